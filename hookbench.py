@@ -0,0 +1,374 @@
+#!/usr/bin/python3
+
+"""Libvirt port-forwarding hook scale benchmarks.
+
+Generates synthetic configurations, runs the hook end to end against stub
+firewall binaries, and hookctrl in process. The results are written as JSON,
+and can be compared with the results of an earlier run.
+
+0.0.1:
+======
+
+ * Initial version
+
+"""
+
+__author__ = "Martin Bo Kristensen Groenholdt <martin.groenholdt@gmail.com>"
+__version__ = "0.0.1"
+
+import argparse
+import ipaddress
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Directory of the hook scripts.
+HOOK_PATH = os.path.dirname(os.path.abspath(__file__))
+# Stub standing in for the firewall binaries. It logs every call, so the
+# number of forks can be counted, and answers the capability probes.
+STUB = """#!/bin/sh
+echo "$(basename "$0") $*" >> "$STUB_LOG"
+case "$(basename "$0") $1" in
+    *-restore\\ --help) echo "  --noflush";;
+    *-restore\\ *) cat > /dev/null;;
+    "nft -f") cat > /dev/null;;
+    *\\ --version) echo "iptables v1.8.7 (legacy)";;
+esac
+exit 0
+"""
+# Binaries replaced by the stub.
+STUB_BINARIES = ['iptables', 'iptables-restore', 'iptables-save', 'ipset',
+                 'nft']
+# Slow downs below this many ms are noise, not regressions.
+MIN_DELTA = 1.0
+# Format version of the results file.
+RESULTS_VERSION = 1
+
+
+def synthetic_config(machines, ports, networks, backend='iptables'):
+    """
+    Generate a configuration.
+
+    Public ports are handed out in sequence and wrap around, so large
+    configurations reuse them.
+
+    :param machines: Number of machines.
+    :param ports: Number of port mappings of each machine.
+    :param networks: Number of networks.
+    :param backend: Firewall backend.
+    :return: Configuration data.
+    """
+    config = {'debug': False, 'public_ip': '192.0.2.1', 'backend': backend,
+              'machines': {}, 'networks': {}}
+    first_ip = int(ipaddress.ip_address('10.0.0.1'))
+    public_port = itertools.cycle(range(1024, 65536))
+    for index in range(machines):
+        config['machines']['vm{}'.format(index)] = {
+            'private_ip': str(ipaddress.ip_address(first_ip + index)),
+            'port_map': [[next(public_port), 22 + port] for port in
+                         range(ports)]}
+    first_net = int(ipaddress.ip_address('172.16.0.0'))
+    for index in range(networks):
+        config['networks']['net{}'.format(index)] = str(
+            ipaddress.ip_network((first_net + index * 256, 24)))
+    return config
+
+
+class Bench:
+    """
+    Benchmark environment: a configuration, stub binaries and run time state
+    in a temporary directory.
+    """
+
+    def __init__(self, tmp_dir):
+        """
+        Constructor, installs the stubs and the hook links.
+        """
+        self.tmp_dir = tmp_dir
+        self.config_filename = os.path.join(tmp_dir, 'config.json')
+        self.stub_log = os.path.join(tmp_dir, 'stub.log')
+        bin_path = os.path.join(tmp_dir, 'bin')
+        os.makedirs(bin_path)
+        for binary in STUB_BINARIES:
+            with open(os.path.join(bin_path, binary), 'w') as stub_file:
+                stub_file.write(STUB)
+            os.chmod(os.path.join(bin_path, binary), 0o755)
+        # libvirt calls the hook through links named after the hook.
+        for hook in ['qemu', 'network']:
+            os.symlink(os.path.join(HOOK_PATH, 'hooks.py'),
+                       os.path.join(tmp_dir, hook))
+        self.env = dict(os.environ,
+                        CONFIG_FILENAME=self.config_filename,
+                        RUN_PATH=os.path.join(tmp_dir, 'run'),
+                        SOCKET_FILENAME=os.path.join(tmp_dir, 'no-hookd'),
+                        IPTABLES_BINARY=os.path.join(bin_path, 'iptables'),
+                        IPSET_BINARY=os.path.join(bin_path, 'ipset'),
+                        NFT_BINARY=os.path.join(bin_path, 'nft'),
+                        TIMINGS_FILENAME=os.path.join(tmp_dir,
+                                                      'timings.jsonl'),
+                        STUB_LOG=self.stub_log)
+
+    def write_config(self, config):
+        with open(self.config_filename, 'w') as json_file:
+            json.dump(config, json_file)
+        for filename in [self.config_filename + '.cache',
+                         os.path.join(self.tmp_dir, 'run')]:
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            elif os.path.exists(filename):
+                os.remove(filename)
+
+    def forks(self):
+        """
+        Get the number of stub calls so far.
+        """
+        try:
+            with open(self.stub_log, 'r') as log_file:
+                return sum(1 for line in log_file)
+        except FileNotFoundError:
+            return 0
+
+    def run_hook(self, hook, libvirt_object, action):
+        """
+        Run the hook in a new process, as libvirt does.
+
+        :return: Tuple of the wall time in ms, the number of forks of
+                 firewall binaries, the peak RSS of the hook in KiB and the
+                 time the hook spent loading the configuration in ms.
+        """
+        forks = self.forks()
+        start = time.monotonic()
+        process = subprocess.Popen([os.path.join(self.tmp_dir, hook),
+                                    libvirt_object, action, 'begin', '-'],
+                                   env=self.env, stdin=subprocess.DEVNULL)
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall = (time.monotonic() - start) * 1000
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            raise RuntimeError('The hook failed with status {}'.format(
+                process.returncode))
+        # The hook reports its phases as the last line of the timings.
+        with open(self.env['TIMINGS_FILENAME'], 'r') as timings_file:
+            phases = json.loads(timings_file.readlines()[-1])['phases']
+        return wall, self.forks() - forks, usage.ru_maxrss, phases['load']
+
+
+def timed(function, *args, **kwargs):
+    """
+    Call a function.
+
+    :return: Tuple of the result and the time it took in ms.
+    """
+    start = time.monotonic()
+    result = function(*args, **kwargs)
+    return result, (time.monotonic() - start) * 1000
+
+
+def bench_size(bench, machines, ports, networks, backend, repeat):
+    """
+    Run all the benchmarks for one configuration size.
+
+    :return: List of result records.
+    """
+    import hookctrl
+    import hooks
+    from hookjsonconf import HookConfig
+
+    size = {'machines': machines, 'ports': ports, 'networks': networks,
+            'backend': backend}
+    config = synthetic_config(machines, ports, networks, backend)
+    bench.write_config(config)
+    machine = 'vm{}'.format(machines // 2)
+    network = 'net{}'.format(networks // 2)
+    results = []
+
+    def record(case, wall, forks, rss, parse):
+        results.append(dict(size, case=case, wall_ms=wall, forks=forks,
+                            peak_rss_kb=rss, parse_ms=parse,
+                            parse_share=parse / wall if wall > 0 else 0))
+
+    # First hook call after a change, compiling the configuration cache.
+    record('hook_cold', *bench.run_hook('qemu', machine, 'start'))
+
+    # Every start follows a stop, as it does in libvirt, so it does not
+    # remove the rules of the previous run first.
+    runs = []
+    for index in range(repeat):
+        bench.run_hook('qemu', machine, 'stopped')
+        runs.append(bench.run_hook('qemu', machine, 'start'))
+    record('hook_machine', *(min(values) for values in zip(*runs)))
+
+    if networks:
+        runs = [bench.run_hook('network', network, 'plugged') for index in
+                range(repeat)]
+        record('hook_network', *(min(values) for values in zip(*runs)))
+
+    # Rule generation and application in process, with the models the hook
+    # uses.
+    json_config = HookConfig()
+    loaded = json_config.models(json_config.load(bench.config_filename,
+                                                 machine=machine))
+    walls = []
+    forks = 0
+    for index in range(repeat):
+        hooks.ctrl_machine('stopped', machine, loaded)
+        before = bench.forks()
+        walls.append(timed(hooks.ctrl_machine, 'start', machine, loaded)[1])
+        forks += bench.forks() - before
+    record('ctrl_machine', min(walls), forks // repeat,
+           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 0)
+
+    # A hookctrl edit: read, index, change and build the whole file.
+    walls = []
+    parses = []
+    for index in range(repeat):
+        start = time.monotonic()
+        json_config = HookConfig()
+        parsed, parse = timed(json_config.read, bench.config_filename)
+        hookctrl.process_config(parsed, argparse.Namespace(
+            cmd='add_machine', name='bench', private_ip='10.255.255.254'))
+        json_config.build(parsed, True)
+        walls.append((time.monotonic() - start) * 1000)
+        parses.append(parse)
+    record('hookctrl', min(walls), 0,
+           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, min(parses))
+    return results
+
+
+def run(machines, ports, networks, backend='iptables', repeat=3,
+        max_mappings=None):
+    """
+    Run the benchmarks for every combination of the configuration sizes.
+
+    :param machines: List of numbers of machines.
+    :param ports: List of numbers of port mappings per machine.
+    :param networks: Number of networks.
+    :param backend: Firewall backend.
+    :param repeat: Number of runs of each benchmark, the fastest counts.
+    :param max_mappings: Skip configurations with more port mappings.
+    :return: Results, as written to the results file.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bench = Bench(tmp_dir)
+        # The hook modules read their settings when imported.
+        saved_env = dict(os.environ)
+        os.environ.update(bench.env)
+        sys.path.insert(0, HOOK_PATH)
+        try:
+            for machine_count, port_count in itertools.product(machines,
+                                                               ports):
+                if (max_mappings is not None and
+                        machine_count * port_count > max_mappings):
+                    continue
+                results += bench_size(bench, machine_count, port_count,
+                                      networks, backend, repeat)
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_env)
+    return {'version': RESULTS_VERSION, 'python': platform.python_version(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+
+
+def result_key(result):
+    return (result['case'], result['machines'], result['ports'],
+            result['networks'], result['backend'])
+
+
+def compare(baseline, current, threshold):
+    """
+    Compare the wall times of two benchmark runs.
+
+    :param baseline: Results of the earlier run.
+    :param current: Results of this run.
+    :param threshold: Relative slow down counted as a regression, if it is
+                      also over MIN_DELTA.
+    :return: List of (key, baseline ms, current ms, regression) tuples.
+    """
+    old = {result_key(result): result for result in baseline['results']}
+    rows = []
+    for result in current['results']:
+        key = result_key(result)
+        if key not in old:
+            continue
+        before = old[key]['wall_ms']
+        after = result['wall_ms']
+        rows.append((key, before, after,
+                     after > before * (1 + threshold) and
+                     after - before > MIN_DELTA))
+    return rows
+
+
+def parse_sizes(value):
+    try:
+        return [int(size) for size in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected comma separated numbers')
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Scale benchmarks of ' +
+                                         'the libvirt hook and hookctrl.')
+    arg_parser.add_argument("--machines", type=parse_sizes,
+                            default=[10, 1000, 50000],
+                            help="Comma separated numbers of machines.")
+    arg_parser.add_argument("--ports", type=parse_sizes, default=[1, 10, 500],
+                            help="Comma separated numbers of port " +
+                            "mappings per machine.")
+    arg_parser.add_argument("--networks", type=int, default=200,
+                            help="Number of networks.")
+    arg_parser.add_argument("--backend", type=str, default='iptables',
+                            choices=['iptables', 'iptables-restore', 'nft'],
+                            help="Firewall backend.")
+    arg_parser.add_argument("--repeat", type=int, default=3,
+                            help="Runs of each benchmark, the fastest counts.")
+    arg_parser.add_argument("--max_mappings", type=int, default=1000000,
+                            help="Skip configurations with more port " +
+                            "mappings.")
+    arg_parser.add_argument("--output", type=str, default='bench.json',
+                            help="File to write the results to.")
+    arg_parser.add_argument("--compare", type=str,
+                            help="Results of an earlier run to compare with.")
+    arg_parser.add_argument("--threshold", type=float, default=0.2,
+                            help="Relative slow down counted as a " +
+                            "regression.")
+    args = arg_parser.parse_args()
+
+    results = run(args.machines, args.ports, args.networks, args.backend,
+                  args.repeat, args.max_mappings)
+    with open(args.output, 'w') as results_file:
+        json.dump(results, results_file, indent=4)
+
+    print('{:<14} {:>8} {:>6} {:>10} {:>6} {:>10} {:>6}'.format(
+        'case', 'machines', 'ports', 'wall ms', 'forks', 'rss KiB',
+        'parse'))
+    for result in results['results']:
+        print('{case:<14} {machines:>8} {ports:>6} {wall_ms:>10.1f} '
+              '{forks:>6} {peak_rss_kb:>10} {parse_share:>6.0%}'.format(
+                  **result))
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = 0
+        print()
+        for key, before, after, regression in compare(baseline, results,
+                                                      args.threshold):
+            print('{:<14} {:>8} {:>6} {:>10.1f} -> {:>10.1f} {}'.format(
+                key[0], key[1], key[2], before, after,
+                'REGRESSION' if regression else ''))
+            regressions += regression
+        if regressions:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
+    exit(0)
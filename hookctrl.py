@@ -5,6 +5,20 @@
 Utility for adding, modifying and deleting machine definitions from the Libvirt 
 hook configuration file.
 
+0.1.0:
+======
+ * SQLite configuration store, edited in a single transaction.
+ * reconcile command re-installing the rules of the whole host.
+ * Port ranges in port mappings, and overlap checks between mappings.
+ * Check private IP addresses, networks and public ports against indexes
+   of the configuration, rejecting collisions between machines.
+ * Batch mode applying JSON lines or CSV commands as one change.
+ * Write the configuration file in place, atomically and under a lock.
+ * Optionally apply port changes to running machines at once.
+ * plan command writing the rules of the configuration.
+ * compile command writing the rules of each machine and network as
+   fragments the hook streams, compiled again after every edit.
+
 0.0.1:
 ======
  * Initial version
@@ -12,26 +26,67 @@ hook configuration file.
 """
 
 __author__ = "Martin Bo Kristensen Groenholdt <martin.groenholdt@gmail.com>"
-__version__ = "0.0.1"
+__version__ = "0.1.0"
 
 import argparse
+import bisect
+import copy
+import csv
 import ipaddress
 import json
 import os
+import re
+import sqlite3
+import subprocess
 import sys
+import time
+import urllib.parse
 from enum import Enum
-from hookjsonconf import HookConfig
+import hooks
+from hookjsonconf import HookConfig, ConfigChangedError, SQL_EXTENSIONS, \
+    port_range
+from hookmodel import Machine, Network
+from hooksqlconf import HookSQLConfig
 
 CONFIG_PATH = os.getenv('CONFIG_PATH') or os.path.dirname(
     os.path.abspath(__file__))
 # Name of the forwarding configuration file.
 CONFIG_FILENAME = os.getenv('CONFIG_FILENAME') or os.path.join(CONFIG_PATH,
                                                                'config.json')
+# Number of times an edit is tried when the file is changed concurrently.
+WRITE_ATTEMPTS = 3
+
+
+# Commands allowed in a batch of commands.
+BATCH_COMMANDS = ['add_machine', 'remove_machine', 'add_network',
+                  'remove_network', 'add_port', 'remove_port']
+# Commands changing the rules of a running machine.
+LIVE_COMMANDS = ['add_port', 'remove_port', 'remove_machine']
+# Commands changing a machine or a network.
+MACHINE_COMMANDS = ['add_machine', 'remove_machine', 'add_port',
+                    'remove_port']
+NETWORK_COMMANDS = ['add_network', 'remove_network']
+# Actions of the compiled fragments of machines and networks.
+FRAGMENT_ACTIONS = {'machine': ['start', 'stopped', 'ledger'],
+                    'network': ['plugged', 'unplugged']}
+# Fields of a command in a batch.
+BATCH_FIELDS = ['cmd', 'name', 'private_ip', 'public_port', 'vm_port',
+                'network']
 
 
 class ConfigError(Exception):
     pass
 
+
+class BatchError(ConfigError):
+    """
+    Errors of the lines of a batch of commands.
+    """
+
+    def __init__(self, errors):
+        super().__init__('\n'.join(errors))
+        self.errors = errors
+
 # class ArgumentParser(argparse.ArgumentParser):
 #     """
 #     Derived class preventing exit on parser error
@@ -70,23 +125,215 @@ def create_argparser():
                                               'add_network',
                                               'remove_network',
                                               'add_port',
-                                              'remove_port'], type=str, default='',
+                                              'remove_port',
+                                              'reconcile',
+                                              'plan',
+                                              'compile'], type=str,
+                            default='',
                             help="Sub entry commands.")
     # Sub entry values
     arg_parser.add_argument("--name", type=str, default='',
                             help="Name of the entry.")
     arg_parser.add_argument("--private_ip", type=str,
                             help="Set the private IP address of a machine.")
-    arg_parser.add_argument("--public_port", type=int,
-                            help="Set the public port of the mapping.")
-    arg_parser.add_argument("--vm-port", type=int,
-                            help="Set the machine port of the mapping.")
+    arg_parser.add_argument("--public_port", type=str,
+                            help="Set the public port or port range " +
+                            "(first-last) of the mapping.")
+    arg_parser.add_argument("--vm-port", type=str,
+                            help="Set the machine port or port range " +
+                            "(first-last) of the mapping.")
     arg_parser.add_argument("--network", type=str,
                             help="Set IP range of a network.")
+    # SQLite configuration store
+    arg_parser.add_argument("--import_json", type=str,
+                            help="Replace the contents of an SQLite " +
+                            "configuration store with a JSON configuration " +
+                            "file.")
+    arg_parser.add_argument("--export_json", action='store_true',
+                            help="Print the contents of an SQLite " +
+                            "configuration store as JSON.")
+    arg_parser.add_argument("--format", choices=['restore', 'nft', 'jsonl'],
+                            type=str,
+                            help="Output format of the plan command, " +
+                            "default after the backend.")
+    arg_parser.add_argument("--apply", action='store_true',
+                            help="Apply port changes to running machines " +
+                            "at once.")
+    arg_parser.add_argument("--dry_run", action='store_true',
+                            help="Print the new configuration instead of " +
+                            "writing it.")
+    # Batch of commands
+    arg_parser.add_argument("--batch", type=str,
+                            help="Apply the commands in a JSON lines or " +
+                            "CSV file (- for stdin) as one change.")
 
     return arg_parser
 
 
+def check_port(port, name):
+    """
+    Check and convert a port or port range from the command line.
+
+    :param port: Port number, or port range as "first-last".
+    :param name: Name of the port in error messages.
+    :return: The port as an integer, or the port range as a string.
+    """
+    if port is None or not re.match(r'^\d+(-\d+)?$', str(port)):
+        raise argparse.ArgumentTypeError('Invalid ' + name)
+
+    first, last = port_range(port)
+
+    if first < 0 or last > 65535 or first > last:
+        raise argparse.ArgumentTypeError('Invalid ' + name)
+
+    if first == last:
+        return first
+    return '{}-{}'.format(first, last)
+
+
+def port_size(port):
+    """
+    Get the number of ports in a port or port range.
+    """
+    first, last = port_range(port)
+    return last - first + 1
+
+
+class Intervals:
+    """
+    Non-overlapping ranges with an owner, sorted by their first value.
+
+    Only the range starting right before the end of a new range can overlap
+    it, which is found by bisection.
+    """
+
+    def __init__(self, ranges=()):
+        """
+        Constructor.
+
+        :param ranges: (first, last, owner) tuples.
+        """
+        self.ranges = sorted(ranges)
+        self.firsts = [first for first, last, owner in self.ranges]
+
+    def find(self, first, last):
+        """
+        Find a range overlapping first to last.
+
+        :return: Tuple of the first and last value and the owner, or None if
+                 no range overlaps.
+        """
+        index = bisect.bisect_right(self.firsts, last)
+        if index > 0 and self.ranges[index - 1][1] >= first:
+            return self.ranges[index - 1]
+        return None
+
+    def add(self, first, last, owner):
+        index = bisect.bisect_right(self.firsts, first)
+        self.firsts.insert(index, first)
+        self.ranges.insert(index, (first, last, owner))
+
+    def remove(self, first, last, owner):
+        index = bisect.bisect_left(self.ranges, (first, last, owner))
+        if index < len(self.ranges) and \
+                self.ranges[index] == (first, last, owner):
+            del self.firsts[index]
+            del self.ranges[index]
+
+
+def network_range(network):
+    """
+    Get the first and last address of a network, comparable across IPv4 and
+    IPv6.
+    """
+    network = ipaddress.ip_network(network, strict=False)
+    return ((network.version, int(network.network_address)),
+            (network.version, int(network.broadcast_address)))
+
+
+class ConfigIndex:
+    """
+    Reverse indexes of a configuration, built once per load.
+
+    The indexes are kept up to date by process_config(), so that every
+    check is a lookup instead of a scan of all the machines.
+    """
+
+    def __init__(self, config):
+        """
+        Constructor, indexes all the machines and networks.
+        """
+        # (machine, public port, vm port) -> port mapping in the config.
+        self.mappings = dict()
+        # Private IP address -> machine.
+        self.private_ips = dict()
+        port_ranges = []
+        for name, machine in config['machines'].items():
+            self.private_ips[machine['private_ip']] = name
+            for mapping in machine['port_map']:
+                self.mappings[self.mapping_key(name, *mapping)] = mapping
+                port_ranges.append(port_range(mapping[0]) + (name,))
+        # Public port ranges -> machine.
+        self.ports = Intervals(port_ranges)
+        # Network IP ranges -> network.
+        self.networks = Intervals(network_range(network) + (name,) for
+                                  name, network in config['networks'].items())
+
+    @staticmethod
+    def mapping_key(name, public_port, vm_port):
+        # Ports are ints or strings depending on where they came from.
+        return name, str(public_port), str(vm_port)
+
+    def port_owner(self, public_port):
+        """
+        Find a mapping overlapping a public port or port range.
+
+        :return: Tuple of the first and last port and the machine name, or
+                 None if no mapping overlaps.
+        """
+        return self.ports.find(*port_range(public_port))
+
+    def network_owner(self, network):
+        """
+        Find a network overlapping an IP range.
+
+        :return: Tuple of the first and last address and the network name, or
+                 None if no network overlaps.
+        """
+        return self.networks.find(*network_range(network))
+
+    def mapping(self, name, public_port, vm_port):
+        """
+        Get a port mapping of a machine.
+
+        :return: The port mapping as stored in the configuration, or None.
+        """
+        return self.mappings.get(self.mapping_key(name, public_port, vm_port))
+
+    def add_machine(self, name, private_ip):
+        self.private_ips[private_ip] = name
+
+    def remove_machine(self, name, machine):
+        for mapping in machine['port_map']:
+            self.remove_port(name, *mapping)
+        if self.private_ips.get(machine['private_ip']) == name:
+            del self.private_ips[machine['private_ip']]
+
+    def add_network(self, name, network):
+        self.networks.add(*network_range(network) + (name,))
+
+    def remove_network(self, name, network):
+        self.networks.remove(*network_range(network) + (name,))
+
+    def add_port(self, name, mapping):
+        self.mappings[self.mapping_key(name, *mapping)] = mapping
+        self.ports.add(*port_range(mapping[0]) + (name,))
+
+    def remove_port(self, name, public_port, vm_port):
+        del self.mappings[self.mapping_key(name, public_port, vm_port)]
+        self.ports.remove(*port_range(public_port) + (name,))
+
+
 def check_args(args):
     # Check that the command has a name parameter
     if args.cmd != '':
@@ -95,9 +342,13 @@ def check_args(args):
                             'add_network',
                             'remove_network',
                             'add_port',
-                            'remove_port']:
+                            'remove_port',
+                            'reconcile',
+                            'plan',
+                            'compile']:
             raise argparse.ArgumentTypeError('wrong command "' + args.cmd + '"')
-        if 'port' not in args.cmd:
+        if 'port' not in args.cmd and args.cmd not in ['reconcile', 'plan',
+                                                       'compile']:
             if args.name == '':
                 raise argparse.ArgumentTypeError('argument --cmd ' + args.cmd +
                                                  ' needs the --name argument')
@@ -114,21 +365,12 @@ def check_args(args):
             except ValueError:
                 raise argparse.ArgumentTypeError('Invalid network IP range')
         elif args.cmd == 'add_port' or args.cmd == 'remove_port':
-            try:
-                args.public_port = int(args.public_port)
-            except TypeError:
-                raise argparse.ArgumentTypeError('Invalid public port')
+            args.public_port = check_port(args.public_port, 'public port')
+            args.vm_port = check_port(args.vm_port, 'vm port')
 
-            if args.public_port < 0 or args.public_port > 65535:
-                raise argparse.ArgumentTypeError('Invalid public port')
-
-            try:
-                args.vm_port = int(args.vm_port)
-            except TypeError:
-                raise argparse.ArgumentTypeError('Invalid vm port')
-
-            if args.vm_port < 0 or args.vm_port > 65535:
-                raise argparse.ArgumentTypeError('Invalid vm port')
+            if port_size(args.public_port) != port_size(args.vm_port):
+                raise argparse.ArgumentTypeError('Public and vm port ranges '
+                                                 'differ in size')
 
     return True
 
@@ -167,52 +409,76 @@ def add_port(config, name, public_port, vm_port):
 
 def remove_port(config, name, public_port, vm_port):
     port_map = config['machines'][name]['port_map']
-
-    i = 0
-    index = -1
-    for mapping in port_map:
-        if mapping[0] == public_port and mapping[1] == vm_port:
-            index = i
-            break
-        i += 1
-
-    if index != -1:
-        del config['machines'][name]['port_map'][index]
+    if [public_port, vm_port] in port_map:
+        port_map.remove([public_port, vm_port])
 
     return config
 
 
-def process_config(config, args=None):
+def process_config(config, args=None, index=None):
+    """
+    Apply the command line to the configuration data.
+
+    :param config: Configuration data.
+    :param args: Parsed command line.
+    :param index: ConfigIndex of the configuration, kept up to date with the
+                  changes. Built from the configuration if None.
+    :return: The configuration data.
+    """
     if 'cmd' in args.__dict__.keys():
         if args.cmd != '':
+            if index is None:
+                index = ConfigIndex(config)
             if args.cmd == 'add_machine':
                 if args.name in config['machines'].keys():
                     raise ConfigError('Machine exists')
+                if args.private_ip in index.private_ips:
+                    raise ConfigError('Private IP address is used by machine '
+                                      '{}'.format(
+                                          index.private_ips[args.private_ip]))
                 config = add_machine(config, args.name, args.private_ip)
+                index.add_machine(args.name, args.private_ip)
             elif args.cmd == 'remove_machine':
                 if args.name not in config['machines'].keys():
                     raise ConfigError('Machine does not exist')
+                index.remove_machine(args.name, config['machines'][args.name])
                 config = remove_machine(config, args.name)
             elif args.cmd == 'add_network':
                 if args.name in config['networks'].keys():
                     raise ConfigError('Network exists')
+                overlap = index.network_owner(args.network)
+                if overlap is not None:
+                    raise ConfigError('Network overlaps network '
+                                      '{}'.format(overlap[2]))
                 config = add_network(config, args.name, args.network)
+                index.add_network(args.name, args.network)
             elif args.cmd == 'remove_network':
                 if args.name not in config['networks'].keys():
                     raise ConfigError('Network does not exist')
+                index.remove_network(args.name, config['networks'][args.name])
                 config = remove_network(config, args.name)
             elif args.cmd == 'add_port':
                 if args.name not in config['machines'].keys():
                     raise ConfigError('Machine does not exist')
-                if [args.public_port, args.vm_port] in config['machines'][args.name]['port_map']:
+                if index.mapping(args.name, args.public_port,
+                                 args.vm_port) is not None:
                     raise ConfigError('Port mapping exists')
+                overlap = index.port_owner(args.public_port)
+                if overlap is not None:
+                    raise ConfigError('Public port overlaps a mapping of '
+                                      'machine {}'.format(overlap[2]))
                 config = add_port(config, args.name, args.public_port, args.vm_port)
+                index.add_port(args.name,
+                               config['machines'][args.name]['port_map'][-1])
             elif args.cmd == 'remove_port':
                 if args.name not in config['machines'].keys():
                     raise ConfigError('Machine does not exist')
-                if [args.public_port, args.vm_port] not in config['machines'][args.name]['port_map']:
+                mapping = index.mapping(args.name, args.public_port,
+                                        args.vm_port)
+                if mapping is None:
                     raise ConfigError('Port mapping does not exists')
-                config = remove_port(config, args.name, args.public_port, args.vm_port)
+                index.remove_port(args.name, *mapping)
+                config = remove_port(config, args.name, *mapping)
 
     if 'debug' in args.__dict__.keys():
         config['debug'] = args.debug
@@ -226,6 +492,619 @@ def process_config(config, args=None):
     return config
 
 
+def process_store(store, args=None):
+    """
+    Apply the command line to an SQLite configuration store.
+
+    All the changes are made in a single transaction, nothing is changed if
+    any of them fail.
+    """
+    with store.transaction():
+        store_command(store, args)
+
+
+def store_command(store, args):
+    """
+    Apply a command to an SQLite configuration store, in the current
+    transaction.
+    """
+    if 'cmd' in args.__dict__.keys():
+        if args.cmd == 'add_machine':
+            if store.machine(args.name) is not None:
+                raise ConfigError('Machine exists')
+            owner = store.ip_owner(args.private_ip)
+            if owner is not None:
+                raise ConfigError('Private IP address is used by machine '
+                                  '{}'.format(owner))
+            store.add_machine(args.name, args.private_ip)
+        elif args.cmd == 'remove_machine':
+            if store.machine(args.name) is None:
+                raise ConfigError('Machine does not exist')
+            store.remove_machine(args.name)
+        elif args.cmd == 'add_network':
+            if store.network(args.name) is not None:
+                raise ConfigError('Network exists')
+            overlap = store.network_owner(args.network)
+            if overlap is not None:
+                raise ConfigError('Network overlaps network '
+                                  '{}'.format(overlap))
+            store.add_network(args.name, args.network)
+        elif args.cmd == 'remove_network':
+            if store.network(args.name) is None:
+                raise ConfigError('Network does not exist')
+            store.remove_network(args.name)
+        elif args.cmd == 'add_port':
+            if store.machine(args.name) is None:
+                raise ConfigError('Machine does not exist')
+            if store.port_owner(args.public_port) is not None:
+                raise ConfigError('Port mapping exists')
+            store.add_port(args.name, args.public_port, args.vm_port)
+        elif args.cmd == 'remove_port':
+            if store.machine(args.name) is None:
+                raise ConfigError('Machine does not exist')
+            if not store.remove_port(args.name, args.public_port,
+                                     args.vm_port):
+                raise ConfigError('Port mapping does not exists')
+
+    if 'debug' in args.__dict__.keys():
+        store.set('debug', args.debug)
+
+    if 'public_ip' in args.__dict__.keys():
+        try:
+            store.set('public_ip',
+                      ipaddress.ip_address(args.public_ip).exploded)
+        except ValueError:
+            raise argparse.ArgumentTypeError('Invalid public IP address')
+
+
+def read_batch(batch_file):
+    """
+    Read the commands of a batch.
+
+    The commands are JSON objects, one per line, or CSV with a header line
+    naming the fields. Both use the names of BATCH_FIELDS. Empty lines and
+    lines starting with # are skipped.
+
+    :param batch_file: File object to read from.
+    :return: Iterator of (line number, arguments) tuples. The arguments are
+             an exception if the line could not be read.
+    """
+    header = None
+    for lineno, line in enumerate(batch_file, 1):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        try:
+            if line.startswith('{'):
+                fields = json.loads(line)
+                if not isinstance(fields, dict):
+                    raise ValueError('Expected a JSON object')
+            elif header is None:
+                header = next(csv.reader([line]))
+                unknown = set(header) - set(BATCH_FIELDS)
+                if unknown:
+                    header = None
+                    raise ValueError('Unknown fields ' +
+                                     ', '.join(sorted(unknown)))
+                continue
+            else:
+                values = next(csv.reader([line]))
+                if len(values) > len(header):
+                    raise ValueError('Too many values')
+                fields = {key: value for key, value in zip(header, values)
+                          if value != ''}
+            unknown = set(fields) - set(BATCH_FIELDS)
+            if unknown:
+                raise ValueError('Unknown fields ' + ', '.join(sorted(unknown)))
+            args = argparse.Namespace(cmd='', name='', private_ip=None,
+                                      public_port=None, vm_port=None,
+                                      network=None)
+            args.__dict__.update(fields)
+            yield lineno, args
+        except ValueError as exception:
+            yield lineno, exception
+
+
+def run_batch(commands, apply):
+    """
+    Check and apply a batch of commands.
+
+    All the commands are tried, so that every bad line is reported at once.
+
+    :param commands: Iterator of (line number, arguments) tuples, see
+                     read_batch().
+    :param apply: Function applying the arguments of a command.
+    :return: Number of commands applied.
+    :raise BatchError: If any command failed.
+    """
+    count = 0
+    errors = []
+    for lineno, args in commands:
+        try:
+            if isinstance(args, Exception):
+                raise args
+            if args.cmd not in BATCH_COMMANDS:
+                raise ConfigError('Unsupported command "{}"'.format(args.cmd))
+            check_args(args)
+            apply(args)
+            count += 1
+        except (ValueError, argparse.ArgumentTypeError, ConfigError,
+                sqlite3.Error) as exception:
+            errors.append('Line {}: {}'.format(lineno, exception))
+    if errors:
+        raise BatchError(errors)
+    return count
+
+
+def process_batch(config, commands):
+    """
+    Apply a batch of commands to the configuration data.
+
+    The configuration is indexed once for the whole batch. If any command
+    fails the configuration data is left in an undefined state, and must
+    not be written.
+
+    :return: Number of commands applied.
+    """
+    index = ConfigIndex(config)
+    return run_batch(commands,
+                     lambda args: process_config(config, args, index))
+
+
+def process_store_batch(store, commands):
+    """
+    Apply a batch of commands to an SQLite configuration store.
+
+    Nothing is changed if any of the commands fail.
+
+    :return: Number of commands applied.
+    """
+    with store.transaction():
+        return run_batch(commands, lambda args: store_command(store, args))
+
+
+def open_batch(filename):
+    """
+    Open a batch of commands, - is stdin.
+    """
+    if filename == '-':
+        return open(sys.stdin.fileno(), 'r', closefd=False)
+    return open(filename, 'r')
+
+
+def print_batch_summary(count, start):
+    """
+    Print the number of commands applied and the rate on stderr.
+    """
+    elapsed = time.monotonic() - start
+    print('Applied {} commands in {:.1f} ms ({:.0f} commands/s)'.format(
+        count, elapsed * 1000, count / elapsed if elapsed > 0 else 0),
+        file=sys.stderr)
+
+
+def virsh_probe(kind):
+    """
+    Get the names of the running libvirt objects using virsh.
+
+    The machines are the QEMU domains of the default connection and the LXC
+    containers, if libvirt has the LXC driver.
+
+    :param kind: 'machine' or 'network'.
+    :return: Set of names.
+    """
+    if kind == 'network':
+        args = ['virsh', 'net-list', '--name']
+    else:
+        args = ['virsh', 'list', '--name']
+    output = subprocess.run(args, stdout=subprocess.PIPE,
+                            check=True).stdout.decode('utf-8')
+    if kind != 'network':
+        try:
+            output += subprocess.run(['virsh', '-c', 'lxc:///', 'list',
+                                      '--name'], stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL,
+                                     check=True).stdout.decode('utf-8')
+        except subprocess.CalledProcessError:
+            pass
+    return set(name for name in output.split('\n') if name != '')
+
+
+def config_models(config, machines=None, networks=None):
+    """
+    Build the models the hook builds its rules from, so that the rules of
+    hookctrl are the same, see hookmodel.
+
+    :param config: Configuration data.
+    :param machines: Names of the machines to include, all if None.
+    :param networks: Names of the networks to include, all if None.
+    :return: Configuration data with Machine and Network objects.
+    :raise ConfigError: If an entry is invalid.
+    """
+    entries = dict(config)
+    for kind, names in [('machines', machines), ('networks', networks)]:
+        if names is not None:
+            entries[kind] = {name: config[kind][name] for name in names
+                             if name in config[kind]}
+    try:
+        return HookConfig().models(entries)
+    except ValueError as exception:
+        raise ConfigError(str(exception))
+
+
+def desired_rules(config, probe=virsh_probe):
+    """
+    Build the rules of all the running machines and networks.
+
+    :param config: Configuration models, see config_models().
+    :param probe: Function returning the names of the running libvirt
+                  objects, see virsh_probe().
+    :return: List of argument lists, including the binary.
+    """
+    cmds = []
+    for name in sorted(probe('machine')):
+        if name in config['machines']:
+            cmds += hooks.machine_rules('start', name,
+                                        config['machines'][name], config)
+    for name in sorted(probe('network')):
+        if name in config['networks']:
+            cmds += hooks.network_rules('plugged', config['networks'][name],
+                                        config, check=False)
+    return cmds
+
+
+def reconcile(config, probe=virsh_probe):
+    """
+    Install the missing and remove the extra rules of the whole host.
+
+    The installed rules are read with a single iptables-save, and the
+    difference is applied in a single iptables-restore. The ledgers of the
+    machines are rewritten to match.
+
+    :param config: Configuration data.
+    :param probe: Function returning the names of the running libvirt
+                  objects, see virsh_probe().
+    :return: List of the commands that were applied.
+    :raise ConfigError: If an entry is invalid or the rules can not be
+                        applied.
+    """
+    config = config_models(config)
+    running = {'machine': probe('machine'), 'network': probe('network')}
+    desired = desired_rules(config, running.get)
+    # The nftables table set up and element additions are idempotent, the
+    # iptables rules are compared with the installed ones.
+    cmds = [cmd for cmd in desired if
+            cmd[0] in [hooks.NFT_BINARY, hooks.IPSET_BINARY]]
+    desired = [cmd for cmd in desired if cmd[0] == hooks.IPTABLES_BINARY]
+    saved = subprocess.run([hooks.IPTABLES_SAVE_BINARY],
+                           stdout=subprocess.PIPE,
+                           check=True).stdout.decode('utf-8')
+    cmds += hooks.reconcile_rules(desired, hooks.parse_iptables_save(saved),
+                                  config)
+    if not hooks.apply_rules(cmds, dict(config, backend='iptables-restore')):
+        raise ConfigError('Error applying the reconciled rules')
+    # The rules of machines that are not running were removed, but not the
+    # nftables elements.
+    write_ledgers(config, running['machine'],
+                  prune=config.get('backend') != 'nft')
+    return cmds
+
+
+def write_ledgers(config, machines, prune=False):
+    """
+    Record the rules of the running machines as installed.
+
+    :param config: Configuration models, see config_models().
+    :param machines: Names of the running machines.
+    :param prune: Remove the ledgers of the machines that are not running.
+    """
+    for name in sorted(machines):
+        installed = []
+        if name in config['machines']:
+            installed = hooks.machine_rules('start', name,
+                                            config['machines'][name], config)
+        hooks.write_ledger(name, installed)
+    if not prune or not os.path.isdir(hooks.LEDGER_PATH):
+        return
+    for filename in os.listdir(hooks.LEDGER_PATH):
+        name = urllib.parse.unquote(filename[:-len('.json')])
+        if filename.endswith('.json') and name not in machines:
+            hooks.write_ledger(name, [])
+
+
+def plan(config, name='', plan_format=None):
+    """
+    Generate the rules of a machine, a network or the whole configuration.
+
+    :param config: Configuration data.
+    :param name: Name of a machine or network, all of them if empty.
+    :param plan_format: 'restore', 'nft' or 'jsonl'. The rules are built for
+                        the backend of the format, or of the configuration
+                        for jsonl.
+    :return: Iterator of (kind, name, argument list) tuples, see
+             hooks.plan_rules().
+    :raise ConfigError: If there is no such entry, or it is invalid.
+    """
+    if plan_format == 'nft':
+        config = dict(config, backend='nft')
+    elif plan_format == 'restore' and config.get('backend') == 'nft':
+        config = dict(config, backend='iptables-restore')
+
+    if name == '':
+        return hooks.plan_rules(config_models(config))
+    if name in config['machines']:
+        return hooks.plan_rules(config_models(config, [name], []), [name],
+                                [])
+    if name in config['networks']:
+        return hooks.plan_rules(config_models(config, [], [name]), [],
+                                [name])
+    raise ConfigError('No machine or network named {}'.format(name))
+
+
+def write_plan(rules, output, plan_format):
+    """
+    Write rules as they are generated.
+
+    :param rules: Iterator of (kind, name, argument list) tuples.
+    :param output: File object to write to.
+    :param plan_format: 'restore' for an iptables-restore payload, ipset
+                        commands are comments, 'nft' for an nft script,
+                        iptables and ipset commands are comments, or
+                        'jsonl' for a JSON object per rule.
+    :return: Number of rules written.
+    """
+    count = 0
+    table = None
+    if plan_format == 'nft':
+        for statement in hooks.NFT_BOOTSTRAP:
+            output.write(statement.format(hooks.NFT_TABLE) + '\n')
+
+    for kind, name, cmd in rules:
+        count += 1
+        if plan_format == 'jsonl':
+            output.write(json.dumps({'kind': kind, 'name': name,
+                                     'cmd': cmd}) + '\n')
+        elif plan_format == 'nft' and cmd[0] == hooks.NFT_BINARY:
+            output.write(' '.join(cmd[1:]) + '\n')
+        elif plan_format == 'nft':
+            output.write('# ' + ' '.join(cmd) + '\n')
+        elif cmd[0] == hooks.IPSET_BINARY:
+            # Outside of the tables, as ipset runs before iptables-restore.
+            if table is not None:
+                output.write('COMMIT\n')
+                table = None
+            output.write('# ' + ' '.join(cmd) + '\n')
+        else:
+            rule_table, line = hooks.restore_line(cmd)
+            if rule_table != table:
+                if table is not None:
+                    output.write('COMMIT\n')
+                output.write('*' + rule_table + '\n')
+                table = rule_table
+            output.write(line + '\n')
+
+    if table is not None:
+        output.write('COMMIT\n')
+    return count
+
+
+def edited_entries(args, commands=None):
+    """
+    Get the machines and networks changed by the commands.
+
+    :param args: Parsed command line.
+    :param commands: Batch of commands, see read_batch().
+    :return: Tuple of the sets of machine and network names, or of None if
+             a global value changes every entry.
+    """
+    if 'public_ip' in args.__dict__.keys():
+        return None, None
+    machines = set()
+    networks = set()
+    commands = [command for lineno, command in commands or [] if
+                not isinstance(command, Exception)]
+    for command in [args] + commands:
+        if command.cmd in MACHINE_COMMANDS:
+            machines.add(command.name)
+        elif command.cmd in NETWORK_COMMANDS:
+            networks.add(command.name)
+    return machines, networks
+
+
+def write_fragment(filename, key, text):
+    """
+    Write a compiled fragment atomically, headed by its key.
+    """
+    tmp_filename = '{}.{}'.format(filename, os.getpid())
+    with open(tmp_filename, 'w') as fragment_file:
+        fragment_file.write('# {}\n'.format(key))
+        fragment_file.write(text)
+    os.replace(tmp_filename, filename)
+
+
+def compile_fragments(config, filename=CONFIG_FILENAME, machines=None,
+                      networks=None):
+    """
+    Write the rules of machines and networks as compiled fragments.
+
+    A machine gets the iptables-restore payloads of its start and stopped
+    events and the ledger recorded after a start, a network those of its
+    plugged and unplugged events. Each fragment is headed by the key of its
+    entry, see hooks.fragment_key(), and the hook only streams current ones.
+    Fragments are only compiled with the "iptables-restore" backend, and not
+    for networks in an ipset. The fragments of removed entries are deleted,
+    as are those of invalid entries, which the hook reports when they are
+    used. Only the entries compiled are checked.
+
+    :param config: Configuration data.
+    :param filename: Name of the configuration file.
+    :param machines: Names of the machines to compile, all if None.
+    :param networks: Names of the networks to compile, all if None.
+    :return: Number of machines and networks compiled.
+    :raise ConfigError: If the fragments can not be written.
+    """
+    if config.get('backend') != 'iptables-restore':
+        return 0
+    path = filename + '.fragments'
+    try:
+        os.makedirs(path, exist_ok=True)
+        existing = {'machine': set(), 'network': set()}
+        if machines is None or networks is None:
+            for fragment in os.listdir(path):
+                kind, separator, name = fragment.rpartition('.')[0].partition(
+                    '-')
+                if kind in existing:
+                    existing[kind].add(urllib.parse.unquote(name))
+        if machines is None:
+            machines = existing['machine'] | set(config['machines'])
+        if networks is None:
+            networks = existing['network'] | set(config['networks'])
+
+        compiled = 0
+        for kind, names in [('machine', machines), ('network', networks)]:
+            for name in sorted(names):
+                fragments = dict()
+                try:
+                    if kind == 'machine' and name in config['machines']:
+                        machine = Machine.from_config(
+                            name, config['machines'][name])
+                        start = hooks.machine_rules('start', name, machine,
+                                                    config)
+                        if start:
+                            fragments = {
+                                'start': hooks.restore_payload(start),
+                                'stopped': hooks.restore_payload(
+                                    hooks.teardown_rules(start)),
+                                'ledger': hooks.ledger_data(start)}
+                    elif (kind == 'network' and name in config['networks'] and
+                          not config.get('network_ipset', False)):
+                        network = Network(name, config['networks'][name])
+                        fragments = {action: hooks.restore_payload(
+                            hooks.network_rules(action, network, config,
+                                                check=False)) for
+                            action in FRAGMENT_ACTIONS['network']}
+                except ValueError:
+                    fragments = dict()
+
+                if fragments:
+                    key = hooks.fragment_key(kind, name, config)
+                    for action, text in fragments.items():
+                        write_fragment(hooks.fragment_filename(
+                            filename, kind, name, action), key, text)
+                    compiled += 1
+                    continue
+                for action in FRAGMENT_ACTIONS[kind]:
+                    fragment = hooks.fragment_filename(filename, kind, name,
+                                                       action)
+                    if os.path.exists(fragment):
+                        os.remove(fragment)
+    except OSError as exception:
+        raise ConfigError('Could not write the compiled fragments: '
+                          '{}'.format(exception))
+    return compiled
+
+
+def live_machines(args, commands=None):
+    """
+    Get the names of the machines whose rules are changed by the commands.
+
+    :param args: Parsed command line.
+    :param commands: Batch of commands, see read_batch().
+    :return: Set of machine names.
+    """
+    names = set()
+    if args.cmd in LIVE_COMMANDS:
+        names.add(args.name)
+    for lineno, command in commands or []:
+        if (not isinstance(command, Exception) and
+                command.cmd in LIVE_COMMANDS):
+            names.add(command.name)
+    return names
+
+
+def machines_snapshot(config, names):
+    """
+    Copy the global values and the given machines of a configuration.
+    """
+    snapshot = dict(config, machines={}, networks={})
+    for name in names:
+        if name in config['machines']:
+            snapshot['machines'][name] = copy.deepcopy(
+                config['machines'][name])
+    return snapshot
+
+
+def store_snapshot(store, names):
+    """
+    Load the global values and the given machines of an SQLite store.
+    """
+    snapshot = store.settings()
+    snapshot['machines'] = dict()
+    snapshot['networks'] = dict()
+    for name in names:
+        machine = store.machine(name)
+        if machine is not None:
+            snapshot['machines'][name] = machine
+    return snapshot
+
+
+def hot_apply(names, old_config, config, probe=virsh_probe):
+    """
+    Apply the changed rules of running machines to the host at once.
+
+    Only the difference between the rules installed for a machine and the
+    rules of its new configuration is applied. The installed rules are
+    taken from the ledger of the machine, or from its old configuration if
+    nothing is recorded.
+
+    :param names: Names of the changed machines.
+    :param old_config: Configuration before the change.
+    :param config: Configuration after the change.
+    :param probe: Function returning the names of the running libvirt
+                  objects, see virsh_probe().
+    :return: List of the commands that were applied.
+    :raise ConfigError: If an entry is invalid or the rules can not be
+                        applied.
+    """
+    cmds = []
+    names = set(names) & probe('machine')
+    old_config = config_models(old_config, names, [])
+    config = config_models(config, names, [])
+    for name in sorted(names):
+        installed = hooks.read_ledger(name)
+        if installed is None:
+            installed = []
+            if name in old_config['machines']:
+                installed = hooks.machine_rules(
+                    'start', name, old_config['machines'][name], old_config)
+        desired = []
+        if name in config['machines']:
+            desired = hooks.machine_rules('start', name,
+                                          config['machines'][name], config)
+
+        delta = hooks.rules_delta(installed, desired)
+        if not delta:
+            continue
+        if not hooks.apply_rules(delta, config):
+            delta = hooks.retry_present(
+                delta, installed,
+                lambda present: hooks.rules_delta(present, desired), config)
+            if delta is None:
+                raise ConfigError('Error applying the rules of machine '
+                                  '{}'.format(name))
+        hooks.write_ledger(name, desired)
+        cmds += delta
+    return cmds
+
+
+def print_applied(cmds):
+    """
+    Print the commands applied to running machines.
+    """
+    for cmd in cmds:
+        print(' '.join(cmd))
+    print('Applied {} commands to running machines'.format(len(cmds)))
+
+
 def main():
     config = None
     arg_parser = create_argparser()
@@ -240,14 +1119,114 @@ def main():
         check_args(args)
 
         json_config = HookConfig()
-        # Path to the forwarding configuration file
-        with open(CONFIG_FILENAME, 'r') as json_config_file:
-            json_config = HookConfig(json_config_file.read())
-            config = json_config.config
+        if args.cmd == 'reconcile':
+            cmds = reconcile(json_config.read(CONFIG_FILENAME))
+            for cmd in cmds:
+                print(' '.join(cmd))
+            print('Reconciled, {} commands applied'.format(len(cmds)))
+            return
+
+        if args.cmd == 'plan':
+            config = json_config.read(CONFIG_FILENAME)
+            plan_format = args.format
+            if plan_format is None:
+                plan_format = 'nft' if config.get('backend') == 'nft' \
+                    else 'restore'
+            write_plan(plan(config, args.name, plan_format), sys.stdout,
+                       plan_format)
+            return
+
+        if args.cmd == 'compile':
+            config = json_config.read(CONFIG_FILENAME)
+            machines, networks = None, None
+            if args.name in config['machines']:
+                machines, networks = {args.name}, set()
+            elif args.name in config['networks']:
+                machines, networks = set(), {args.name}
+            elif args.name != '':
+                raise ConfigError('No machine or network named '
+                                  '{}'.format(args.name))
+            if config.get('backend') != 'iptables-restore':
+                print('Fragments are only compiled for the iptables-restore '
+                      'backend')
+                return
+            print('Compiled {} machines and networks'.format(
+                compile_fragments(config, CONFIG_FILENAME, machines,
+                                  networks)))
+            return
 
-        config = process_config(config, args)
+        if CONFIG_FILENAME.endswith(SQL_EXTENSIONS):
+            store = HookSQLConfig(CONFIG_FILENAME)
+            if args.import_json is not None:
+                with open(args.import_json, 'r') as json_config_file:
+                    store.import_config(
+                        json_config.parse(json_config_file.read()))
+            commands = None
+            if args.batch is not None:
+                with open_batch(args.batch) as batch_file:
+                    commands = list(read_batch(batch_file))
+            names = live_machines(args, commands) if args.apply else set()
+            old_config = store_snapshot(store, names)
+            if commands is not None:
+                start = time.monotonic()
+                count = process_store_batch(store, commands)
+                print_batch_summary(count, start)
+            process_store(store, args)
+            machines, networks = edited_entries(args, commands)
+            if machines is None or args.import_json is not None:
+                compile_fragments(store.export_config(), CONFIG_FILENAME)
+            elif machines or networks:
+                fragment_config = store_snapshot(store, machines)
+                for name in networks:
+                    if store.network(name) is not None:
+                        fragment_config['networks'][name] = store.network(
+                            name)
+                compile_fragments(fragment_config, CONFIG_FILENAME, machines,
+                                  networks)
+            if names:
+                print_applied(hot_apply(names, old_config,
+                                        store_snapshot(store, names)))
+            if args.export_json:
+                print(json_config.build(store.export_config(), True))
+            store.close()
+            return
+
+        commands = None
+        if args.batch is not None:
+            with open_batch(args.batch) as batch_file:
+                commands = list(read_batch(batch_file))
+        names = set()
+        if args.apply and not args.dry_run:
+            names = live_machines(args, commands)
+
+        # The file is read and written under its lock, but not held while
+        # editing. If someone else wrote the file in between, the edit is
+        # done again on the new contents.
+        for attempt in range(WRITE_ATTEMPTS):
+            json_config = HookConfig()
+            config = json_config.read(CONFIG_FILENAME)
+            old_config = machines_snapshot(config, names)
+            start = time.monotonic()
+            if commands is not None:
+                count = process_batch(config, commands)
+            config = process_config(config, args)
+            if args.dry_run:
+                print(json_config.build(config, True))
+                break
+            try:
+                json_config.write(CONFIG_FILENAME, config)
+                break
+            except ConfigChangedError:
+                if attempt == WRITE_ATTEMPTS - 1:
+                    raise
 
-        print(json_config.build(config, True))
+        if commands is not None:
+            print_batch_summary(count, start)
+        if not args.dry_run:
+            compile_fragments(config, CONFIG_FILENAME,
+                              *edited_entries(args, commands))
+        if names:
+            print_applied(hot_apply(names, old_config, config))
     except FileNotFoundError:
         print('No config.json found, terminating.')
     except json.JSONDecodeError as jde:
@@ -256,8 +1235,16 @@ def main():
     except argparse.ArgumentTypeError as ate:
         arg_parser.print_usage()
         print(ate)
-    except ConfigError as ce:
+    except BatchError as be:
+        # Nothing was changed, automation needs to know.
+        print(be)
+        exit(1)
+    except (ConfigError, ConfigChangedError) as ce:
         print(ce)
+    except subprocess.CalledProcessError as cpe:
+        print('Error running {}'.format(' '.join(cpe.cmd)))
+    except sqlite3.Error as se:
+        print('Error updating configuration store: {}'.format(se))
 
 
 if __name__ == '__main__':
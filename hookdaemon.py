@@ -0,0 +1,577 @@
+#!/usr/bin/python3
+
+"""Libvirt port-forwarding hook daemon.
+
+Long running service keeping the parsed configuration and the state of the
+firewall backend in memory. The hook script hands its events to the daemon
+over a UNIX socket, instead of parsing the configuration and probing iptables
+on every call.
+
+0.1.0:
+======
+
+ * Keep the configuration as typed models, with the rules of each machine.
+ * Coalesce events arriving within a short window into one ruleset update.
+ * Keep the ledger of the rules installed for each machine.
+ * Watch the configuration file and apply the rules of the changed machines
+   and networks only.
+
+0.0.1:
+======
+
+ * Initial version
+
+"""
+
+__author__ = "Martin Bo Kristensen Groenholdt <martin.groenholdt@gmail.com>"
+__version__ = "0.1.0"
+
+import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import json
+import os
+import struct
+import subprocess
+import syslog
+import time
+
+import hooks
+from hookjsonconf import HookConfig
+
+# Seconds to wait for more events after the first event of a batch.
+BATCH_WINDOW = float(os.getenv('BATCH_WINDOW') or 0.05)
+# Maximum number of events applied in one batch.
+BATCH_SIZE = int(os.getenv('BATCH_SIZE') or 500)
+# Backends applying a batch of rules in a single transaction.
+TRANSACTION_BACKENDS = ['iptables-restore', 'nft']
+# Seconds between checks of the configuration file without inotify.
+WATCH_INTERVAL = float(os.getenv('WATCH_INTERVAL') or 1.0)
+# inotify events of a file written in place or replaced by a rename.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+def active_networks():
+    """
+    Get the names of the active libvirt networks using virsh.
+
+    :return: Set of names, empty if virsh can not be run.
+    """
+    try:
+        output = subprocess.run(['virsh', 'net-list', '--name'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                check=True).stdout.decode('utf-8')
+    except (OSError, subprocess.CalledProcessError) as exception:
+        syslog.syslog(syslog.LOG_ERR, 'Could not list the active networks: '
+                      '{}'.format(exception))
+        return set()
+    return set(name for name in output.split('\n') if name != '')
+
+
+def merge_config(old_config, config):
+    """
+    Find the machines and networks changed by a new configuration.
+
+    Unchanged machines are taken over from the old configuration, with the
+    rules already built for them, so they cost nothing. If a global value
+    the rules depend on changed, every machine and network has changed.
+
+    :param old_config: Configuration models before the change.
+    :param config: Configuration models after the change, updated in place.
+    :return: Tuple of the sets of changed machine and network names.
+    """
+    if any(old_config.get(key) != config.get(key) for
+           key in hooks.RULE_SETTINGS):
+        return (set(old_config['machines']) | set(config['machines']),
+                set(old_config['networks']) | set(config['networks']))
+
+    machines = set()
+    for name in set(old_config['machines']) | set(config['machines']):
+        old = old_config['machines'].get(name)
+        if old is not None and old == config['machines'].get(name):
+            config['machines'][name] = old
+        else:
+            machines.add(name)
+    networks = set(name for name in
+                   set(old_config['networks']) | set(config['networks']) if
+                   old_config['networks'].get(name) !=
+                   config['networks'].get(name))
+    return machines, networks
+
+
+class Inotify:
+    """
+    inotify watch on a directory, through the C library.
+    """
+
+    def __init__(self, path, mask):
+        """
+        Constructor, adds the watch.
+
+        :raise OSError: If inotify is not available.
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed', path)
+
+    def names(self):
+        """
+        Read the pending events.
+
+        :return: Set of the names of the files the events are about.
+        """
+        names = set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(data):
+            length = struct.unpack_from('iIII', data, offset)[3]
+            offset += struct.calcsize('iIII')
+            names.add(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class HookDaemon:
+    """
+    Apply libvirt hook events received over a UNIX socket.
+    """
+
+    def __init__(self, config_filename):
+        """
+        Constructor
+        """
+        self.config_filename = config_filename
+        self.config = None
+        self.stamp = None
+        self.queue = None
+        # Held while the configuration is loaded or rules are applied.
+        self.lock = None
+        # Whether changes of the configuration are applied, see watch().
+        self.watching = False
+        # Number of batches and events applied since start.
+        self.batches = 0
+        self.events = 0
+
+    def reload(self):
+        """
+        Load the configuration again if the file has changed.
+
+        If the new configuration can not be loaded, the old one is kept.
+
+        :return: The previous configuration if a new one was loaded, None
+                 otherwise.
+        """
+        stat = os.stat(self.config_filename)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        if stamp == self.stamp:
+            return None
+
+        try:
+            json_config = HookConfig()
+            json_config.read(self.config_filename)
+            # Checked once, and the rules of each machine are built once.
+            config = json_config.models()
+        except ValueError as exception:
+            syslog.syslog(syslog.LOG_ERR, 'Error loading configuration '
+                          'file: {}'.format(exception))
+            if self.config is None:
+                raise
+            return None
+
+        previous = self.config
+        self.config = config
+        self.stamp = stamp
+        syslog.syslog('Loaded {}'.format(self.config_filename))
+        return previous
+
+    def change_rules(self, old_config, machines, networks):
+        """
+        Build the commands moving the rules of changed entries to the current
+        configuration.
+
+        Only machines with rules recorded in their ledger, that is running
+        machines, are changed. The old IP range of a changed or removed
+        network is unplugged and the new one plugged if the network is
+        active, see active_networks(). New networks are plugged by libvirt
+        when they start.
+
+        :param old_config: Configuration models before the change.
+        :param machines: Names of the changed machines.
+        :param networks: Names of the changed networks.
+        :return: Dictionary of the commands and the rules installed after
+                 the change (None for networks) by (hook, name).
+        """
+        changes = dict()
+        for name in sorted(machines):
+            installed = hooks.read_ledger(name)
+            if installed is None:
+                continue
+            desired = []
+            if name in self.config['machines']:
+                desired = hooks.machine_rules(
+                    'start', name, self.config['machines'][name], self.config)
+            delta = hooks.rules_delta(installed, desired)
+            if delta:
+                changes[('qemu', name)] = (delta, desired)
+
+        active = active_networks() if networks else set()
+        for name in sorted(networks):
+            if name not in old_config['networks'] or name not in active:
+                continue
+            cmds = hooks.network_rules('unplugged',
+                                       old_config['networks'][name],
+                                       old_config)
+            if name in self.config['networks']:
+                cmds += hooks.network_rules(
+                    'plugged', self.config['networks'][name], self.config)
+            changes[('network', name)] = (cmds, None)
+        return changes
+
+    def apply_changes(self, old_config):
+        """
+        Apply the rules of the machines and networks changed since the old
+        configuration, in one batch.
+
+        The changes are applied together where they can be, see
+        apply_together(), and the ledger of each machine follows its own
+        result.
+
+        :param old_config: Configuration models before the change.
+        :return: Number of changed entries whose rules were applied.
+        """
+        start = time.monotonic()
+        machines, networks = merge_config(old_config, self.config)
+        changes = self.change_rules(old_config, machines, networks)
+
+        results = self.apply_together(
+            {key: cmds for key, (cmds, desired) in changes.items()})
+        for key, (cmds, desired) in changes.items():
+            if not results[key] and desired is not None:
+                results[key] = hooks.retry_present(
+                    cmds, hooks.read_ledger(key[1]),
+                    lambda present: hooks.rules_delta(present, desired),
+                    self.config) is not None
+
+        for (hook, name), success in results.items():
+            desired = changes[(hook, name)][1]
+            if success and desired is not None:
+                hooks.write_ledger(name, desired)
+            elif not success:
+                syslog.syslog(syslog.LOG_ERR, 'Error applying the changed '
+                              'rules of {}'.format(name))
+
+        applied = sum(1 for success in results.values() if success)
+        syslog.syslog('Applied the changes of {} machines and {} networks to '
+                      '{} entries in {:.1f} ms'.format(
+                          len(machines), len(networks), applied,
+                          (time.monotonic() - start) * 1000))
+        return applied
+
+    def apply_together(self, rules):
+        """
+        Apply the commands of several entries, together where they take a
+        single transaction.
+
+        With a transactional backend, the commands of the entries in the
+        same table are applied together, see hooks.transaction_table(). An
+        iptables-restore payload of several tables commits them one by one,
+        so a failed table could leave the ones before it applied. If a
+        transaction fails, or with the iptables backend, the entries are
+        applied one by one so that each of them gets its own result.
+
+        :param rules: Dictionary of the commands of each entry, in order.
+        :return: Dictionary of the result of each entry.
+        """
+        groups = dict()
+        for key, cmds in rules.items():
+            groups.setdefault(hooks.transaction_table(cmds), []).append(key)
+
+        results = dict()
+        for table, keys in groups.items():
+            combined = [cmd for key in keys for cmd in rules[key]]
+            if (table is not None and len(keys) > 1 and
+                    self.config.get('backend') in TRANSACTION_BACKENDS and
+                    hooks.apply_rules(combined, self.config)):
+                results.update(dict.fromkeys(keys, True))
+                continue
+            for key in keys:
+                results[key] = hooks.apply_rules(rules[key], self.config)
+        return results
+
+    def refresh(self):
+        """
+        Load the configuration if it has changed.
+
+        When the configuration is watched, the changes are applied to the
+        running machines and networks, whoever notices the new file first.
+        """
+        old_config = self.reload()
+        if old_config is not None and self.watching:
+            self.apply_changes(old_config)
+
+    def event_rules(self, hook, libvirt_object, action, pending=None):
+        """
+        Build the commands for a single hook event.
+
+        :param hook: Name of the libvirt hook.
+        :param libvirt_object: Name of the libvirt object.
+        :param action: libvirt hook action
+        :param pending: Rules of the machine after the earlier events of the
+                        batch, see hooks.machine_event().
+        :return: Tuple of the commands and the rules installed for a machine
+                 after the event (None for networks), or None if the event
+                 is ignored.
+        """
+        if not hooks.is_handled([hook, libvirt_object, action]):
+            return None
+
+        syslog.syslog('{} {} for {}'.format(action.title(), hook,
+                                            libvirt_object))
+        if hook == 'network':
+            if libvirt_object not in self.config['networks']:
+                return None
+            return hooks.network_rules(
+                action, self.config['networks'][libvirt_object],
+                self.config), None
+
+        return hooks.machine_event(action, libvirt_object, self.config,
+                                   pending)
+
+    def apply_batch(self, events):
+        """
+        Apply a batch of hook events as one ruleset update.
+
+        With a transactional backend the rules of the events in the same
+        table are applied together, see apply_together().
+
+        :param events: List of (hook, libvirt_object, action) tuples.
+        :return: List of replies, in the order of the events.
+        """
+        start = time.monotonic()
+        replies = [None] * len(events)
+        rules = dict()
+        ledgers = dict()
+        # Rules of each machine after the events before it in the batch, so
+        # that events for the same machine build on each other.
+        pending = dict()
+        for index, event in enumerate(events):
+            try:
+                result = self.event_rules(*event, pending.get(event[1]))
+            except Exception as exception:
+                replies[index] = {'status': 'error', 'error': str(exception)}
+                continue
+            if result is None:
+                replies[index] = {'status': 'ignored'}
+                continue
+            rules[index], ledgers[index] = result
+            if ledgers[index] is not None:
+                pending[event[1]] = ledgers[index]
+
+        results = self.apply_together(rules)
+
+        for index, success in results.items():
+            if ledgers[index] is None:
+                continue
+            if success:
+                hooks.write_ledger(events[index][1], ledgers[index])
+            else:
+                hooks.record_present(events[index][1], ledgers[index])
+
+        latency = (time.monotonic() - start) * 1000
+        for index, success in results.items():
+            replies[index] = {'status': 'ok' if success else 'error',
+                              'cmds': [' '.join(cmd) for cmd in rules[index]]}
+            if not success:
+                replies[index]['error'] = 'Error applying the rules.'
+        for reply in replies:
+            reply['batch_size'] = len(events)
+            reply['batch_latency'] = latency
+
+        self.batches += 1
+        self.events += len(events)
+        syslog.syslog('Applied a batch of {} events in {:.1f} ms'.format(
+            len(events), latency))
+        return replies
+
+    def handle_event(self, hook, libvirt_object, action):
+        """
+        Apply a single hook event.
+
+        :param hook: Name of the libvirt hook.
+        :param libvirt_object: Name of the libvirt object.
+        :param action: libvirt hook action
+        :return: The reply to the hook script.
+        """
+        self.refresh()
+        return self.apply_batch([(hook, libvirt_object, action)])[0]
+
+    async def aggregate(self):
+        """
+        Collect events arriving within the batch window and apply them.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + BATCH_WINDOW
+            while len(batch) < BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            events = [event for event, future in batch]
+            try:
+                async with self.lock:
+                    await loop.run_in_executor(None, self.refresh)
+                    replies = await loop.run_in_executor(
+                        None, self.apply_batch, events)
+            except Exception as exception:
+                syslog.syslog(syslog.LOG_ERR, 'Error applying events: '
+                              '{}'.format(exception))
+                replies = [{'status': 'error', 'error': str(exception)}] * \
+                    len(batch)
+            for (event, future), reply in zip(batch, replies):
+                if not future.done():
+                    future.set_result(reply)
+
+    async def watch(self):
+        """
+        Apply the changes of the configuration file as soon as it is written.
+
+        inotify reports writes and renames in the directory of the file,
+        without it the file is checked every WATCH_INTERVAL seconds.
+        """
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        self.watching = True
+        path, filename = os.path.split(os.path.abspath(self.config_filename))
+        try:
+            inotify = Inotify(path, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        except OSError as exception:
+            syslog.syslog(syslog.LOG_WARNING, 'Checking {} every {} s: '
+                          '{}'.format(self.config_filename, WATCH_INTERVAL,
+                                      exception))
+            inotify = None
+        else:
+            def read_events():
+                if filename in inotify.names():
+                    changed.set()
+
+            loop.add_reader(inotify.fd, read_events)
+
+        try:
+            while True:
+                if inotify is not None:
+                    await changed.wait()
+                    # Let the writer finish, a change often comes as
+                    # several events.
+                    await asyncio.sleep(BATCH_WINDOW)
+                    changed.clear()
+                else:
+                    await asyncio.sleep(WATCH_INTERVAL)
+                try:
+                    async with self.lock:
+                        await loop.run_in_executor(None, self.refresh)
+                except Exception as exception:
+                    syslog.syslog(syslog.LOG_ERR, 'Error applying the '
+                                  'configuration: {}'.format(exception))
+        finally:
+            if inotify is not None:
+                loop.remove_reader(inotify.fd)
+                inotify.close()
+
+    async def handle_client(self, reader, writer):
+        """
+        Read one event from a hook script and reply with the result.
+        """
+        try:
+            request = json.loads((await reader.readline()).decode('utf-8'))
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put(((request['hook'], request['object'],
+                                   request['action']), future))
+            reply = await future
+        except Exception as exception:
+            syslog.syslog(syslog.LOG_ERR, 'Error handling event: {}'.format(
+                exception))
+            reply = {'status': 'error', 'error': str(exception)}
+
+        writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, socket_filename, watch=False):
+        """
+        Serve hook events on a UNIX socket until cancelled.
+
+        :param socket_filename: Name of the UNIX socket.
+        :param watch: Apply changes of the configuration file to running
+                      machines, see watch().
+        """
+        self.queue = asyncio.Queue()
+        self.lock = asyncio.Lock()
+        self.reload()
+        tasks = [asyncio.get_running_loop().create_task(self.aggregate())]
+        if watch:
+            tasks.append(asyncio.get_running_loop().create_task(
+                self.watch()))
+
+        os.makedirs(os.path.dirname(socket_filename), exist_ok=True)
+        if os.path.exists(socket_filename):
+            os.remove(socket_filename)
+        server = await asyncio.start_unix_server(self.handle_client,
+                                                 path=socket_filename)
+        # Only root may ask us to change the firewall.
+        os.chmod(socket_filename, 0o600)
+        syslog.syslog('Listening on {}'.format(socket_filename))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if os.path.exists(socket_filename):
+                os.remove(socket_filename)
+
+
+def main():
+    """
+    Main entry point.
+    """
+    parser = argparse.ArgumentParser(description='Libvirt hook daemon.')
+    parser.add_argument('--watch', action='store_true',
+                        help='apply changes of the configuration file to '
+                             'running machines')
+    args = parser.parse_args()
+
+    syslog.openlog(ident='libvirt-hookd [' + str(os.getpid()) + ']:')
+    daemon = HookDaemon(hooks.CONFIG_FILENAME)
+    try:
+        asyncio.run(daemon.serve(hooks.SOCKET_FILENAME, args.watch))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
+    exit(0)
@@ -2,6 +2,17 @@
 
 """Libvirt port-forwarding hook config file parser library.
 
+0.1.0:
+======
+
+ * Typed machine, port mapping and network models, see hookmodel.
+ * Atomic writes under an advisory lock, refused if the file changed since
+   it was read.
+ * Compiled, indexed cache of the configuration for single entry lookups.
+ * Load the configuration from an SQLite store, see hooksqlconf.
+ * Read a whole configuration file or store.
+ * Port ranges in port mappings.
+
 0.0.1:
 ======
 
@@ -10,9 +21,70 @@
 """
 
 __author__ = "Martin Bo Kristensen Groenholdt <martin.groenholdt@gmail.com>"
-__version__ = "0.0.1"
+__version__ = "0.1.0"
 
+import contextlib
+import fcntl
+import hashlib
 import json
+import marshal
+import os
+import struct
+import tempfile
+import time
+
+# Identifies a compiled configuration cache, and its format version.
+CACHE_MAGIC = b'LVHCONF1'
+# Header of the compiled cache: magic, size, modification time and SHA1 of
+# the JSON file, followed by the offset and length of the index.
+CACHE_HEADER = struct.Struct('<8sQq20sQQ')
+# File name extensions of SQLite configuration stores.
+SQL_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+
+class ConfigChangedError(Exception):
+    """
+    The configuration file was changed by someone else since it was read.
+    """
+    pass
+
+
+@contextlib.contextmanager
+def locked(filename, exclusive=False):
+    """
+    Context manager holding the advisory lock of a configuration file.
+
+    Writers hold the lock exclusively, readers shared. The lock is taken on a
+    separate file, since the configuration file is replaced when written.
+
+    :param filename: Name of the configuration file.
+    :param exclusive: Take the lock for writing.
+    """
+    try:
+        lock_file = open(filename + '.lock', 'a')
+    except OSError:
+        if exclusive:
+            raise
+        # The file is replaced atomically, so readers that can not create
+        # the lock still never see a partial file.
+        lock_file = None
+    if lock_file is None:
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def port_range(port):
+    """
+    Parse the port or port range of a mapping.
+
+    :param port: Port number, or port range as "first-last".
+    :return: Tuple of the first and last port.
+    """
+    first, _, last = str(port).partition('-')
+    return int(first), int(last or first)
 
 
 class HookConfig:
@@ -24,6 +96,10 @@ class HookConfig:
         """
         Constructor
         """
+        # Size, modification time and SHA1 of the file last read or written.
+        self.version = None
+        # Time spent parsing JSON, in milliseconds.
+        self.parse_ms = 0.0
         if config is not None:
             self.parse(config)
         else:
@@ -33,9 +109,266 @@ class HookConfig:
         """
         Parse a JSON string as configuration data
         """
+        start = time.monotonic()
         self.config = json.loads(config)
+        self.parse_ms += (time.monotonic() - start) * 1000
+        return self.config
+
+    def read(self, filename):
+        """
+        Read all the configuration data from a file.
+
+        :param filename: Name of the JSON file or SQLite store.
+        :return: The configuration data.
+        """
+        if filename.endswith(SQL_EXTENSIONS):
+            os.stat(filename)
+            from hooksqlconf import HookSQLConfig
+            store = HookSQLConfig(filename)
+            try:
+                self.config = store.export_config()
+            finally:
+                store.close()
+            return self.config
+
+        with locked(filename):
+            stat = os.stat(filename)
+            with open(filename, 'rb') as json_file:
+                data = json_file.read()
+        self.version = (stat.st_size, stat.st_mtime_ns,
+                        hashlib.sha1(data).digest())
+        return self.parse(data.decode('utf-8'))
+
+    def changed(self, filename):
+        """
+        Check if a file changed since it was read or written by this object.
+
+        A file that was only touched is not changed.
+        """
+        if self.version is None:
+            return False
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return True
+        size, mtime, digest = self.version
+        if stat.st_size == size and stat.st_mtime_ns == mtime:
+            return False
+        with open(filename, 'rb') as json_file:
+            return hashlib.sha1(json_file.read()).digest() != digest
+
+    def write(self, filename, config=None):
+        """
+        Write configuration data to a JSON file, atomically.
+
+        The data is written to a temporary file, which is synced to disk and
+        renamed over the file under the exclusive lock, so readers see
+        either the old or the new file. If the file was read by this object,
+        and changed since, nothing is written.
+
+        :param filename: Name of the JSON configuration file.
+        :param config: Configuration data, the data last read if None.
+        :raise ConfigChangedError: If the file changed since it was read.
+        """
+        if config is None:
+            config = self.config
+        data = self.build(config, True).encode('utf-8')
+        directory = os.path.dirname(os.path.abspath(filename))
+        with locked(filename, exclusive=True):
+            if self.changed(filename):
+                raise ConfigChangedError('{} was changed while editing '
+                                         'it'.format(filename))
+            fd, tmp_filename = tempfile.mkstemp(
+                prefix=os.path.basename(filename) + '.', dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as json_file:
+                    json_file.write(data)
+                    json_file.flush()
+                    os.fsync(json_file.fileno())
+                if os.path.exists(filename):
+                    os.chmod(tmp_filename, os.stat(filename).st_mode & 0o7777)
+                os.replace(tmp_filename, filename)
+            except BaseException:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+                raise
+            # Make the rename itself durable.
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            stat = os.stat(filename)
+        self.config = config
+        self.version = (stat.st_size, stat.st_mtime_ns,
+                        hashlib.sha1(data).digest())
+
+    def load(self, filename, machine=None, network=None):
+        """
+        Load the configuration needed for a single machine or network.
+
+        The entries are read from a compiled cache next to the JSON file,
+        which is rebuilt when the JSON file changes. Only the global values
+        and the requested entries are decoded. If the cache is unusable the
+        JSON file is parsed instead.
+
+        Files with an SQLite extension are loaded from an SQLite store.
+
+        :param filename: Name of the JSON configuration file.
+        :param machine: Name of the machine to load.
+        :param network: Name of the network to load.
+        :return: The configuration data.
+        """
+        if filename.endswith(SQL_EXTENSIONS):
+            os.stat(filename)
+            # Only pay for the sqlite3 import when the store is used.
+            from hooksqlconf import HookSQLConfig
+            store = HookSQLConfig(filename)
+            try:
+                self.config = store.load(machine, network)
+            finally:
+                store.close()
+            return self.config
+
+        with locked(filename):
+            return self.load_json(filename, machine, network)
+
+    def load_json(self, filename, machine=None, network=None):
+        """
+        Load a machine or network from a JSON file or its compiled cache.
+        """
+        stat = os.stat(filename)
+        cache_filename = filename + '.cache'
+        try:
+            with open(cache_filename, 'rb') as cache_file:
+                header = CACHE_HEADER.unpack(
+                    cache_file.read(CACHE_HEADER.size))
+                magic, size, mtime, digest, index_offset, index_length = \
+                    header
+                if magic != CACHE_MAGIC:
+                    raise ValueError('Not a configuration cache')
+
+                if size != stat.st_size or mtime != stat.st_mtime_ns:
+                    # The file was touched or changed, only rebuild if the
+                    # contents changed.
+                    with open(filename, 'rb') as json_file:
+                        data = json_file.read()
+                    if hashlib.sha1(data).digest() != digest:
+                        return self.compile(filename, data, machine, network)
+                    self.stamp(cache_filename, header, stat)
+
+                cache_file.seek(index_offset)
+                index = marshal.loads(cache_file.read(index_length))
+
+                self.config = self.read_record(cache_file, index[('', '')])
+                for kind, key, name in [('m', 'machines', machine),
+                                        ('n', 'networks', network)]:
+                    if (kind, name) in index:
+                        self.config[key][name] = self.read_record(
+                            cache_file, index[(kind, name)])
+                return self.config
+        except (OSError, EOFError, ValueError, TypeError, KeyError,
+                struct.error):
+            pass
+
+        with open(filename, 'rb') as json_file:
+            data = json_file.read()
+        return self.compile(filename, data, machine, network)
+
+    def read_record(self, cache_file, position):
+        """
+        Read a single record from a compiled cache.
+        """
+        cache_file.seek(position[0])
+        return marshal.loads(cache_file.read(position[1]))
+
+    def stamp(self, cache_filename, header, stat):
+        """
+        Update the size and modification time in a compiled cache header.
+        """
+        magic, size, mtime, digest, index_offset, index_length = header
+        try:
+            with open(cache_filename, 'r+b') as cache_file:
+                cache_file.write(CACHE_HEADER.pack(
+                    magic, stat.st_size, stat.st_mtime_ns, digest,
+                    index_offset, index_length))
+        except OSError:
+            pass
+
+    def compile(self, filename, data=None, machine=None, network=None):
+        """
+        Compile a JSON configuration file into an indexed cache.
+
+        Each machine and network is a separate record in the cache, so that
+        it can be loaded without decoding the rest of the configuration.
+
+        :param filename: Name of the JSON configuration file.
+        :param data: Contents of the file, read from the file if None.
+        :param machine: Name of the machine to return.
+        :param network: Name of the network to return.
+        :return: The configuration data for the machine and network.
+        """
+        stat = os.stat(filename)
+        if data is None:
+            with open(filename, 'rb') as json_file:
+                data = json_file.read()
+        config = self.parse(data.decode('utf-8'))
+
+        records = []
+        index = dict()
+        offset = CACHE_HEADER.size
+
+        def add_record(key, value):
+            nonlocal offset
+            record = marshal.dumps(value)
+            index[key] = (offset, len(record))
+            records.append(record)
+            offset += len(record)
+
+        add_record(('', ''), dict(config, machines={}, networks={}))
+        for name, value in config.get('machines', {}).items():
+            add_record(('m', name), value)
+        for name, value in config.get('networks', {}).items():
+            add_record(('n', name), value)
+
+        index_data = marshal.dumps(index)
+        header = CACHE_HEADER.pack(CACHE_MAGIC, stat.st_size,
+                                   stat.st_mtime_ns,
+                                   hashlib.sha1(data).digest(), offset,
+                                   len(index_data))
+        cache_filename = filename + '.cache'
+        tmp_filename = '{}.{}'.format(cache_filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as cache_file:
+                cache_file.write(header)
+                cache_file.writelines(records)
+                cache_file.write(index_data)
+            os.replace(tmp_filename, cache_filename)
+        except OSError:
+            # The cache is an optimisation, carry on without it.
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+        self.config = dict(config, machines={}, networks={})
+        if machine in config.get('machines', {}):
+            self.config['machines'][machine] = config['machines'][machine]
+        if network in config.get('networks', {}):
+            self.config['networks'][network] = config['networks'][network]
         return self.config
 
+    def models(self, config=None):
+        """
+        Get configuration data with Machine and Network objects, see
+        hookmodel.
+
+        :param config: Configuration data, the data last read if None.
+        :raise ValueError: If an entry is invalid.
+        """
+        from hookmodel import build_models
+        if config is None:
+            config = self.config
+        return build_models(config)
+
     def build(self, config, pretty=False):
         """
         Encode configuration data as a JSON string
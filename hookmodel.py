@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+"""Libvirt port-forwarding hook configuration model.
+
+Compact, validated objects for the machines, port mappings and networks of
+the configuration. Ports are integers and addresses ipaddress objects, and
+the DNAT rules of a machine are kept with it once built.
+
+0.0.1:
+======
+
+ * Initial version
+ * Compare machines and networks.
+
+"""
+
+__author__ = "Martin Bo Kristensen Groenholdt <martin.groenholdt@gmail.com>"
+__version__ = "0.0.1"
+
+import ipaddress
+
+from hookjsonconf import port_range
+
+
+def check_port_range(port):
+    """
+    Parse and check the port or port range of a mapping.
+
+    :param port: Port number, or port range as "first-last".
+    :return: Tuple of the first and last port.
+    :raise ValueError: If the port or range is invalid.
+    """
+    if isinstance(port, bool) or not isinstance(port, (int, str)):
+        raise ValueError('Invalid port {!r}'.format(port))
+    first, last = port_range(port)
+    if first < 0 or last > 65535 or first > last:
+        raise ValueError('Invalid port {!r}'.format(port))
+    return first, last
+
+
+class PortMapping:
+    """
+    Mapping of a public port or port range to the ports of a machine.
+
+    Iterates as the public and machine port of the configuration file, a
+    number for a single port and "first-last" for a range.
+    """
+    __slots__ = ('public_first', 'public_last', 'private_first',
+                 'private_last')
+
+    def __init__(self, public_port, private_port):
+        """
+        Constructor, checks the ports.
+
+        :raise ValueError: If a port is invalid or the ranges differ in size.
+        """
+        self.public_first, self.public_last = check_port_range(public_port)
+        self.private_first, self.private_last = check_port_range(
+            private_port)
+        if (self.public_last - self.public_first !=
+                self.private_last - self.private_first):
+            raise ValueError('Port ranges {} and {} differ in size'.format(
+                public_port, private_port))
+
+    @property
+    def public_port(self):
+        if self.public_first == self.public_last:
+            return self.public_first
+        return '{}-{}'.format(self.public_first, self.public_last)
+
+    @property
+    def private_port(self):
+        if self.private_first == self.private_last:
+            return self.private_first
+        return '{}-{}'.format(self.private_first, self.private_last)
+
+    def __iter__(self):
+        yield self.public_port
+        yield self.private_port
+
+    def __eq__(self, other):
+        if isinstance(other, PortMapping):
+            return (self.public_first, self.public_last, self.private_first,
+                    self.private_last) == \
+                (other.public_first, other.public_last, other.private_first,
+                 other.private_last)
+        return NotImplemented
+
+    def __repr__(self):
+        return 'PortMapping({!r}, {!r})'.format(self.public_port,
+                                                self.private_port)
+
+
+class Machine:
+    """
+    Configuration of a machine.
+
+    Supports item access to "private_ip" and "port_map", as in the
+    configuration data, so that the rule builders of the hook take either.
+    """
+    __slots__ = ('name', 'private_ip', 'port_map', 'templates')
+
+    def __init__(self, name, private_ip, port_map):
+        """
+        Constructor, checks the address and the port mappings.
+
+        :param name: Name of the machine.
+        :param private_ip: IP address of the machine.
+        :param port_map: List of (public port, machine port) pairs.
+        :raise ValueError: If an address or port is invalid.
+        """
+        self.name = name
+        self.private_ip = ipaddress.ip_address(private_ip)
+        self.port_map = tuple(PortMapping(*mapping) for mapping in port_map)
+        # DNAT rules built for the machine, see hooks.dnat_rules().
+        self.templates = dict()
+
+    @classmethod
+    def from_config(cls, name, value):
+        """
+        Build a machine from its entry in the configuration data.
+
+        :raise ValueError: If the entry is invalid.
+        """
+        try:
+            return cls(name, value['private_ip'], value['port_map'])
+        except (KeyError, TypeError, ValueError) as exception:
+            raise ValueError('Invalid machine {}: {}'.format(name, exception))
+
+    def to_config(self):
+        """
+        Get the entry of the machine in the configuration data.
+        """
+        return {'private_ip': str(self.private_ip),
+                'port_map': [list(mapping) for mapping in self.port_map]}
+
+    def __getitem__(self, key):
+        if key == 'private_ip':
+            return str(self.private_ip)
+        if key == 'port_map':
+            return self.port_map
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if isinstance(other, Machine):
+            return (self.name, self.private_ip, self.port_map) == \
+                (other.name, other.private_ip, other.port_map)
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Machine({!r}, {!r}, {!r})'.format(
+            self.name, str(self.private_ip),
+            [list(mapping) for mapping in self.port_map])
+
+
+class Network:
+    """
+    IP range of a network, converts to its string form for the rules.
+    """
+    __slots__ = ('name', 'network')
+
+    def __init__(self, name, network):
+        """
+        Constructor, checks the IP range. Host bits are allowed, as in the
+        address of a bridge with its prefix, and are cleared.
+
+        :raise ValueError: If the IP range is invalid.
+        """
+        self.name = name
+        try:
+            self.network = ipaddress.ip_network(network, strict=False)
+        except (TypeError, ValueError) as exception:
+            raise ValueError('Invalid network {}: {}'.format(name, exception))
+
+    def __str__(self):
+        return str(self.network)
+
+    def __eq__(self, other):
+        if isinstance(other, Network):
+            return (self.name, self.network) == (other.name, other.network)
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Network({!r}, {!r})'.format(self.name, str(self.network))
+
+
+def build_models(config):
+    """
+    Replace the machines and networks of configuration data by models.
+
+    :param config: Configuration data, as read from the configuration file.
+    :return: New configuration data with Machine and Network objects.
+    :raise ValueError: If an entry is invalid.
+    """
+    models = dict(config)
+    models['machines'] = {name: Machine.from_config(name, value) for
+                          name, value in config.get('machines', {}).items()}
+    models['networks'] = {name: Network(name, value) for
+                          name, value in config.get('networks', {}).items()}
+    return models
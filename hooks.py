@@ -8,6 +8,40 @@ networking on a host with a single public IP address.
 Original version by "Sascha Peilicke <saschpe@gmx.de>" adapted for my use-case.
 
 
+0.4.0:
+======
+
+ * Batched iptables-restore backend applying each hook event atomically.
+ * Fix rules not being removed on the stopped action.
+ * Optional dedicated NAT chain per machine for constant time tear down.
+ * nftables backend using map lookups for DNAT.
+ * Optional ipset for FORWARD acceptance of networks.
+ * Leave before any import or sub-process on hook actions that are not
+   handled, and report the start-up time.
+ * Do not fork to find iptables, cache its probed capabilities on disk.
+ * Load the configuration through the compiled configuration cache.
+ * Hand events to the hook daemon when it is running.
+ * Compare desired and installed rules, for reconciling after a firewall
+   reload.
+ * Record the rules installed for each machine, remove them as recorded and
+   only apply the difference on reconnect.
+ * Port ranges in port mappings, forwarded by a single rule.
+ * Optional multiport rules for mappings to the same port on the machine.
+ * Work on typed machine and network models, keeping the DNAT rules of a
+   machine with it.
+ * Log the time spent in each phase of a run as one JSON record, and
+   optionally profile runs.
+ * Log one summary record per event, with the rules only at debug level,
+   and a configurable log level.
+ * Generate the rules of the whole configuration without side effects.
+ * Apply rules under a host wide lock, wait for the xtables lock and run
+   commands failing on it again, reporting the time waited.
+ * Stream the rules of an event from its compiled fragment when it is
+   current.
+ * Accept forwarded traffic with iptables rules with the nftables backend
+   too, as an nftables accept does not override the libvirt FORWARD rules.
+
+
 0.3.1:
 ======
 
@@ -38,15 +72,49 @@ Original version by "Sascha Peilicke <saschpe@gmx.de>" adapted for my use-case.
 """
 
 __author__ = "Martin Bo Kristensen Groenholdt <martin.groenholdt@gmail.com>"
-__version__ = "0.3.0"
+__version__ = "0.4.0"
 
-import json
 import os
-import subprocess
 import sys
+import time
+
+# Time at which the hook started, used to report the start-up time.
+STARTUP_TIME = time.monotonic()
+# libvirt hooks handled by this script.
+HOOKS = ['qemu', 'lxc', 'network']
+# libvirt hook actions handled by this script.
+ACTIONS = ['unplugged', 'plugged', 'stopped', 'start', 'reconnect']
+
+
+def is_handled(argv):
+    """
+    Check whether the hook and action libvirt called us with are handled.
+
+    :param argv: The command line, as passed by libvirt.
+    :return: True if the hook and action are handled.
+    """
+    return (len(argv) >= 3 and os.path.basename(argv[0]) in HOOKS and
+            argv[2] in ACTIONS)
+
+
+# libvirt calls the hook for every phase of the life cycle of an object, most
+# of which we ignore. Leave before any other import, configuration read or
+# sub-process.
+if __name__ == '__main__' and not is_handled(sys.argv):
+    sys.exit(0)
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import re
+import shutil
+import socket
+import subprocess
 import syslog
+import urllib.parse
 
-from hookjsonconf import HookConfig
+from hookjsonconf import HookConfig, port_range
 
 # Path to the forwarding configuration file
 CONFIG_PATH = os.getenv('CONFIG_PATH') or os.path.dirname(
@@ -55,67 +123,787 @@ CONFIG_PATH = os.getenv('CONFIG_PATH') or os.path.dirname(
 CONFIG_FILENAME = os.getenv('CONFIG_FILENAME') or os.path.join(CONFIG_PATH,
                                                                'config.json')
 # Path of the iptables binary
-IPTABLES_BINARY = os.getenv('IPTABLES_BINARY') or subprocess.check_output(
-    ['which', 'iptables']).strip().decode('ascii')
+IPTABLES_BINARY = os.getenv('IPTABLES_BINARY') or shutil.which(
+    'iptables') or 'iptables'
+# Path of the iptables-restore binary, used by the batched backend.
+IPTABLES_RESTORE_BINARY = os.getenv(
+    'IPTABLES_RESTORE_BINARY') or IPTABLES_BINARY + '-restore'
+# Path of the iptables-save binary, used to reconcile the installed rules.
+IPTABLES_SAVE_BINARY = os.getenv(
+    'IPTABLES_SAVE_BINARY') or IPTABLES_BINARY + '-save'
+# Path of the directory holding run time state of the hook.
+RUN_PATH = os.getenv('RUN_PATH') or '/run/libvirt-hook'
+# Name of the file caching the probed iptables capabilities.
+CAPABILITIES_FILENAME = os.path.join(RUN_PATH, 'iptables.json')
+# Name of the UNIX socket of the hook daemon.
+SOCKET_FILENAME = os.getenv('SOCKET_FILENAME') or os.path.join(RUN_PATH,
+                                                               'hookd.sock')
+# Path of the directory holding the rules installed for each machine.
+LEDGER_PATH = os.path.join(RUN_PATH, 'ledger')
+# Seconds to wait for the hook daemon to apply an event.
+DAEMON_TIMEOUT = float(os.getenv('DAEMON_TIMEOUT') or 30)
+# Start-up time above which a warning is logged, in milliseconds.
+STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET') or 100)
+# File to append a JSON record with the timings of every hook run to.
+TIMINGS_FILENAME = os.getenv('TIMINGS_FILENAME')
+# Directory to write a cProfile dump of every hook run to.
+PROFILE_PATH = os.getenv('PROFILE_PATH')
+# Syslog priorities by name, for the log level.
+LOG_LEVELS = {'debug': syslog.LOG_DEBUG, 'info': syslog.LOG_INFO,
+              'notice': syslog.LOG_NOTICE, 'warning': syslog.LOG_WARNING,
+              'err': syslog.LOG_ERR}
+# Name of the least important priority logged, "debug" in the configuration
+# or "log_level" take precedence.
+LOG_LEVEL = os.getenv('LOG_LEVEL') or 'info'
+# Details of the current hook event, logged with its summary.
+EVENT_LOG = list()
+# Time spent in each phase of the hook run, in milliseconds.
+PHASES = dict()
+# Counters of the hook run, such as the number of rules and forks.
+COUNTS = dict()
+# Name of the lock serialising the rule application of all hook runs.
+APPLY_LOCK_FILENAME = os.path.join(RUN_PATH, 'apply.lock')
+# Seconds to wait for the rule application lock before going ahead anyway.
+LOCK_TIMEOUT = float(os.getenv('LOCK_TIMEOUT') or 10)
+# Seconds iptables waits for the xtables lock.
+XTABLES_WAIT = int(os.getenv('XTABLES_WAIT') or 5)
+# Number of times a command failing on the xtables lock is run again.
+LOCK_RETRIES = int(os.getenv('LOCK_RETRIES') or 3)
+# Exit status of iptables when another process holds the xtables lock.
+XTABLES_LOCK_STATUS = 4
+# Global values changing the rules of every machine and network.
+RULE_SETTINGS = ['public_ip', 'backend', 'machine_chains', 'multiport',
+                 'network_ipset']
+# Format version of the compiled rule fragments, part of their key.
+FRAGMENT_VERSION = 1
+# Capabilities of the iptables binary, see iptables_capabilities().
+CAPABILITIES = dict()
+# Prefix of the dedicated per machine NAT chains.
+CHAIN_PREFIX = 'LVH-'
+# Maximum length of an iptables chain name.
+CHAIN_MAX_LENGTH = 28
+# Maximum number of ports in a multiport match.
+MULTIPORT_SIZE = 15
+# Libvirt object names that can be used as is in a chain name.
+CHAIN_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+# Path of the ipset binary, used for the network set.
+IPSET_BINARY = os.getenv('IPSET_BINARY') or 'ipset'
+# Name of the ipset holding the IP ranges of the networks.
+IPSET_NAME = 'libvirt-hook-nets'
+# Path of the nft binary, used by the nftables backend.
+NFT_BINARY = os.getenv('NFT_BINARY') or 'nft'
+# Name of the nftables table holding the forwarding maps.
+NFT_TABLE = 'libvirt_hook'
+# Statements creating the nftables table, maps and chains. These are applied
+# with every nftables batch and leave existing map elements untouched.
+# Forwarded traffic is accepted by iptables rules, as an accept in this table
+# does not stop the FORWARD rules of libvirt from rejecting the packet. The
+# forward chain of older versions is emptied.
+NFT_BOOTSTRAP = [
+    'add table ip {0}',
+    'add map ip {0} dnat {{ type ipv4_addr . inet_proto . inet_service : '
+    'ipv4_addr . inet_service; }}',
+    'add chain ip {0} prerouting {{ type nat hook prerouting priority -100; '
+    'policy accept; }}',
+    'flush chain ip {0} prerouting',
+    'add rule ip {0} prerouting dnat ip addr . port to '
+    'ip daddr . meta l4proto . th dport map @dnat',
+    'add chain ip {0} forward {{ type filter hook forward priority 0; '
+    'policy accept; }}',
+    'flush chain ip {0} forward'
+]
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Context manager adding the time spent in the enclosed block to a phase of
+    the hook run, see PHASES.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        PHASES[name] = PHASES.get(name, 0.0) + \
+            (time.monotonic() - start) * 1000
+
+
+def count(name, value=1):
+    """
+    Add to a counter of the hook run, see COUNTS.
+    """
+    COUNTS[name] = COUNTS.get(name, 0) + value
+
+
+def log_level(config):
+    """
+    Get the least important syslog priority that is logged.
+
+    :param config: Configuration values from the configuration file.
+    """
+    if config.get('debug', False):
+        return syslog.LOG_DEBUG
+    return LOG_LEVELS.get(config.get('log_level', LOG_LEVEL),
+                          syslog.LOG_INFO)
+
+
+def log_detail(message):
+    """
+    Add a line to the details of the current hook event, see log_summary().
+    """
+    EVENT_LOG.append(message)
+
+
+def log_summary(summary, cmds, config, priority=syslog.LOG_INFO):
+    """
+    Log a hook event as a single record.
+
+    The record holds the summary and the buffered details of the event, and
+    at debug level the full list of commands.
+
+    :param summary: One line description of the event.
+    :param cmds: List of the argument lists applied for the event.
+    :param config: Configuration values from the configuration file.
+    :param priority: Syslog priority of the record.
+    """
+    level = log_level(config)
+    if priority <= level:
+        lines = [summary] + EVENT_LOG
+        if level >= syslog.LOG_DEBUG:
+            lines += [' '.join(cmd) for cmd in cmds]
+        syslog.syslog(priority, '\n'.join(lines))
+    del EVENT_LOG[:]
+
+
+def report_timings(hook, libvirt_object, action):
+    """
+    Log the timings and counters of the hook run as one JSON record.
+
+    The record is appended to TIMINGS_FILENAME if set, and goes to syslog at
+    debug level.
+    """
+    record = {'time': time.time(), 'pid': os.getpid(), 'hook': hook,
+              'object': libvirt_object, 'action': action,
+              'phases': {name: round(value, 3) for name, value in
+                         PHASES.items()},
+              'counts': COUNTS}
+    line = json.dumps(record, sort_keys=True)
+    syslog.syslog(syslog.LOG_DEBUG, 'Timings ' + line)
+    if TIMINGS_FILENAME:
+        try:
+            with open(TIMINGS_FILENAME, 'a') as timings_file:
+                timings_file.write(line + '\n')
+        except OSError as exception:
+            syslog.syslog(syslog.LOG_WARNING, 'Could not write the timings: '
+                          '{}'.format(exception))
+
+
+def probe_iptables(binary):
+    """
+    Probe the variant of iptables and the options it supports.
+
+    :param binary: Path of the iptables binary.
+    :return: Dictionary with the capabilities of the binary.
+    """
+    version = subprocess.run([binary, '--version'], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT).stdout.decode('ascii')
+    match = re.search(r'v(\d+)\.(\d+)\.(\d+)', version)
+    numbers = (0, 0, 0)
+    if match:
+        numbers = tuple(int(number) for number in match.groups())
+    restore_help = subprocess.run([IPTABLES_RESTORE_BINARY, '--help'],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT).stdout
+    return {
+        'binary': os.path.realpath(binary),
+        'variant': 'nft' if 'nf_tables' in version else 'legacy',
+        'version': '.'.join(str(number) for number in numbers),
+        # -w appeared in iptables 1.4.20, with a timeout in 1.6.0, and in
+        # iptables-restore in 1.6.2.
+        'wait': numbers >= (1, 4, 20),
+        'wait_seconds': numbers >= (1, 6, 0),
+        'restore_wait': numbers >= (1, 6, 2),
+        'noflush': b'--noflush' in restore_help
+    }
+
+
+def iptables_capabilities():
+    """
+    Get the capabilities of the iptables binary.
+
+    Probing forks iptables, so the result is cached on disk and only probed
+    again when the binary changes.
+
+    :return: Dictionary with the capabilities of the binary.
+    """
+    if CAPABILITIES:
+        return CAPABILITIES
+
+    stat = os.stat(IPTABLES_BINARY)
+    stamp = [os.path.realpath(IPTABLES_BINARY), stat.st_size,
+             stat.st_mtime_ns]
+    try:
+        with open(CAPABILITIES_FILENAME, 'r') as cache_file:
+            cached = json.load(cache_file)
+        # Caches of older versions lack the newer capabilities.
+        if cached.get('stamp') == stamp and 'restore_wait' in cached:
+            CAPABILITIES.update(cached)
+            return CAPABILITIES
+    except (OSError, ValueError):
+        pass
+
+    CAPABILITIES.update(probe_iptables(IPTABLES_BINARY), stamp=stamp)
+    try:
+        os.makedirs(RUN_PATH, exist_ok=True)
+        tmp_filename = '{}.{}'.format(CAPABILITIES_FILENAME, os.getpid())
+        with open(tmp_filename, 'w') as cache_file:
+            json.dump(CAPABILITIES, cache_file)
+        os.replace(tmp_filename, CAPABILITIES_FILENAME)
+    except OSError:
+        syslog.syslog(syslog.LOG_WARNING, 'Could not cache the capabilities '
+                      'of {}'.format(IPTABLES_BINARY))
+    return CAPABILITIES
+
+
+@contextlib.contextmanager
+def apply_lock():
+    """
+    Context manager holding the host wide lock of the rule application.
+
+    Hook runs and the hook daemon apply their rules one at a time. The lock
+    is polled with a growing delay for up to LOCK_TIMEOUT seconds, after
+    which the rules are applied anyway, as a machine without forwarding is
+    worse than a race. The time waited is added to the lock_wait phase.
+    """
+    start = time.monotonic()
+    try:
+        os.makedirs(os.path.dirname(APPLY_LOCK_FILENAME), exist_ok=True)
+        lock_file = open(APPLY_LOCK_FILENAME, 'a')
+    except OSError as exception:
+        syslog.syslog(syslog.LOG_WARNING, 'Could not open the lock {}: '
+                      '{}'.format(APPLY_LOCK_FILENAME, exception))
+        lock_file = None
+
+    if lock_file is not None:
+        delay = 0.005
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() - start >= LOCK_TIMEOUT:
+                    syslog.syslog(syslog.LOG_WARNING, 'Waited {:.1f} s for '
+                                  'the lock {}, going ahead without '
+                                  'it'.format(LOCK_TIMEOUT,
+                                              APPLY_LOCK_FILENAME))
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+    PHASES['lock_wait'] = PHASES.get('lock_wait', 0.0) + \
+        (time.monotonic() - start) * 1000
+
+    try:
+        yield
+    finally:
+        if lock_file is not None:
+            lock_file.close()
+
+
+def wait_args(binary):
+    """
+    Get the arguments making an iptables binary wait for the xtables lock.
+
+    :param binary: Path of iptables or iptables-restore.
+    :return: List of arguments, empty if the binary can not wait.
+    """
+    if binary not in [IPTABLES_BINARY, IPTABLES_RESTORE_BINARY]:
+        return []
+    try:
+        capabilities = iptables_capabilities()
+    except OSError:
+        return []
+    if binary == IPTABLES_BINARY and capabilities.get('wait_seconds'):
+        return ['-w', str(XTABLES_WAIT)]
+    if binary == IPTABLES_RESTORE_BINARY and capabilities.get('restore_wait'):
+        return ['-w', str(XTABLES_WAIT)]
+    return []
+
+
+def execute(args, payload=None):
+    """
+    Run a firewall binary, running it again if the xtables lock was held.
+
+    iptables waits for the xtables lock for XTABLES_WAIT seconds, if it
+    supports -w. A command that still fails on the lock is run again up to
+    LOCK_RETRIES times with a growing delay, counted as lock_wait.
+
+    :param args: A list of arguments, including the binary.
+    :param payload: Text written to the standard input of the binary.
+    :return: Tuple of the exit status and the output of the binary.
+    """
+    args = args[:1] + wait_args(args[0]) + args[1:]
+    stdin = subprocess.PIPE if payload is not None else None
+    if payload is not None:
+        payload = payload.encode('ascii')
+    delay = 0.1
+    for attempt in range(LOCK_RETRIES + 1):
+        with phase('exec'):
+            process = subprocess.Popen(args, stdin=stdin,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            output = process.communicate(payload)[0].decode('ascii',
+                                                            'replace')
+        count('forks')
+        if (process.returncode != XTABLES_LOCK_STATUS or
+                'xtables lock' not in output or attempt == LOCK_RETRIES):
+            break
+        count('lock_retries')
+        with phase('lock_wait'):
+            time.sleep(delay)
+        delay *= 2
+    return process.returncode, output
 
 
 def logged_call(args, config):
     """
-    Log command and stdout from external call.
+    Log command and output from external call.
 
     :param args: A list of arguments used in the sub-process call.
     :param config: Configuration values from the configuration file.
+    :return: True if the command succeeded.
     """
 
-    # Log the actual command on debug.
-    if config['debug']:
-        syslog.syslog(syslog.LOG_DEBUG, ' '.join(args))
-
-    # Call the command and pipe stdout to a place where we can use it.
-    ret = subprocess.Popen(args, stdout=subprocess.PIPE)
-    # Get stdout.
-    # TODO Should be logging and checking stderr.
-    ret = ret.communicate()[0].decode('ascii')
+    # The commands are logged with the summary of the event, at debug level.
+    returncode, ret = execute(args)
     # Log it as an alert if there is any output.
     if ret != '':
         syslog.syslog(syslog.LOG_ALERT, ret)
+    return returncode == 0
 
 
-def ctrl_network(action, libvirt_object, config):
+def rule_exists(cmd):
     """
-    Set up/tear down the forwarding of incoming connections.
+    Check whether the rule of an iptables insert or append command exists.
+
+    :param cmd: An iptables argument list, including the binary.
+    :return: True if the rule is installed.
+    """
+    check = [arg if arg not in ['-I', '-A'] else '-C' for arg in cmd]
+    check[1:1] = wait_args(check[0])
+    return subprocess.call(check, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL) == 0
+
+
+def restore_line(cmd):
+    """
+    Render an iptables command as a line of an iptables-restore payload.
+
+    :param cmd: An iptables argument list, including the binary.
+    :return: Tuple of the table and the line.
+    """
+    args = list(cmd[1:])
+    table = 'filter'
+    if '-t' in args:
+        index = args.index('-t')
+        table = args[index + 1]
+        del args[index:index + 2]
+    if args[0] == '-N':
+        # Declaring the chain creates it, or flushes it if it exists.
+        return table, ':{} - [0:0]'.format(args[1])
+    return table, ' '.join(args)
+
+
+def restore_payload(cmds):
+    """
+    Render iptables commands as an iptables-restore payload.
+
+    The commands are grouped by table, keeping their relative order, and each
+    table is terminated by a COMMIT line.
+
+    :param cmds: A list of iptables argument lists, including the binary.
+    :return: The payload as a string.
+    """
+    tables = dict()
+    for cmd in cmds:
+        table, line = restore_line(cmd)
+        tables.setdefault(table, []).append(line)
+
+    lines = []
+    for table, rules in tables.items():
+        lines.append('*' + table)
+        lines.extend(rules)
+        lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def restore_call(cmds, config):
+    """
+    Apply a list of iptables commands in a single iptables-restore call.
+
+    iptables-restore commits each table atomically, so if any of the rules
+    of a table fail none of the rules of that table are applied. The tables
+    committed before it stay applied, see transaction_table().
+
+    :param cmds: A list of iptables argument lists, including the binary.
+    :param config: Configuration values from the configuration file.
+    :return: True if the rules were applied.
+    """
+    return restore_stream(restore_payload(cmds), config)
+
+
+def restore_stream(payload, config):
+    """
+    Apply an iptables-restore payload, keeping the existing rules.
+
+    :param payload: The payload as a string.
+    :param config: Configuration values from the configuration file.
+    :return: True if the rules were applied.
+    """
+    args = [IPTABLES_RESTORE_BINARY, '--noflush']
+
+    returncode, output = execute(args, payload)
+    # Log it as an alert if there is any output.
+    if output != '':
+        syslog.syslog(syslog.LOG_ALERT, output)
+    if returncode != 0:
+        syslog.syslog(syslog.LOG_ERR,
+                      'iptables-restore failed, no rules were applied.')
+    return returncode == 0
+
+
+def nft_payload(cmds):
+    """
+    Render nft commands as an nft script, preceded by the table set up.
+
+    :param cmds: A list of nft argument lists, including the binary.
+    :return: The script as a string.
+    """
+    lines = [statement.format(NFT_TABLE) for statement in NFT_BOOTSTRAP]
+    for cmd in cmds:
+        lines.append(' '.join(cmd[1:]))
+    return '\n'.join(lines) + '\n'
+
+
+def nft_call(cmds, config):
+    """
+    Apply a list of nft commands in a single atomic nft batch.
+
+    :param cmds: A list of nft argument lists, including the binary.
+    :param config: Configuration values from the configuration file.
+    :return: True if the rules were applied.
+    """
+    payload = nft_payload(cmds)
+    args = [NFT_BINARY, '-f', '-']
+
+    returncode, output = execute(args, payload)
+    # Log it as an alert if there is any output.
+    if output != '':
+        syslog.syslog(syslog.LOG_ALERT, output)
+    if returncode != 0:
+        syslog.syslog(syslog.LOG_ERR, 'nft failed, no rules were applied.')
+    return returncode == 0
+
+
+def apply_rules(cmds, config):
+    """
+    Execute commands using the backend selected in the configuration.
+
+    The "iptables" backend (default) forks iptables once per rule, the
+    "iptables-restore" and "nft" backends apply all the rules in one
+    transaction.
+
+    :param cmds: A list of iptables argument lists, including the binary.
+    :param config: Configuration values from the configuration file.
+    :return: True if all the commands succeeded.
+    """
+    # Rules are applied by one process at a time, see apply_lock().
+    with apply_lock():
+        success = True
+        # ipset commands are not part of the ruleset and run first, so that the
+        # sets exist when rules referring to them are applied.
+        for cmd in cmds:
+            if cmd[0] == IPSET_BINARY:
+                success = logged_call(cmd, config) and success
+        cmds = [cmd for cmd in cmds if cmd[0] != IPSET_BINARY]
+
+        # nft commands always go to nft, even if the backend has changed since
+        # they were recorded.
+        nft_cmds = [cmd for cmd in cmds if cmd[0] == NFT_BINARY]
+        if nft_cmds:
+            success = nft_call(nft_cmds, config) and success
+        cmds = [cmd for cmd in cmds if cmd[0] != NFT_BINARY]
+
+        if not cmds:
+            return success
+
+        backend = config.get('backend', 'iptables')
+        if (backend == 'iptables-restore' and
+                not iptables_capabilities()['noflush']):
+            syslog.syslog(syslog.LOG_WARNING, 'iptables-restore does not '
+                          'support --noflush, applying rules one by one.')
+            backend = 'iptables'
+
+        if backend == 'iptables-restore':
+            success = restore_call(cmds, config) and success
+        else:
+            for cmd in cmds:
+                success = logged_call(cmd, config) and success
+        return success
+
+
+def canonical_rule(args):
+    """
+    Normalise the match and target of an iptables rule for comparison.
+
+    iptables-save prints rules with the options in its own order, with
+    implicit modules and with host prefixes, so the rules we generate and the
+    installed rules are compared in this form.
+
+    :param args: The rule arguments, after the chain name.
+    :return: A sorted tuple of (option, values...) tuples.
+    """
+    aliases = {'--destination': '-d', '--source': '-s', '--protocol': '-p',
+               '--jump': '-j', '--match': '-m', '--state': '--ctstate',
+               '--destination-port': '--dport'}
+    options = []
+    for arg in args:
+        if arg.startswith('-') or arg == '!':
+            options.append([aliases.get(arg, arg)])
+        else:
+            options[-1].append(arg)
+
+    rule = []
+    for option in options:
+        if option[0] == '-m' and option[1] in ['tcp', 'udp', 'state',
+                                               'conntrack']:
+            continue
+        if option[0] in ['-d', '-s'] and option[1].endswith('/32'):
+            option[1] = option[1][:-3]
+        rule.append(tuple(option))
+    return tuple(sorted(rule))
+
+
+def parse_iptables_save(text):
+    """
+    Parse the output of iptables-save into an index of the installed rules.
+
+    :param text: Output of iptables-save.
+    :return: Dictionary of table name to a dictionary of chain name to a
+             dictionary of canonical rule to rule arguments.
+    """
+    tables = dict()
+    table = None
+    for line in text.splitlines():
+        if line.startswith('*'):
+            table = tables.setdefault(line[1:].strip(), dict())
+        elif line.startswith(':'):
+            table.setdefault(line[1:].split()[0], dict())
+        elif line.startswith('-A '):
+            args = line.split()
+            chain = table.setdefault(args[1], dict())
+            chain[canonical_rule(args[2:])] = args[2:]
+    return tables
+
+
+def is_managed(table, chain, rule, config):
+    """
+    Check whether an installed rule is one the hook installs.
+
+    :param table: Name of the table.
+    :param chain: Name of the chain.
+    :param rule: The canonical rule, see canonical_rule().
+    :param config: Configuration values from the configuration file.
+    :return: True if the rule was installed by the hook.
+    """
+    if chain.startswith(CHAIN_PREFIX):
+        return True
+
+    options = dict((option[0], option[1:]) for option in rule)
+    if table == 'nat' and chain == 'PREROUTING':
+        if options.get('-j', ('',))[0].startswith(CHAIN_PREFIX):
+            return True
+        return (set(options) in [{'-p', '-d', '--dport', '-j',
+                                  '--to-destination'},
+                                 {'-p', '-d', '-m', '--dports', '-j',
+                                  '--to-destination'}] and
+                options['-j'] == ('DNAT',) and
+                options['-d'] == (config['public_ip'],))
+
+    if table == 'filter' and chain == 'FORWARD':
+        if options.get('--match-set', ('',))[0] == IPSET_NAME:
+            return True
+        return (set(options) == {'-d', '--ctstate', '-j'} and
+                options['--ctstate'] == ('NEW,RELATED,ESTABLISHED',) and
+                options['-j'] == ('ACCEPT',))
+
+    return False
+
+
+def reconcile_rules(desired, installed, config):
+    """
+    Compute the commands turning the installed rules into the desired rules.
+
+    Only rules installed by the hook are removed.
+
+    :param desired: List of iptables argument lists creating the desired
+                    rules, as returned by machine_rules() and network_rules().
+    :param installed: Installed rules, as returned by parse_iptables_save().
+    :param config: Configuration values from the configuration file.
+    :return: List of iptables argument lists, including the binary.
+    """
+    wanted = dict()
+    wanted_chains = set()
+    for cmd in desired:
+        args = list(cmd[1:])
+        table = 'filter'
+        if '-t' in args:
+            index = args.index('-t')
+            table = args[index + 1]
+            del args[index:index + 2]
+        if args[0] == '-N':
+            wanted_chains.add((table, args[1]))
+        elif args[0] in ['-I', '-A']:
+            wanted[(table, args[1], canonical_rule(args[2:]))] = args
+
+    removals = list()
+    removed_chains = list()
+    for table, chains in installed.items():
+        for chain, rules in chains.items():
+            if (chain.startswith(CHAIN_PREFIX) and
+                    (table, chain) not in wanted_chains):
+                removed_chains.append((table, chain))
+                continue
+            for rule, args in rules.items():
+                if ((table, chain, rule) not in wanted and
+                        is_managed(table, chain, rule, config)):
+                    removals.append([IPTABLES_BINARY, '-t', table, '-D',
+                                     chain] + args)
+
+    cmds = removals
+    for table, chain in removed_chains:
+        cmds.append([IPTABLES_BINARY, '-t', table, '-F', chain])
+        cmds.append([IPTABLES_BINARY, '-t', table, '-X', chain])
+    for table, chain in sorted(wanted_chains):
+        if chain not in installed.get(table, {}):
+            cmds.append([IPTABLES_BINARY, '-t', table, '-N', chain])
+    for (table, chain, rule), args in wanted.items():
+        if rule not in installed.get(table, {}).get(chain, {}):
+            cmds.append([IPTABLES_BINARY, '-t', table] + args)
+    return cmds
+
+
+def network_rules(action, network, config, check=True):
+    """
+    Build the commands accepting forwarded traffic for a network.
+
+    With "network_ipset" enabled in the configuration, the networks are
+    members of a single hash:net ipset matched by one FORWARD rule, and
+    plugging or unplugging a network only adds or deletes a set member.
+
+    The rules are iptables rules at the top of FORWARD with every backend,
+    ahead of the FORWARD rules of libvirt.
 
     :param action: libvirt hook action
-    :param libvirt_object:
+    :param network: IP range of the network, or a Network model.
     :param config: Configuration values from the configuration file.
-    :return: List of commands that has been executed.
+    :param check: Leave out the FORWARD rule of the set if it is installed,
+                  which runs iptables.
+    :return: List of argument lists, including the binary.
     """
+    network = str(network)
     cmds = list()
-    network = None
-    if libvirt_object in config['networks'].keys():
-        network = config['networks'][libvirt_object]
-    else:
-        syslog.syslog('No network configuration, terminating.')
-        exit(0)
+
+    if config.get('network_ipset', False):
+        if action in ['unplugged']:
+            cmds.append([IPSET_BINARY, '-exist', 'del', IPSET_NAME, network])
+        if action in ['plugged']:
+            cmds.append([IPSET_BINARY, '-exist', 'create', IPSET_NAME,
+                         'hash:net'])
+            cmds.append([IPSET_BINARY, '-exist', 'add', IPSET_NAME, network])
+            # One rule matches the whole set, add it on first use only.
+            cmd = [IPTABLES_BINARY, '-I', 'FORWARD', '-m', 'set',
+                   '--match-set', IPSET_NAME, 'dst', '-m', 'conntrack',
+                   '--ctstate', 'NEW,RELATED,ESTABLISHED', '-j', 'ACCEPT']
+            if not check or not rule_exists(cmd):
+                cmds.append(cmd)
+        return cmds
 
     if action in ['unplugged']:
-        syslog.syslog('Removing forwarding rule for network ' +
-                      '{}'.format(network))
         cmd = [IPTABLES_BINARY, '-D', 'FORWARD', '-m', 'state', '-d',
                network, '--state', 'NEW,RELATED,ESTABLISHED', '-j',
                'ACCEPT']
         cmds.append(cmd)
 
     if action in ['plugged']:
-        syslog.syslog('Adding forwarding rule for network ' +
-                      '{}'.format(network))
         cmd = [IPTABLES_BINARY, '-I', 'FORWARD', '-m', 'state', '-d',
                network, '--state', 'NEW,RELATED,ESTABLISHED', '-j',
                'ACCEPT']
         cmds.append(cmd)
 
-    for cmd in cmds:
-        logged_call(cmd, config)
+    return cmds
+
+
+def plan_rules(config, machines=None, networks=None):
+    """
+    Generate the rules of machines and networks, without running anything.
+
+    The rules are built one machine or network at a time, so that the rules
+    of a large configuration are never all in memory.
+
+    :param config: Configuration values from the configuration file.
+    :param machines: Names of the machines, all of them if None.
+    :param networks: Names of the networks, all of them if None.
+    :return: Iterator of (kind, name, argument list) tuples, kind is
+             'machine' or 'network'.
+    """
+    if machines is None:
+        machines = config['machines'].keys()
+    if networks is None:
+        networks = config['networks'].keys()
+    for name in machines:
+        for cmd in machine_rules('start', name, config['machines'][name],
+                                 config):
+            yield 'machine', name, cmd
+    # Commands shared by all the networks, such as creating the ipset and
+    # its FORWARD rule, are generated once.
+    shared = set()
+    for name in networks:
+        network = str(config['networks'][name])
+        for cmd in network_rules('plugged', network, config, check=False):
+            if network not in cmd:
+                if tuple(cmd) in shared:
+                    continue
+                shared.add(tuple(cmd))
+            yield 'network', name, cmd
+
+
+def ctrl_network(action, libvirt_object, config):
+    """
+    Set up/tear down the forwarding of incoming connections.
+
+    :param action: libvirt hook action
+    :param libvirt_object:
+    :param config: Configuration values from the configuration file.
+    :return: List of commands that has been executed.
+    """
+    network = None
+    if libvirt_object in config['networks'].keys():
+        network = config['networks'][libvirt_object]
+    else:
+        syslog.syslog(syslog.LOG_DEBUG, 'No network configuration, '
+                      'terminating.')
+        exit(0)
+
+    with phase('rules'):
+        cmds = network_rules(action, network, config)
+    count('rules', len(cmds))
+    with phase('apply'):
+        success = apply_rules(cmds, config)
+
+    log_summary('{} network {} ({}): {} rules{}'.format(
+        action.title(), libvirt_object, network, len(cmds),
+        '' if success else ', failed'), cmds, config,
+        syslog.LOG_INFO if success else syslog.LOG_ERR)
 
     # This is used for testing.
     cmds_strings = []
@@ -124,6 +912,584 @@ def ctrl_network(action, libvirt_object, config):
     return (cmds_strings)
 
 
+def machine_chain(libvirt_object):
+    """
+    Get the name of the dedicated NAT chain of a machine.
+
+    The name is derived from the libvirt object name only, so the chain can
+    be found again after a crash. Names that are too long for iptables or
+    contain unusual characters are shortened and suffixed by a hash.
+
+    :param libvirt_object: Name of the libvirt object.
+    :return: The chain name.
+    """
+    chain = CHAIN_PREFIX + libvirt_object
+    if len(chain) <= CHAIN_MAX_LENGTH and CHAIN_NAME_RE.match(libvirt_object):
+        return chain
+
+    digest = hashlib.sha1(libvirt_object.encode('utf-8')).hexdigest()[:8]
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', libvirt_object)
+    name = name[:CHAIN_MAX_LENGTH - len(CHAIN_PREFIX) - len(digest) - 1]
+    return '{}{}-{}'.format(CHAIN_PREFIX, name, digest)
+
+
+def dnat_rule(config, machine, public_port, private_port, match_ip=True):
+    """
+    Build the match and target part of a DNAT rule for a port mapping.
+
+    A port range is forwarded by a single rule. If the public and machine
+    ranges differ, the ports are shifted from the start of the public range.
+
+    :param config: Configuration values from the configuration file.
+    :param machine: Configuration of the machine.
+    :param public_port: Port or port range on the public IP address.
+    :param private_port: Port or port range on the machine.
+    :param match_ip: Match the public IP address as destination.
+    :return: List of iptables arguments.
+    """
+    rule = ['-p', 'tcp']
+    if match_ip:
+        rule += ['-d', config['public_ip']]
+
+    public_first, public_last = port_range(public_port)
+    if public_first == public_last:
+        rule += ['--dport', str(public_port), '-j', 'DNAT',
+                 '--to-destination',
+                 '{0}:{1}'.format(machine['private_ip'], private_port)]
+        return rule
+
+    private_first, private_last = port_range(private_port)
+    destination = '{0}:{1}-{2}'.format(machine['private_ip'], private_first,
+                                       private_last)
+    if public_first != private_first:
+        destination += '/{}'.format(public_first)
+    rule += ['--dport', '{}:{}'.format(public_first, public_last), '-j',
+             'DNAT', '--to-destination', destination]
+    return rule
+
+
+def nft_elements(config, machine, public_port, private_port, value=True):
+    """
+    Build the dnat map elements of a port mapping.
+
+    Port ranges are expanded to an element per port, as the map is looked up
+    by exact port.
+
+    :param config: Configuration values from the configuration file.
+    :param machine: Configuration of the machine.
+    :param public_port: Port or port range on the public IP address.
+    :param private_port: Port or port range on the machine.
+    :param value: Include the destination of the elements.
+    :return: List of nft arguments, including the braces.
+    """
+    public_first, public_last = port_range(public_port)
+    private_first = port_range(private_port)[0]
+    elements = ['{']
+    for port in range(public_first, public_last + 1):
+        if len(elements) > 1:
+            elements.append(',')
+        elements += [config['public_ip'], '.', 'tcp', '.', str(port)]
+        if value:
+            elements += [':', machine['private_ip'], '.',
+                         str(port - public_first + private_first)]
+    elements.append('}')
+    return elements
+
+
+def dnat_rules(config, machine, match_ip=True):
+    """
+    Build the match and target part of the DNAT rules of a machine.
+
+    With "multiport" enabled in the configuration, mappings to the same port
+    on the machine are grouped in multiport rules of up to MULTIPORT_SIZE
+    ports, and the destination port is left unchanged.
+
+    The rules of a Machine model are kept in the model, and only built the
+    first time for a public IP address and set of options.
+
+    :param config: Configuration values from the configuration file.
+    :param machine: Configuration of the machine.
+    :param match_ip: Match the public IP address as destination.
+    :return: List of lists of iptables arguments, not to be modified.
+    """
+    templates = getattr(machine, 'templates', None)
+    key = (config['public_ip'], config.get('multiport', False), match_ip)
+    if templates is not None and key in templates:
+        return templates[key]
+
+    rules = list()
+    identity = list()
+    for public_port, private_port in machine['port_map']:
+        if (config.get('multiport', False) and
+                str(public_port) == str(private_port) and
+                '-' not in str(public_port)):
+            identity.append(str(public_port))
+        else:
+            rules.append(dnat_rule(config, machine, public_port,
+                                   private_port, match_ip))
+
+    for index in range(0, len(identity), MULTIPORT_SIZE):
+        rule = ['-p', 'tcp']
+        if match_ip:
+            rule += ['-d', config['public_ip']]
+        rule += ['-m', 'multiport', '--dports',
+                 ','.join(identity[index:index + MULTIPORT_SIZE]), '-j',
+                 'DNAT', '--to-destination', machine['private_ip']]
+        rules.append(rule)
+
+    if templates is not None:
+        templates[key] = rules
+    return rules
+
+
+def machine_rules(action, libvirt_object, machine, config):
+    """
+    Build the iptables commands needed for a machine.
+
+    The "nft" backend adds and deletes elements in the dnat map of the
+    nftables table instead of rules.
+
+    With "machine_chains" enabled in the configuration, the rules of each
+    machine live in a dedicated chain with a single jump from PREROUTING,
+    and tear down is a flush and delete of that chain instead of one delete
+    per rule.
+
+    :param action: libvirt hook action
+    :param libvirt_object: Name of the libvirt object.
+    :param machine: Configuration of the machine.
+    :param config: Configuration values from the configuration file.
+    :return: List of iptables argument lists, including the binary.
+    """
+    cmds = list()
+    nat = [IPTABLES_BINARY, '-t', 'nat']
+
+    if config.get('backend', 'iptables') == 'nft':
+        dnat = ['element', 'ip', NFT_TABLE, 'dnat']
+        if action in ['stopped', 'reconnect']:
+            for public_port, private_port in machine['port_map']:
+                cmds.append([NFT_BINARY, 'delete'] + dnat +
+                            nft_elements(config, machine, public_port,
+                                         private_port, value=False))
+        if action in ['start', 'reconnect']:
+            for public_port, private_port in machine['port_map']:
+                cmds.append([NFT_BINARY, 'add'] + dnat +
+                            nft_elements(config, machine, public_port,
+                                         private_port))
+        return cmds
+
+    if config.get('machine_chains', False):
+        chain = machine_chain(libvirt_object)
+        jump = ['-p', 'tcp', '-d', config['public_ip'], '-j', chain]
+
+        if action in ['stopped', 'reconnect']:
+            cmds.append(nat + ['-D', 'PREROUTING'] + jump)
+            cmds.append(nat + ['-F', chain])
+            cmds.append(nat + ['-X', chain])
+
+        if action in ['start', 'reconnect']:
+            # Fill the chain before jumping to it, and flush it in case it
+            # was left behind by a crash.
+            cmds.append(nat + ['-N', chain])
+            cmds.append(nat + ['-F', chain])
+            for rule in dnat_rules(config, machine, match_ip=False):
+                cmds.append(nat + ['-A', chain] + rule)
+            cmds.append(nat + ['-I', 'PREROUTING'] + jump)
+
+        return cmds
+
+    if action in ['stopped', 'reconnect']:
+        for rule in dnat_rules(config, machine):
+            cmds.append(nat + ['-D', 'PREROUTING'] + rule)
+
+    if action in ['start', 'reconnect']:
+        for rule in dnat_rules(config, machine):
+            cmds.append(nat + ['-I', 'PREROUTING'] + rule)
+
+    return cmds
+
+
+def ledger_filename(libvirt_object):
+    """
+    Get the name of the ledger file of a machine.
+    """
+    return os.path.join(LEDGER_PATH,
+                        urllib.parse.quote(libvirt_object, safe='') + '.json')
+
+
+def read_ledger(libvirt_object):
+    """
+    Read the rules installed for a machine.
+
+    :param libvirt_object: Name of the libvirt object.
+    :return: List of the argument lists that installed the rules, or None if
+             nothing is recorded.
+    """
+    binaries = {'iptables': IPTABLES_BINARY, 'nft': NFT_BINARY}
+    try:
+        with open(ledger_filename(libvirt_object), 'r') as ledger_file:
+            rules = json.load(ledger_file)
+        return [[binaries[rule[0]]] + rule[1:] for rule in rules]
+    except (OSError, ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def ledger_data(cmds):
+    """
+    Encode the rules installed for a machine as the contents of its ledger.
+
+    :param cmds: List of the argument lists that installed the rules.
+    :return: The ledger as a JSON string.
+    """
+    tools = {IPTABLES_BINARY: 'iptables', NFT_BINARY: 'nft'}
+    rules = [[tools[cmd[0]]] + cmd[1:] for cmd in cmds]
+    return json.dumps(rules, separators=(',', ':'))
+
+
+def write_ledger(libvirt_object, cmds):
+    """
+    Record the rules installed for a machine.
+
+    :param libvirt_object: Name of the libvirt object.
+    :param cmds: List of the argument lists that installed the rules. The
+                 ledger is removed if the list is empty.
+    """
+    if not cmds:
+        filename = ledger_filename(libvirt_object)
+        try:
+            if os.path.exists(filename):
+                os.remove(filename)
+        except OSError as exception:
+            syslog.syslog(syslog.LOG_ERR, 'Could not record the rules of '
+                          '{}: {}'.format(libvirt_object, exception))
+        return
+    store_ledger(libvirt_object, ledger_data(cmds))
+
+
+def store_ledger(libvirt_object, data):
+    """
+    Write the ledger of a machine.
+
+    :param libvirt_object: Name of the libvirt object.
+    :param data: Contents of the ledger, see ledger_data().
+    """
+    filename = ledger_filename(libvirt_object)
+    try:
+        os.makedirs(LEDGER_PATH, exist_ok=True)
+        tmp_filename = '{}.{}'.format(filename, os.getpid())
+        with open(tmp_filename, 'w') as ledger_file:
+            ledger_file.write(data)
+        os.replace(tmp_filename, filename)
+    except OSError as exception:
+        syslog.syslog(syslog.LOG_ERR, 'Could not record the rules of '
+                      '{}: {}'.format(libvirt_object, exception))
+
+
+def nft_element_key(cmd):
+    """
+    Get the key of the element of an nft add element command.
+
+    :param cmd: An nft argument list, including the binary.
+    :return: The key as a list of arguments, enclosed in braces.
+    """
+    start = cmd.index('{')
+    elements = ['{']
+    in_key = True
+    for arg in cmd[start + 1:-1]:
+        if arg == ',':
+            in_key = True
+        elif arg == ':':
+            in_key = False
+        if in_key:
+            elements.append(arg)
+    return elements + ['}']
+
+
+def nft_keys(cmd):
+    """
+    Split the elements of an nft add element command.
+
+    :param cmd: An nft argument list, including the binary.
+    :return: List of (key, arguments) tuples, the key as a tuple of its
+             values and the arguments of the whole element.
+    """
+    start = cmd.index('{')
+    elements = [[]]
+    for arg in cmd[start + 1:-1]:
+        if arg == ',':
+            elements.append([])
+        else:
+            elements[-1].append(arg)
+    keys = list()
+    for element in elements:
+        key = element[:element.index(':')] if ':' in element else element
+        keys.append((tuple(arg for arg in key if arg != '.'), element))
+    return keys
+
+
+def nft_present(installed):
+    """
+    Find the nftables elements that are in the dnat map, listing the map
+    once.
+
+    :param installed: List of nft argument lists, including the binary.
+    :return: List of the argument lists with only the elements that exist,
+             None for those without any, or None if nft can not be run.
+    """
+    try:
+        with phase('exec'):
+            listed = subprocess.run([NFT_BINARY, '-j', 'list', 'map', 'ip',
+                                     NFT_TABLE, 'dnat'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+        count('forks')
+    except OSError:
+        return None
+
+    # Without the table, after a flush of the ruleset, no element is left.
+    keys = set()
+    if listed.returncode == 0:
+        try:
+            for item in json.loads(listed.stdout.decode('utf-8'))['nftables']:
+                for element in item.get('map', {}).get('elem', []):
+                    key = element[0]
+                    if 'elem' in key:
+                        key = key['elem']['val']
+                    keys.add(tuple(str(value) for value in key['concat']))
+        except (ValueError, KeyError, IndexError, TypeError):
+            return None
+
+    present = list()
+    for cmd in installed:
+        elements = [element for key, element in nft_keys(cmd) if key in keys]
+        if not elements:
+            present.append(None)
+            continue
+        start = cmd.index('{')
+        args = cmd[:start + 1]
+        for element in elements:
+            args += element + [',']
+        present.append(args[:-1] + ['}'])
+    return present
+
+
+def present_rules(installed):
+    """
+    Find the rules that are in the firewall.
+
+    Rules and chains are looked up in a single iptables-save run, nftables
+    elements in a single listing of the dnat map. Rules can be gone without
+    the hook knowing, such as after a firewall reload.
+
+    :param installed: List of the argument lists that installed the rules.
+    :return: List of the argument lists whose rule, chain or elements exist,
+             all of them if the firewall can not be read.
+    """
+    tables = dict()
+    if any(cmd[0] == IPTABLES_BINARY for cmd in installed):
+        try:
+            with phase('exec'):
+                saved = subprocess.run([IPTABLES_SAVE_BINARY],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL)
+            count('forks')
+        except OSError:
+            return installed
+        if saved.returncode != 0:
+            return installed
+        tables = parse_iptables_save(saved.stdout.decode('ascii', 'replace'))
+
+    nft_cmds = [cmd for cmd in installed if cmd[0] == NFT_BINARY]
+    if nft_cmds:
+        nft_cmds = nft_present(nft_cmds)
+        if nft_cmds is None:
+            return installed
+    nft_cmds = iter(nft_cmds)
+
+    present = list()
+    for cmd in installed:
+        if cmd[0] == NFT_BINARY:
+            # The elements that are gone are left out.
+            cmd = next(nft_cmds)
+            exists = cmd is not None
+        elif cmd[0] == IPTABLES_BINARY:
+            table, line = restore_line(cmd)
+            chains = tables.get(table, {})
+            if line.startswith(':'):
+                exists = line[1:].split()[0] in chains
+            else:
+                args = line.split()
+                exists = canonical_rule(args[2:]) in chains.get(args[1], {})
+        else:
+            exists = True
+        if exists:
+            present.append(cmd)
+    return present
+
+
+def teardown_rules(installed):
+    """
+    Build the commands removing installed rules.
+
+    Chains created by the rules are flushed and deleted as a whole.
+
+    :param installed: List of the argument lists that installed the rules.
+    :return: List of argument lists, including the binary.
+    """
+    chains = set(cmd[cmd.index('-N') + 1] for cmd in installed
+                 if '-N' in cmd)
+    cmds = list()
+    for cmd in reversed(installed):
+        if cmd[0] == NFT_BINARY:
+            # Elements are deleted by key only.
+            start = cmd.index('{')
+            cmds.append([NFT_BINARY, 'delete'] + cmd[2:start] +
+                        nft_element_key(cmd))
+            continue
+
+        for index, arg in enumerate(cmd):
+            if arg in ['-I', '-A'] and cmd[index + 1] not in chains:
+                cmds.append(cmd[:index] + ['-D'] + cmd[index + 1:])
+            elif arg == '-N':
+                cmds.append(cmd[:index] + ['-F', cmd[index + 1]])
+                cmds.append(cmd[:index] + ['-X', cmd[index + 1]])
+    return cmds
+
+
+def rules_delta(installed, desired):
+    """
+    Build the commands turning the installed rules into the desired rules.
+
+    :param installed: List of the argument lists that installed the rules.
+    :param desired: List of the argument lists installing the new rules.
+    :return: List of argument lists, including the binary.
+    """
+    installed_set = set(tuple(cmd) for cmd in installed)
+    desired_set = set(tuple(cmd) for cmd in desired)
+    stale = [cmd for cmd in installed if tuple(cmd) not in desired_set]
+    cmds = teardown_rules(stale)
+    cmds += [cmd for cmd in desired if tuple(cmd) not in installed_set]
+    return cmds
+
+
+def transaction_table(cmds):
+    """
+    Get the single transaction commands can be applied in.
+
+    :param cmds: A list of argument lists, including the binary.
+    :return: 'nft' for nft commands, the table of iptables commands that are
+             all in the same table, or None if the commands take more than
+             one transaction.
+    """
+    binaries = set(cmd[0] for cmd in cmds)
+    if binaries == {NFT_BINARY}:
+        return 'nft'
+    if binaries != {IPTABLES_BINARY}:
+        return None
+    tables = set(restore_line(cmd)[0] for cmd in cmds)
+    if len(tables) != 1:
+        return None
+    return tables.pop()
+
+
+def atomic_rules(cmds, config):
+    """
+    Check if commands are applied in a single transaction, so that nothing
+    is applied if they fail.
+
+    :param cmds: A list of argument lists, including the binary.
+    :param config: Configuration values from the configuration file.
+    """
+    table = transaction_table(cmds)
+    if table == 'nft':
+        return True
+    return (table is not None and
+            config.get('backend') == 'iptables-restore' and
+            iptables_capabilities()['noflush'])
+
+
+def retry_present(cmds, installed, rebuild, config):
+    """
+    Apply the commands of an event again after they failed, removing only
+    the recorded rules that are in the firewall.
+
+    Recorded rules are removed without looking at the firewall first, and
+    only if that fails in one transaction, such as after a firewall reload,
+    the firewall is read once, see present_rules().
+
+    :param cmds: The commands that failed.
+    :param installed: The recorded rules the commands remove.
+    :param rebuild: Function building the commands from the recorded rules
+                    that are in the firewall.
+    :param config: Configuration values from the configuration file.
+    :return: The commands that were applied instead, or None if they can
+             not be applied.
+    """
+    if not installed or not atomic_rules(cmds, config):
+        return None
+    present = present_rules(installed)
+    if present == installed:
+        return None
+    cmds = rebuild(present)
+    if not apply_rules(cmds, config):
+        return None
+    return cmds
+
+
+def record_present(libvirt_object, installed):
+    """
+    Record the rules of a machine that are in the firewall, after applying
+    its rules failed part way.
+
+    :param libvirt_object: Name of the libvirt object.
+    :param installed: The rules the machine should have after the event.
+    """
+    candidates = list(read_ledger(libvirt_object) or [])
+    known = set(tuple(cmd) for cmd in candidates)
+    candidates += [cmd for cmd in installed if tuple(cmd) not in known]
+    write_ledger(libvirt_object, present_rules(candidates))
+
+
+def machine_event(action, libvirt_object, config, pending=None):
+    """
+    Build the commands for a machine event, using the ledger of the machine.
+
+    Rules are removed as recorded in the ledger, not as found in the current
+    configuration, and reconnect only applies the difference between the
+    two.
+
+    :param action: libvirt hook action
+    :param libvirt_object: Name of the libvirt object.
+    :param config: Configuration values from the configuration file.
+    :param pending: Rules of the machine after earlier events that are not
+                    applied yet, or that are in the firewall, used instead of
+                    its ledger.
+    :return: Tuple of the commands and the rules installed after the event,
+             or None if there is nothing to do for the machine.
+    """
+    installed = read_ledger(libvirt_object) if pending is None else pending
+    machine = config['machines'].get(libvirt_object)
+    if machine is None:
+        if action == 'stopped' and installed:
+            return teardown_rules(installed), []
+        return None
+
+    if installed is None:
+        cmds = machine_rules(action, libvirt_object, machine, config)
+        if action == 'stopped':
+            return cmds, []
+        return cmds, machine_rules('start', libvirt_object, machine, config)
+
+    if action == 'stopped':
+        return teardown_rules(installed), []
+
+    desired = machine_rules('start', libvirt_object, machine, config)
+    if action == 'start':
+        # Left behind by a machine that crashed, remove the old rules first.
+        return teardown_rules(installed) + desired, desired
+
+    return rules_delta(installed, desired), desired
+
+
 def ctrl_machine(action, libvirt_object, config):
     """
     Set up/tear down port forwarding for the individual machines.
@@ -133,94 +1499,295 @@ def ctrl_machine(action, libvirt_object, config):
     :param config: Configuration values from the configuration file.
     :return: List of commands that has been executed.
     """
-    cmds = list()
-    machine = {}
-    if libvirt_object in config['machines'].keys():
-        machine = config['machines'][libvirt_object]
-    else:
-        syslog.syslog('No forwarding configuration, terminating.')
+    with phase('rules'):
+        event = machine_event(action, libvirt_object, config)
+    if event is None:
+        syslog.syslog(syslog.LOG_DEBUG, 'No forwarding configuration, '
+                      'terminating.')
         exit(0)
+    cmds, installed = event
 
-    if action in ['stopped', 'reconnect']:
-        syslog.syslog('Remove {} forwarding rules'.format(libvirt_object))
-        for ports in machine['port_map']:
-            public_port = ports[0]
-            private_port = ports[1]
-            cmd = [IPTABLES_BINARY, '-t', 'nat', '-D', 'PREROUTING', '-p',
-                   'tcp', '-d', config['public_ip'], '--dport',
-                   public_port, '-j',
-                   'DNAT', '--to-destination',
-                   '{0}:{1}'.format(machine['private_ip'],
-                                    private_port)]
-
-            syslog.syslog(' Private IP and port ' +
-                          '{}:{}'.format(machine['private_ip'],
-                                         private_port))
-            syslog.syslog(' Public IP and port ' +
-                          '{}:{}'.format(config['public_ip'],
-                                         public_port))
-            cmds.append(cmd)
+    machine = config['machines'].get(libvirt_object, {'port_map': []})
+    if log_level(config) >= syslog.LOG_DEBUG:
+        for public_port, private_port in machine['port_map']:
+            log_detail('{}:{} -> {}:{}'.format(
+                config['public_ip'], public_port, machine['private_ip'],
+                private_port))
 
-    if action in ['start', 'reconnect']:
-        syslog.syslog('Insert {} forwarding rules'.format(libvirt_object))
-        for ports in machine['port_map']:
-            public_port = ports[0]
-            private_port = ports[1]
-            cmd = [IPTABLES_BINARY, '-t', 'nat', '-I', 'PREROUTING', '-p',
-                   'tcp', '-d', config['public_ip'], '--dport', public_port, '-j',
-                   'DNAT', '--to-destination',
-                   '{0}:{1}'.format(machine['private_ip'],
-                                    private_port)]
-            syslog.syslog(' Private IP and port ' +
-                          '{}:{}'.format(machine['private_ip'],
-                                         private_port))
-            syslog.syslog(' Public IP and port ' +
-                          '{}:{}'.format(config['public_ip'],
-                                         public_port))
-            cmds.append(cmd)
+    def rebuild(present):
+        return (machine_event(action, libvirt_object, config, present) or
+                ([], []))[0]
 
-        for cmd in cmds:
-            logged_call(cmd, config)
+    count('rules', len(cmds))
+    with phase('apply'):
+        success = apply_rules(cmds, config)
+        if not success:
+            # Recorded rules removed behind our back, such as by a firewall
+            # reload, are not removed again.
+            retried = retry_present(cmds, read_ledger(libvirt_object),
+                                    rebuild, config)
+            if retried is not None:
+                cmds, success = retried, True
+        if success:
+            write_ledger(libvirt_object, installed)
+        else:
+            record_present(libvirt_object, installed)
 
-        # This is used for testing.
-        cmds_strings = []
-        for cmd in cmds:
-            cmds_strings.append(' '.join(cmd))
-        return (cmds_strings)
+    log_summary('{} {}: {} rules for {} port mappings{}'.format(
+        action.title(), libvirt_object, len(cmds), len(machine['port_map']),
+        '' if success else ', failed'), cmds, config,
+        syslog.LOG_INFO if success else syslog.LOG_ERR)
+
+    # This is used for testing.
+    cmds_strings = []
+    for cmd in cmds:
+        cmds_strings.append(' '.join(cmd))
+    return (cmds_strings)
+
+
+def fragment_filename(config_filename, kind, name, action):
+    """
+    Get the name of a compiled rule fragment.
+
+    Fragments are kept in a directory next to the configuration file, see
+    hookctrl.compile_fragments().
+
+    :param config_filename: Name of the configuration file.
+    :param kind: 'machine' or 'network'.
+    :param name: Name of the machine or network.
+    :param action: libvirt hook action, or 'ledger' for the rules recorded
+                   after a start.
+    """
+    return os.path.join(config_filename + '.fragments', '{}-{}.{}'.format(
+        kind, urllib.parse.quote(name, safe=''), action))
+
+
+def fragment_key(kind, name, config):
+    """
+    Get the key of the fragments of a machine or network.
+
+    The key is a hash of the entry and the global values its rules depend
+    on, so a fragment is stale as soon as any of them change.
+
+    :param kind: 'machine' or 'network'.
+    :param name: Name of the machine or network.
+    :param config: Configuration data, as loaded from the file.
+    :return: The key as a hexadecimal string.
+    """
+    data = [FRAGMENT_VERSION, kind, name, config[kind + 's'][name],
+            [config.get(key) for key in RULE_SETTINGS]]
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+
+def read_fragment(kind, name, action, key):
+    """
+    Read a compiled rule fragment, if it is current.
+
+    :param kind: 'machine' or 'network'.
+    :param name: Name of the machine or network.
+    :param action: libvirt hook action, or 'ledger'.
+    :param key: Key of the current entry, see fragment_key().
+    :return: The fragment, or None if it is missing or stale.
+    """
+    try:
+        with open(fragment_filename(CONFIG_FILENAME, kind, name, action),
+                  'r') as fragment_file:
+            if fragment_file.readline() != '# {}\n'.format(key):
+                return None
+            return fragment_file.read()
+    except OSError:
+        return None
+
+
+def apply_fragment(hook, libvirt_object, action, config):
+    """
+    Stream the compiled rules of an event into iptables-restore.
+
+    Only used with the "iptables-restore" backend. A machine is started from
+    its fragment if no rules are recorded for it, and stopped from it if the
+    recorded rules are the ones of the fragment. Anything else, such as a
+    reconnect or a missing or stale fragment, is left to the rules built
+    from the configuration.
+
+    :param hook: Name of the libvirt hook.
+    :param libvirt_object: Name of the libvirt object.
+    :param action: libvirt hook action
+    :param config: Configuration data, as loaded from the file.
+    :return: True if the event was handled.
+    """
+    kind = 'network' if hook == 'network' else 'machine'
+    if (config.get('backend') != 'iptables-restore' or
+            libvirt_object not in config[kind + 's']):
+        return False
+
+    key = fragment_key(kind, libvirt_object, config)
+    ledger = None
+    if kind == 'machine':
+        try:
+            with open(ledger_filename(libvirt_object), 'r') as ledger_file:
+                installed = ledger_file.read()
+        except FileNotFoundError:
+            installed = None
+        except OSError:
+            return False
+        ledger = read_fragment(kind, libvirt_object, 'ledger', key)
+        if ledger is None:
+            return False
+        if action == 'start' and installed is not None:
+            return False
+        if action == 'stopped' and installed != ledger:
+            return False
+
+    payload = read_fragment(kind, libvirt_object, action, key)
+    if payload is None or not iptables_capabilities()['noflush']:
+        return False
+
+    rules = sum(1 for line in payload.splitlines() if line[:1] in '-:')
+    count('rules', rules)
+    with phase('apply'):
+        with apply_lock():
+            success = restore_stream(payload, config)
+        if not success and action == 'stopped':
+            # Some of the rules are gone, remove the others as recorded.
+            return False
+        if success and kind == 'machine':
+            if action == 'start':
+                store_ledger(libvirt_object, ledger)
+            else:
+                write_ledger(libvirt_object, [])
+
+    # The compiled payload is the detail of the event at debug level.
+    if log_level(config) >= syslog.LOG_DEBUG:
+        log_detail(payload.rstrip('\n'))
+    log_summary('{} {}: {} compiled rules{}'.format(
+        action.title(), libvirt_object, rules, '' if success else ', failed'),
+        [], config, syslog.LOG_INFO if success else syslog.LOG_ERR)
+    return True
+
+
+def forward_to_daemon(hook, libvirt_object, action):
+    """
+    Hand a hook event to the hook daemon, if it is running.
+
+    Once the event has been sent, the daemon is responsible for it. If no
+    reply arrives the event is not applied again, to not install the rules
+    twice.
+
+    :param hook: Name of the libvirt hook.
+    :param libvirt_object: Name of the libvirt object.
+    :param action: libvirt hook action
+    :return: The reply of the daemon, or None if the daemon is not running.
+    """
+    if not os.path.exists(SOCKET_FILENAME):
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(DAEMON_TIMEOUT)
+    try:
+        client.connect(SOCKET_FILENAME)
+    except OSError:
+        client.close()
+        return None
+
+    request = {'hook': hook, 'object': libvirt_object, 'action': action}
+    try:
+        with client:
+            client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            reply = client.makefile('rb').readline()
+        return json.loads(reply.decode('utf-8'))
+    except (OSError, ValueError) as exception:
+        return {'status': 'error',
+                'error': 'No reply from the hook daemon: {}'.format(
+                    exception)}
 
 
 def main():
     """
     Main entry point.
     """
+    # Check for supported hook and action.
+    if not is_handled(sys.argv):
+        exit(0)
+
     # Get the parameters from libvirt in to meaningful variables.
     hook, libvirt_object, action = sys.argv[0:3]
     # Isolate the executable name used to call us.
     hook = os.path.basename(hook)
 
-    # Check for supported hook and action.
-    if hook not in ['qemu', 'lxc', 'network']:
-        exit(0)
-    if action not in ['unplugged', 'plugged', 'stopped', 'start', 'reconnect']:
-        exit(0)
-
     # Open a syslog logger that has the executable and the PID appended at the
     # beginning of each line
     syslog.openlog(
         ident='libvirt-hook-' + hook + ' [' + str(os.getpid()) + ']:')
 
-    # Tell what libvirt wants us to do.
-    syslog.syslog('{} {} for {}'.format(action.title(), hook, libvirt_object))
+    profile = None
+    if PROFILE_PATH:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        run_hook(hook, libvirt_object, action)
+    finally:
+        PHASES['total'] = (time.monotonic() - STARTUP_TIME) * 1000
+        report_timings(hook, libvirt_object, action)
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(os.path.join(
+                PROFILE_PATH, '{}-{}-{}-{}.prof'.format(
+                    hook, urllib.parse.quote(libvirt_object, safe=''),
+                    action, os.getpid())))
+
+
+def run_hook(hook, libvirt_object, action):
+    """
+    Handle a hook event.
+
+    :param hook: Name of the libvirt hook.
+    :param libvirt_object: Name of the libvirt object.
+    :param action: libvirt hook action
+    """
+    # What libvirt wants us to do is logged with the summary of the event.
+    syslog.setlogmask(syslog.LOG_UPTO(log_level({})))
+
+    # Let the hook daemon do the work if it is running.
+    with phase('daemon'):
+        reply = forward_to_daemon(hook, libvirt_object, action)
+    if reply is not None:
+        if reply['status'] == 'error':
+            syslog.syslog(syslog.LOG_ERR, reply['error'])
+        exit(0)
 
     try:
-        # Import configuration
+        # Import the configuration of the object we are called for.
         json_config = HookConfig()
-        config = None
+        with phase('load'):
+            if hook == 'network':
+                config = json_config.load(CONFIG_FILENAME,
+                                          network=libvirt_object)
+            else:
+                config = json_config.load(CONFIG_FILENAME,
+                                          machine=libvirt_object)
+        PHASES['parse'] = json_config.parse_ms
+        syslog.setlogmask(syslog.LOG_UPTO(log_level(config)))
 
-        with open(CONFIG_FILENAME, 'r') as json_config_file:
-            config = json_config.parse(json_config_file.read())
+        # Report the time spent before touching the firewall.
+        startup = (time.monotonic() - STARTUP_TIME) * 1000
+        PHASES['startup'] = startup
+        if startup > STARTUP_BUDGET:
+            syslog.syslog(syslog.LOG_WARNING,
+                          'Start-up took {:.1f} ms, over the {:.1f} ms '
+                          'budget'.format(startup, STARTUP_BUDGET))
+        else:
+            syslog.syslog(syslog.LOG_DEBUG,
+                          'Start-up took {:.1f} ms'.format(startup))
 
         try:
+            # Stream the compiled rules of the event, if they are current.
+            if apply_fragment(hook, libvirt_object, action, config):
+                return
+            with phase('load'):
+                config = json_config.models(config)
+
             # Find the hook function and call it.
             if hook in ['qemu', 'lxc']:
                 ctrl_machine(action, libvirt_object, config)
@@ -228,17 +1795,23 @@ def main():
             if hook == 'network':
                 ctrl_network(action, libvirt_object, config)
         except FileNotFoundError as exception:
-            syslog.syslog('Error executing iptables command, terminating.',
-                          syslog.LOG_ERR)
+            syslog.syslog(syslog.LOG_ERR,
+                          'Error executing iptables command, terminating.')
             exit(0)
 
     except FileNotFoundError:
-        syslog.syslog('No {} found, terminating.'.format(CONFIG_FILENAME), syslog.LOG_ERR)
+        syslog.syslog(syslog.LOG_ERR,
+                      'No {} found, terminating.'.format(CONFIG_FILENAME))
         exit(0)
     except json.JSONDecodeError as jde:
         syslog.syslog('Error loading configuration file: {} in line {} char {}: {}'.format(
                 jde.msg, jde.lineno, jde.colno, jde.doc))
         exit(1)
+    except ValueError as ve:
+        # An invalid entry changes nothing, libvirt carries on.
+        syslog.syslog(syslog.LOG_ERR, 'Error in configuration file: '
+                      '{}, nothing changed.'.format(ve))
+        exit(0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+
+"""Libvirt port-forwarding hook SQLite configuration store.
+
+Keeps the hook configuration in an SQLite database, with indexed tables for
+machines, port mappings and networks, as an alternative to the JSON file.
+
+0.0.1:
+======
+
+ * Initial version, with import and export of the JSON configuration.
+ * Index the public port ranges of the port mappings.
+ * Index the private IP addresses and network ranges, to check additions.
+
+"""
+
+__author__ = "Martin Bo Kristensen Groenholdt <martin.groenholdt@gmail.com>"
+__version__ = "0.0.1"
+
+import contextlib
+import ipaddress
+import json
+import sqlite3
+
+from hookjsonconf import port_range
+
+# Port columns have no type affinity, so that the ports keep the type they
+# had in the JSON configuration. The first public port, an integer whatever
+# the type of the port, is unique and indexed to find overlapping port
+# ranges. The private IP addresses of the machines
+# are indexed to find collisions, and the first and last address of the
+# networks, as strings sorting like the addresses, to find overlaps.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS machines (
+    name TEXT PRIMARY KEY,
+    private_ip TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS machines_private_ip ON machines (private_ip);
+CREATE TABLE IF NOT EXISTS port_maps (
+    machine TEXT NOT NULL REFERENCES machines (name) ON DELETE CASCADE,
+    public_port NOT NULL UNIQUE,
+    vm_port NOT NULL,
+    public_first INTEGER NOT NULL,
+    public_last INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS port_maps_machine ON port_maps (machine);
+CREATE TABLE IF NOT EXISTS networks (
+    name TEXT PRIMARY KEY,
+    network TEXT NOT NULL,
+    network_first TEXT,
+    network_last TEXT
+);
+"""
+
+# Stores of older versions lack the address ranges of the networks.
+NETWORK_RANGE_COLUMNS = ['network_first', 'network_last']
+
+
+def network_keys(network):
+    """
+    Get the first and last address of a network, as strings that compare
+    like the addresses, IPv4 before IPv6.
+    """
+    network = ipaddress.ip_network(network, strict=False)
+    return tuple('{}:{:032x}'.format(network.version, int(address)) for
+                 address in [network.network_address,
+                             network.broadcast_address])
+
+
+class HookSQLConfig:
+    """
+    Class for keeping configuration data in an SQLite database.
+    """
+
+    def __init__(self, filename):
+        """
+        Constructor, opens or creates the database.
+        """
+        self.db = sqlite3.connect(filename, isolation_level=None)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        """
+        Add the address ranges of the networks to a store of an older
+        version.
+        """
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(networks)')]
+        missing = [column for column in NETWORK_RANGE_COLUMNS if
+                   column not in columns]
+        if missing:
+            with self.transaction():
+                for column in missing:
+                    self.db.execute('ALTER TABLE networks ADD COLUMN ' +
+                                    column + ' TEXT')
+                for name, network in self.db.execute(
+                        'SELECT name, network FROM networks').fetchall():
+                    self.db.execute('UPDATE networks SET network_first = ?, '
+                                    'network_last = ? WHERE name = ?',
+                                    network_keys(network) + (name,))
+        self.db.execute('CREATE INDEX IF NOT EXISTS networks_first ON '
+                        'networks (network_first)')
+
+        # Older stores index the first public port without making it unique.
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' "
+                           "AND name = 'port_maps_public_first'").fetchone():
+            return
+        try:
+            self.db.execute('CREATE UNIQUE INDEX port_maps_public_first ON '
+                            'port_maps (public_first)')
+            self.db.execute('DROP INDEX IF EXISTS port_maps_public')
+        except sqlite3.IntegrityError:
+            # A port mapped twice keeps the old index, hookctrl still
+            # refuses new overlapping mappings.
+            self.db.execute('CREATE INDEX IF NOT EXISTS port_maps_public ON '
+                            'port_maps (public_first)')
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self.db.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager running the enclosed edits in a single transaction.
+
+        The write lock is taken up front, so concurrent edits are serialised
+        instead of failing at commit time. The transaction is rolled back if
+        the block raises an exception.
+        """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def settings(self):
+        """
+        Get the global configuration values.
+        """
+        config = dict()
+        for key, value in self.db.execute('SELECT key, value FROM settings'):
+            config[key] = json.loads(value)
+        return config
+
+    def set(self, key, value):
+        """
+        Set a global configuration value.
+        """
+        self.db.execute('INSERT OR REPLACE INTO settings (key, value) '
+                        'VALUES (?, ?)', (key, json.dumps(value)))
+
+    def machine(self, name):
+        """
+        Get the configuration of a machine.
+
+        :return: The machine configuration, or None if it does not exist.
+        """
+        row = self.db.execute('SELECT private_ip FROM machines WHERE name = ?',
+                              (name,)).fetchone()
+        if row is None:
+            return None
+        port_map = [[public_port, vm_port] for public_port, vm_port in
+                    self.db.execute('SELECT public_port, vm_port FROM '
+                                    'port_maps WHERE machine = ? ORDER BY '
+                                    'rowid', (name,))]
+        return {'private_ip': row[0], 'port_map': port_map}
+
+    def network(self, name):
+        """
+        Get the IP range of a network.
+
+        :return: The IP range, or None if the network does not exist.
+        """
+        row = self.db.execute('SELECT network FROM networks WHERE name = ?',
+                              (name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def ip_owner(self, private_ip):
+        """
+        Get the name of the machine using a private IP address.
+
+        :return: The machine name, or None if the address is not used.
+        """
+        row = self.db.execute('SELECT name FROM machines WHERE private_ip = '
+                              '? LIMIT 1', (private_ip,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def network_owner(self, network):
+        """
+        Get the name of a network overlapping an IP range.
+
+        The networks of the store do not overlap, so only the one starting
+        last, not after the end of the range, can overlap it.
+
+        :return: The network name, or None if no network overlaps.
+        """
+        first, last = network_keys(network)
+        row = self.db.execute('SELECT name, network_last FROM networks WHERE '
+                              'network_first <= ? ORDER BY network_first '
+                              'DESC LIMIT 1', (last,)).fetchone()
+        if row is None or row[1] < first:
+            return None
+        return row[0]
+
+    def port_owner(self, public_port):
+        """
+        Get the name of the machine using a public port or port range.
+
+        The port mappings of the store do not overlap, so only the one
+        starting last, not after the end of the range, can overlap it.
+
+        :return: The machine name, or None if the ports are not used.
+        """
+        first, last = port_range(public_port)
+        row = self.db.execute('SELECT machine, public_last FROM port_maps '
+                              'WHERE public_first <= ? ORDER BY public_first '
+                              'DESC LIMIT 1', (last,)).fetchone()
+        if row is None or row[1] < first:
+            return None
+        return row[0]
+
+    def add_machine(self, name, private_ip):
+        self.db.execute('INSERT INTO machines (name, private_ip) VALUES '
+                        '(?, ?)', (name, private_ip))
+
+    def remove_machine(self, name):
+        self.db.execute('DELETE FROM machines WHERE name = ?', (name,))
+
+    def add_network(self, name, network):
+        self.db.execute('INSERT INTO networks (name, network, network_first, '
+                        'network_last) VALUES (?, ?, ?, ?)',
+                        (name, network) + network_keys(network))
+
+    def remove_network(self, name):
+        self.db.execute('DELETE FROM networks WHERE name = ?', (name,))
+
+    def add_port(self, name, public_port, vm_port):
+        self.db.execute('INSERT INTO port_maps (machine, public_port, '
+                        'vm_port, public_first, public_last) VALUES (?, ?, '
+                        '?, ?, ?)',
+                        (name, public_port, vm_port) + port_range(public_port))
+
+    def remove_port(self, name, public_port, vm_port):
+        """
+        Remove a port mapping.
+
+        The ports match whatever their type, '2222' the same as 2222.
+
+        :return: True if the mapping existed.
+        """
+        public_first, public_last = port_range(public_port)
+        vm_range = port_range(vm_port)
+        for rowid, stored_vm_port in self.db.execute(
+                'SELECT rowid, vm_port FROM port_maps WHERE public_first = ? '
+                'AND public_last = ? AND machine = ?',
+                (public_first, public_last, name)).fetchall():
+            if port_range(stored_vm_port) == vm_range:
+                self.db.execute('DELETE FROM port_maps WHERE rowid = ?',
+                                (rowid,))
+                return True
+        return False
+
+    def load(self, machine=None, network=None):
+        """
+        Load the configuration needed for a single machine or network.
+
+        :param machine: Name of the machine to load.
+        :param network: Name of the network to load.
+        :return: The configuration data, in the same form as the JSON file.
+        """
+        config = self.settings()
+        config['machines'] = dict()
+        config['networks'] = dict()
+        if machine is not None:
+            value = self.machine(machine)
+            if value is not None:
+                config['machines'][machine] = value
+        if network is not None:
+            value = self.network(network)
+            if value is not None:
+                config['networks'][network] = value
+        return config
+
+    def import_config(self, config):
+        """
+        Replace the contents of the store with a JSON configuration.
+
+        :param config: Configuration data, as read from the JSON file.
+        """
+        with self.transaction():
+            for table in ['port_maps', 'machines', 'networks', 'settings']:
+                self.db.execute('DELETE FROM ' + table)
+            for key, value in config.items():
+                if key not in ['machines', 'networks']:
+                    self.set(key, value)
+            for name, machine in config.get('machines', {}).items():
+                self.add_machine(name, machine['private_ip'])
+                for public_port, vm_port in machine['port_map']:
+                    self.add_port(name, public_port, vm_port)
+            for name, network in config.get('networks', {}).items():
+                self.add_network(name, network)
+
+    def export_config(self):
+        """
+        Export the contents of the store as JSON configuration data.
+        """
+        config = self.settings()
+        config['machines'] = dict()
+        for name, private_ip in self.db.execute('SELECT name, private_ip '
+                                                'FROM machines ORDER BY '
+                                                'rowid'):
+            config['machines'][name] = {'private_ip': private_ip,
+                                        'port_map': []}
+        for name, public_port, vm_port in self.db.execute(
+                'SELECT machine, public_port, vm_port FROM port_maps ORDER '
+                'BY rowid'):
+            config['machines'][name]['port_map'].append([public_port,
+                                                         vm_port])
+        config['networks'] = dict(self.db.execute('SELECT name, network FROM '
+                                                  'networks ORDER BY rowid'))
+        return config
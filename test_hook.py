@@ -13,13 +13,23 @@ Libvirt port-forwarding hook unit tests.
 
 import json
 import imp
+import os
+import syslog
+import tempfile
 import unittest
 from unittest import mock
 from unittest.mock import patch
 from hookjsonconf import HookConfig
+from hookbench import Bench
 
 with patch.dict('os.environ', values={'IPTABLES_BINARY': 'iptables'}, clear=True):
-    from hooks import IPTABLES_BINARY, ctrl_network, ctrl_machine, logged_call
+    from hooks import IPTABLES_BINARY, IPTABLES_RESTORE_BINARY, \
+        ctrl_network, ctrl_machine, logged_call, restore_payload, \
+        machine_chain, nft_payload, is_handled, iptables_capabilities, \
+        machine_rules, network_rules, parse_iptables_save, reconcile_rules, \
+        read_ledger, execute, wait_args, apply_lock, PHASES, COUNTS, \
+        apply_fragment
+    from hookctrl import compile_fragments
 
 
 TEST_CONFIG = """
@@ -63,6 +73,21 @@ class QemuTestCase(unittest.TestCase):
             print('Error loading configuration file: {} in {} line {} char {}'.format(
                 jde.msg, jde.doc, jde.lineno, jde.colno))
 
+    def setUp(self):
+        # Keep the ledger of installed rules away from the host.
+        self.run_path = tempfile.TemporaryDirectory()
+        self.ledger_path = mock.patch('hooks.LEDGER_PATH', self.run_path.name)
+        self.ledger_path.start()
+        self.apply_lock = mock.patch(
+            'hooks.APPLY_LOCK_FILENAME',
+            os.path.join(self.run_path.name, 'apply.lock'))
+        self.apply_lock.start()
+
+    def tearDown(self):
+        self.apply_lock.stop()
+        self.ledger_path.stop()
+        self.run_path.cleanup()
+
     def test_config(self):
         self.assertEqual(self.config['debug'], False)
         self.assertEqual(self.config['machines'], {
@@ -107,5 +132,546 @@ class QemuTestCase(unittest.TestCase):
         ctrl_machine('reconnect', 'test', self.config)
         pass
 
+    @mock.patch('hooks.logged_call', side_effect=dummy_func)
+    def test_machine_stopped_executes(self, logged_call_function):
+        cmds = ctrl_machine('stopped', 'test', self.config)
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -t nat -D PREROUTING -p tcp -d 192.168.0.166 --dport 2222 -j DNAT --to-destination 192.168.122.2:22',
+            IPTABLES_BINARY + ' -t nat -D PREROUTING -p tcp -d 192.168.0.166 --dport 8002 -j DNAT --to-destination 192.168.122.2:80'])
+        self.assertEqual(logged_call_function.call_count, 2)
+
+    def test_restore_payload(self):
+        payload = restore_payload([
+            [IPTABLES_BINARY, '-t', 'nat', '-D', 'PREROUTING', '-p', 'tcp',
+             '--dport', '2222', '-j', 'ACCEPT'],
+            [IPTABLES_BINARY, '-I', 'FORWARD', '-d', '192.168.122.0/24',
+             '-j', 'ACCEPT'],
+            [IPTABLES_BINARY, '-t', 'nat', '-I', 'PREROUTING', '-p', 'tcp',
+             '--dport', '2222', '-j', 'ACCEPT']])
+        self.assertEqual(payload,
+                         '*nat\n'
+                         '-D PREROUTING -p tcp --dport 2222 -j ACCEPT\n'
+                         '-I PREROUTING -p tcp --dport 2222 -j ACCEPT\n'
+                         'COMMIT\n'
+                         '*filter\n'
+                         '-I FORWARD -d 192.168.122.0/24 -j ACCEPT\n'
+                         'COMMIT\n')
+
+    @mock.patch('hooks.logged_call', side_effect=dummy_func)
+    @mock.patch('hooks.iptables_capabilities',
+                return_value={'noflush': True})
+    @mock.patch('hooks.subprocess.Popen')
+    def test_reconnect_restore_backend(self, popen, capabilities,
+                                       logged_call_function):
+        popen.return_value.communicate.return_value = (b'', None)
+        popen.return_value.returncode = 0
+        config = dict(self.config, backend='iptables-restore')
+        cmds = ctrl_machine('reconnect', 'test', config)
+        self.assertEqual(len(cmds), 4)
+        # All rules go through one iptables-restore process.
+        logged_call_function.assert_not_called()
+        popen.assert_called_once()
+        self.assertEqual(popen.call_args[0][0],
+                         [IPTABLES_RESTORE_BINARY, '--noflush'])
+        payload = popen.return_value.communicate.call_args[0][0].decode()
+        self.assertEqual(payload.count('-D PREROUTING'), 2)
+        self.assertEqual(payload.count('-I PREROUTING'), 2)
+        self.assertEqual(payload.count('COMMIT'), 1)
+
+    def test_machine_chain(self):
+        self.assertEqual(machine_chain('test'), 'LVH-test')
+        # Long or odd names are hashed, but always to the same chain name.
+        name = 'a very long libvirt domain name/with odd characters'
+        self.assertEqual(machine_chain(name), machine_chain(name))
+        self.assertLessEqual(len(machine_chain(name)), 28)
+        self.assertNotEqual(machine_chain(name), machine_chain(name + 'x'))
+
+    @mock.patch('hooks.logged_call', side_effect=dummy_func)
+    def test_machine_chains(self, logged_call_function):
+        config = dict(self.config, machine_chains=True)
+        cmds = ctrl_machine('start', 'test', config)
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -t nat -N LVH-test',
+            IPTABLES_BINARY + ' -t nat -F LVH-test',
+            IPTABLES_BINARY + ' -t nat -A LVH-test -p tcp --dport 2222 -j DNAT --to-destination 192.168.122.2:22',
+            IPTABLES_BINARY + ' -t nat -A LVH-test -p tcp --dport 8002 -j DNAT --to-destination 192.168.122.2:80',
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 -j LVH-test'])
+
+        # Tear down does not depend on the number of port mappings.
+        cmds = ctrl_machine('stopped', 'test', config)
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -t nat -D PREROUTING -p tcp -d 192.168.0.166 -j LVH-test',
+            IPTABLES_BINARY + ' -t nat -F LVH-test',
+            IPTABLES_BINARY + ' -t nat -X LVH-test'])
+
+    def test_restore_payload_new_chain(self):
+        payload = restore_payload([
+            [IPTABLES_BINARY, '-t', 'nat', '-N', 'LVH-test'],
+            [IPTABLES_BINARY, '-t', 'nat', '-A', 'LVH-test', '-j', 'ACCEPT']])
+        self.assertEqual(payload, '*nat\n:LVH-test - [0:0]\n'
+                                  '-A LVH-test -j ACCEPT\nCOMMIT\n')
+
+
+    @mock.patch('hooks.logged_call', side_effect=dummy_func)
+    @mock.patch('hooks.subprocess.Popen')
+    def test_nft_backend(self, popen, logged_call_function):
+        popen.return_value.communicate.return_value = (b'', None)
+        popen.return_value.returncode = 0
+        config = dict(self.config, backend='nft')
+        cmds = ctrl_machine('reconnect', 'test', config)
+        self.assertEqual(cmds, [
+            'nft delete element ip libvirt_hook dnat { 192.168.0.166 . tcp . 2222 }',
+            'nft delete element ip libvirt_hook dnat { 192.168.0.166 . tcp . 8002 }',
+            'nft add element ip libvirt_hook dnat { 192.168.0.166 . tcp . 2222 : 192.168.122.2 . 22 }',
+            'nft add element ip libvirt_hook dnat { 192.168.0.166 . tcp . 8002 : 192.168.122.2 . 80 }'])
+        logged_call_function.assert_not_called()
+        popen.assert_called_once()
+        self.assertEqual(popen.call_args[0][0], ['nft', '-f', '-'])
+
+        # Forwarded traffic is accepted in iptables, ahead of the libvirt
+        # FORWARD rules.
+        cmds = ctrl_network('plugged', 'default', config)
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -I FORWARD -m state -d 192.168.122.0/24 --state NEW,RELATED,ESTABLISHED -j ACCEPT'])
+        logged_call_function.assert_called_once()
+
+    def test_nft_payload(self):
+        payload = nft_payload([['nft', 'add', 'element', 'ip', 'libvirt_hook',
+                                'dnat', '{', '192.168.0.166', '.', 'tcp', '.',
+                                '2222', ':', '192.168.122.2', '.', '22',
+                                '}']])
+        lines = payload.splitlines()
+        # The table is set up before any element is touched.
+        self.assertEqual(lines[0], 'add table ip libvirt_hook')
+        self.assertIn('add rule ip libvirt_hook prerouting dnat ip addr . port '
+                      'to ip daddr . meta l4proto . th dport map @dnat', lines)
+        self.assertNotIn('ct state new,related,established accept', payload)
+        self.assertEqual(lines[-1], 'add element ip libvirt_hook dnat { '
+                                    '192.168.0.166 . tcp . 2222 : '
+                                    '192.168.122.2 . 22 }')
+
+
+    @mock.patch('hooks.logged_call', side_effect=dummy_func)
+    @mock.patch('hooks.rule_exists', return_value=False)
+    def test_network_ipset(self, rule_exists, logged_call_function):
+        config = dict(self.config, network_ipset=True)
+        cmds = ctrl_network('plugged', 'default', config)
+        self.assertEqual(cmds, [
+            'ipset -exist create libvirt-hook-nets hash:net',
+            'ipset -exist add libvirt-hook-nets 192.168.122.0/24',
+            IPTABLES_BINARY + ' -I FORWARD -m set --match-set libvirt-hook-nets dst -m conntrack --ctstate NEW,RELATED,ESTABLISHED -j ACCEPT'])
+
+        # The set rule is only inserted once.
+        rule_exists.return_value = True
+        cmds = ctrl_network('plugged', 'default', config)
+        self.assertEqual(len(cmds), 2)
+
+        cmds = ctrl_network('unplugged', 'default', config)
+        self.assertEqual(cmds, [
+            'ipset -exist del libvirt-hook-nets 192.168.122.0/24'])
+
+
+    def test_is_handled(self):
+        self.assertTrue(is_handled(['/etc/libvirt/hooks/qemu', 'test',
+                                    'start', 'begin', '-']))
+        self.assertTrue(is_handled(['network', 'default', 'plugged']))
+        self.assertFalse(is_handled(['/etc/libvirt/hooks/qemu', 'test',
+                                     'prepare', 'begin', '-']))
+        self.assertFalse(is_handled(['/etc/libvirt/hooks/daemon', '-',
+                                     'start', '-', 'shutdown']))
+        self.assertFalse(is_handled(['qemu']))
+
+    def test_iptables_capabilities(self):
+        probed = {'binary': '/bin/true', 'variant': 'nft', 'version': '1.8.7',
+                  'wait': True, 'wait_seconds': True, 'restore_wait': True,
+                  'noflush': True}
+        with tempfile.TemporaryDirectory() as run_path, \
+                mock.patch('hooks.IPTABLES_BINARY', '/bin/true'), \
+                mock.patch('hooks.RUN_PATH', run_path), \
+                mock.patch('hooks.CAPABILITIES_FILENAME',
+                           os.path.join(run_path, 'iptables.json')), \
+                mock.patch('hooks.probe_iptables',
+                           return_value=probed) as probe:
+            with mock.patch('hooks.CAPABILITIES', {}):
+                self.assertTrue(iptables_capabilities()['noflush'])
+            # A new process reads the capabilities from the disk cache.
+            with mock.patch('hooks.CAPABILITIES', {}):
+                self.assertEqual(iptables_capabilities()['variant'], 'nft')
+            probe.assert_called_once()
+
+    @mock.patch('hooks.restore_stream', return_value=True)
+    @mock.patch('hooks.iptables_capabilities',
+                return_value={'noflush': True})
+    def test_apply_fragment(self, capabilities, restore_stream):
+        config = dict(self.config, backend='iptables-restore')
+        filename = os.path.join(self.run_path.name, 'config.json')
+        compile_fragments(config, filename)
+        with mock.patch('hooks.CONFIG_FILENAME', filename):
+            self.assertTrue(apply_fragment('qemu', 'test', 'start', config))
+            self.assertEqual(restore_stream.call_args[0][0].split('\n')[:2],
+                             ['*nat', '-I PREROUTING -p tcp -d 192.168.0.166 '
+                              '--dport 2222 -j DNAT --to-destination '
+                              '192.168.122.2:22'])
+            # The ledger is the one of the rules built by the hook.
+            self.assertEqual(read_ledger('test'), machine_rules(
+                'start', 'test', config['machines']['test'], config))
+
+            # Reconnects and starts over recorded rules are built.
+            self.assertFalse(apply_fragment('qemu', 'test', 'reconnect',
+                                            config))
+            self.assertFalse(apply_fragment('qemu', 'test', 'start', config))
+            self.assertTrue(apply_fragment('qemu', 'test', 'stopped', config))
+            self.assertIsNone(read_ledger('test'))
+            self.assertTrue(apply_fragment('network', 'default', 'plugged',
+                                           config))
+
+            # Stale fragments are not used.
+            changed = json.loads(json.dumps(config))
+            changed['machines']['test']['port_map'].pop()
+            self.assertFalse(apply_fragment('qemu', 'test', 'start',
+                                            changed))
+            self.assertFalse(apply_fragment('qemu', 'test', 'start',
+                                            dict(config, backend='iptables')))
+            self.assertFalse(apply_fragment('qemu', 'other', 'start',
+                                            config))
+
+    @mock.patch('hooks.wait_args', return_value=[])
+    @mock.patch('time.sleep')
+    @mock.patch('subprocess.Popen')
+    def test_execute(self, popen, sleep, wait_args_function):
+        popen.return_value.communicate.return_value = (
+            b'Another app is currently holding the xtables lock.', None)
+        popen.return_value.returncode = 4
+        with mock.patch.dict(PHASES, clear=True), \
+                mock.patch.dict(COUNTS, clear=True):
+            self.assertEqual(execute(['iptables', '-L'])[0], 4)
+            # Run again three times, with a growing delay.
+            self.assertEqual(COUNTS, {'forks': 4, 'lock_retries': 3})
+            self.assertIn('lock_wait', PHASES)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list],
+                         [0.1, 0.2, 0.4])
+
+        # Other failures are not run again.
+        popen.reset_mock()
+        popen.return_value.communicate.return_value = (b'Bad rule', None)
+        popen.return_value.returncode = 2
+        self.assertEqual(execute(['iptables', '-L']), (2, 'Bad rule'))
+        popen.assert_called_once()
+
+    def test_wait_args(self):
+        capabilities = {'wait': True, 'wait_seconds': True,
+                        'restore_wait': False}
+        with mock.patch('hooks.iptables_capabilities',
+                        return_value=capabilities):
+            self.assertEqual(wait_args(IPTABLES_BINARY), ['-w', '5'])
+            self.assertEqual(wait_args(IPTABLES_RESTORE_BINARY), [])
+            self.assertEqual(wait_args('ipset'), [])
+        with mock.patch('hooks.iptables_capabilities', side_effect=OSError):
+            self.assertEqual(wait_args(IPTABLES_BINARY), [])
+
+    def test_apply_lock(self):
+        with mock.patch('hooks.LOCK_TIMEOUT', 0.05), \
+                mock.patch.dict(PHASES, clear=True), \
+                mock.patch('syslog.syslog') as log:
+            with apply_lock():
+                log.assert_not_called()
+                # A second holder gives up waiting, and goes ahead anyway.
+                with apply_lock():
+                    pass
+            log.assert_called_once()
+            self.assertGreaterEqual(PHASES['lock_wait'], 50)
+
+
+    def test_reconcile_rules(self):
+        saved = """# Generated by iptables-save
+*nat
+:PREROUTING ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:LVH-gone - [0:0]
+-A PREROUTING -d 192.168.0.166/32 -p tcp -m tcp --dport 2222 -j DNAT --to-destination 192.168.122.2:22
+-A PREROUTING -d 192.168.0.166/32 -p tcp -m tcp --dport 9999 -j DNAT --to-destination 192.168.122.9:22
+-A PREROUTING -d 10.0.0.1/32 -p tcp -m tcp --dport 80 -j DNAT --to-destination 10.0.0.2:80
+-A PREROUTING -d 192.168.0.166/32 -p tcp -j LVH-gone
+-A LVH-gone -p tcp -m tcp --dport 1234 -j DNAT --to-destination 192.168.122.7:22
+COMMIT
+*filter
+:FORWARD ACCEPT [0:0]
+-A FORWARD -d 192.168.122.0/24 -m state --state NEW,RELATED,ESTABLISHED -j ACCEPT
+-A FORWARD -d 10.1.0.0/24 -m state --state NEW,RELATED,ESTABLISHED -j ACCEPT
+-A FORWARD -d 192.168.122.0/24 -o virbr0 -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT
+COMMIT
+"""
+        desired = machine_rules('start', 'test', self.config['machines']['test'],
+                                self.config)
+        desired += network_rules('plugged', '192.168.122.0/24', self.config)
+        cmds = [' '.join(cmd) for cmd in
+                reconcile_rules(desired, parse_iptables_save(saved),
+                                self.config)]
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -t nat -D PREROUTING -d 192.168.0.166/32 -p tcp -m tcp --dport 9999 -j DNAT --to-destination 192.168.122.9:22',
+            IPTABLES_BINARY + ' -t nat -D PREROUTING -d 192.168.0.166/32 -p tcp -j LVH-gone',
+            IPTABLES_BINARY + ' -t filter -D FORWARD -d 10.1.0.0/24 -m state --state NEW,RELATED,ESTABLISHED -j ACCEPT',
+            IPTABLES_BINARY + ' -t nat -F LVH-gone',
+            IPTABLES_BINARY + ' -t nat -X LVH-gone',
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 8002 -j DNAT --to-destination 192.168.122.2:80'])
+
+        # Nothing to do once the rules are in place.
+        config = dict(self.config, machine_chains=True)
+        desired = machine_rules('start', 'test', config['machines']['test'],
+                                config)
+        saved = """*nat
+:PREROUTING ACCEPT [0:0]
+:LVH-test - [0:0]
+-A PREROUTING -d 192.168.0.166/32 -p tcp -j LVH-test
+-A LVH-test -p tcp -m tcp --dport 2222 -j DNAT --to-destination 192.168.122.2:22
+-A LVH-test -p tcp -m tcp --dport 8002 -j DNAT --to-destination 192.168.122.2:80
+COMMIT
+"""
+        self.assertEqual(reconcile_rules(desired, parse_iptables_save(saved),
+                                         config), [])
+
+
+    @mock.patch('hooks.logged_call', return_value=True)
+    def test_ledger(self, logged_call_function):
+        config = json.loads(json.dumps(self.config))
+        ctrl_machine('start', 'test', config)
+        self.assertEqual(len(read_ledger('test')), 2)
+
+        # Edit the port map while the machine runs, reconnect only applies
+        # the difference.
+        config['machines']['test']['port_map'] = [['2222', '22'],
+                                                  ['8443', '443']]
+        cmds = ctrl_machine('reconnect', 'test', config)
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -t nat -D PREROUTING -p tcp -d 192.168.0.166 --dport 8002 -j DNAT --to-destination 192.168.122.2:80',
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 8443 -j DNAT --to-destination 192.168.122.2:443'])
+
+        # Tear down removes what was installed, even if the machine is gone
+        # from the configuration.
+        del config['machines']['test']
+        cmds = ctrl_machine('stopped', 'test', config)
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -t nat -D PREROUTING -p tcp -d 192.168.0.166 --dport 8443 -j DNAT --to-destination 192.168.122.2:443',
+            IPTABLES_BINARY + ' -t nat -D PREROUTING -p tcp -d 192.168.0.166 --dport 2222 -j DNAT --to-destination 192.168.122.2:22'])
+        self.assertIsNone(read_ledger('test'))
+
+    @mock.patch('hooks.restore_call', return_value=True)
+    @mock.patch('hooks.iptables_capabilities',
+                return_value={'noflush': True})
+    def test_ledger_reload(self, capabilities, restore_call):
+        config = dict(json.loads(json.dumps(self.config)),
+                      backend='iptables-restore')
+        saved = mock.Mock(returncode=0, stdout=b"""*nat
+:PREROUTING ACCEPT [0:0]
+-A PREROUTING -d 192.168.0.166/32 -p tcp -m tcp --dport 8002 -j DNAT --to-destination 192.168.122.2:80
+COMMIT
+""")
+        with mock.patch('hooks.subprocess.run', return_value=saved) as run:
+            ctrl_machine('start', 'test', config)
+            ctrl_machine('stopped', 'test', config)
+            ctrl_machine('start', 'test', config)
+            # The firewall is only read when removing the rules fails.
+            run.assert_not_called()
+
+            # A firewall reload removed one of the rules, it is not removed
+            # again.
+            restore_call.side_effect = [False, True]
+            cmds = ctrl_machine('start', 'test', config)
+            run.assert_called_once()
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -t nat -D PREROUTING -p tcp -d 192.168.0.166 --dport 8002 -j DNAT --to-destination 192.168.122.2:80',
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 2222 -j DNAT --to-destination 192.168.122.2:22',
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 8002 -j DNAT --to-destination 192.168.122.2:80'])
+        self.assertEqual(len(read_ledger('test')), 2)
+
+        # After a failure the ledger holds the rules that are installed.
+        restore_call.side_effect = None
+        restore_call.return_value = False
+        with mock.patch('hooks.subprocess.run', return_value=saved):
+            ctrl_machine('start', 'test', config)
+        self.assertEqual(len(read_ledger('test')), 1)
+
+    @mock.patch('hooks.logged_call', return_value=True)
+    def test_ledger_chains(self, logged_call_function):
+        config = dict(self.config, machine_chains=True)
+        ctrl_machine('start', 'test', config)
+        cmds = ctrl_machine('stopped', 'test', config)
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -t nat -D PREROUTING -p tcp -d 192.168.0.166 -j LVH-test',
+            IPTABLES_BINARY + ' -t nat -F LVH-test',
+            IPTABLES_BINARY + ' -t nat -X LVH-test'])
+
+    @mock.patch('hooks.subprocess.Popen')
+    def test_ledger_nft(self, popen):
+        popen.return_value.communicate.return_value = (b'', None)
+        popen.return_value.returncode = 0
+        config = dict(self.config, backend='nft')
+        ctrl_machine('start', 'test', config)
+        with mock.patch('hooks.subprocess.run') as run:
+            cmds = ctrl_machine('stopped', 'test', config)
+            run.assert_not_called()
+        self.assertEqual(cmds, [
+            'nft delete element ip libvirt_hook dnat { 192.168.0.166 . tcp . 8002 }',
+            'nft delete element ip libvirt_hook dnat { 192.168.0.166 . tcp . 2222 }'])
+        # One nft batch per event.
+        self.assertEqual(popen.call_count, 2)
+
+        # A flush removed one of the elements, the map is listed once.
+        ctrl_machine('start', 'test', config)
+        popen.return_value.returncode = 1
+        listed = mock.Mock(returncode=0, stdout=json.dumps({'nftables': [
+            {'metainfo': {}},
+            {'map': {'family': 'ip', 'name': 'dnat', 'table': 'libvirt_hook',
+                     'elem': [[{'concat': ['192.168.0.166', 'tcp', 2222]},
+                               {'concat': ['192.168.122.2', 22]}]]}}]}
+        ).encode('utf-8'))
+        with mock.patch('hooks.subprocess.run', return_value=listed) as run:
+            popen.side_effect = [popen.return_value, mock.Mock(
+                returncode=0, **{'communicate.return_value': (b'', None)})]
+            cmds = ctrl_machine('stopped', 'test', config)
+            run.assert_called_once()
+        self.assertEqual(cmds, [
+            'nft delete element ip libvirt_hook dnat { 192.168.0.166 . tcp . 2222 }'])
+        self.assertIsNone(read_ledger('test'))
+
+
+    @mock.patch('hooks.logged_call', side_effect=dummy_func)
+    def test_port_range(self, logged_call_function):
+        config = json.loads(json.dumps(self.config))
+        config['machines']['test']['port_map'] = [
+            ['27000-27100', '27000-27100'], ['28000-28002', '27000-27002']]
+        cmds = ctrl_machine('start', 'test', config)
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 27000:27100 -j DNAT --to-destination 192.168.122.2:27000-27100',
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 28000:28002 -j DNAT --to-destination 192.168.122.2:27000-27002/28000'])
+
+        config['backend'] = 'nft'
+        config['machines']['test']['port_map'] = [['28000-28001',
+                                                   '27000-27001']]
+        cmds = machine_rules('start', 'test', config['machines']['test'],
+                             config)
+        self.assertEqual(' '.join(cmds[0]),
+                         'nft add element ip libvirt_hook dnat { 192.168.0.166 . tcp . 28000 : 192.168.122.2 . 27000 , 192.168.0.166 . tcp . 28001 : 192.168.122.2 . 27001 }')
+
+
+    @mock.patch('hooks.logged_call', return_value=True)
+    def test_multiport(self, logged_call_function):
+        config = json.loads(json.dumps(self.config))
+        config['multiport'] = True
+        port_map = [[str(port), str(port)] for port in range(8000, 8016)]
+        config['machines']['test']['port_map'] += port_map
+        cmds = ctrl_machine('start', 'test', config)
+        self.assertEqual(cmds, [
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 2222 -j DNAT --to-destination 192.168.122.2:22',
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 8002 -j DNAT --to-destination 192.168.122.2:80',
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 -m multiport --dports ' +
+            ','.join(str(port) for port in range(8000, 8015)) + ' -j DNAT --to-destination 192.168.122.2',
+            IPTABLES_BINARY + ' -t nat -I PREROUTING -p tcp -d 192.168.0.166 -m multiport --dports 8015 -j DNAT --to-destination 192.168.122.2'])
+
+        # Tear down removes the same grouped rules.
+        cmds = ctrl_machine('stopped', 'test', config)
+        self.assertEqual(len(cmds), 4)
+        self.assertIn('-D PREROUTING -p tcp -d 192.168.0.166 -m multiport '
+                      '--dports 8015', cmds[0])
+
+        # Also when the tear down is computed from the configuration.
+        cmds = machine_rules('stopped', 'test', config['machines']['test'],
+                             config)
+        self.assertEqual(len(cmds), 4)
+
+    def test_timings(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bench = Bench(tmp_dir)
+            bench.write_config(json.loads(TEST_CONFIG))
+            profile_path = os.path.join(tmp_dir, 'profile')
+            os.mkdir(profile_path)
+            bench.env['PROFILE_PATH'] = profile_path
+            bench.run_hook('qemu', 'test', 'start')
+            with open(bench.env['TIMINGS_FILENAME'], 'r') as timings_file:
+                record = json.loads(timings_file.read())
+            self.assertEqual(os.listdir(profile_path),
+                             ['qemu-test-start-{}.prof'.format(
+                                 record['pid'])])
+
+        self.assertEqual((record['hook'], record['object'], record['action']),
+                         ('qemu', 'test', 'start'))
+        self.assertEqual(set(record['phases']),
+                         {'daemon', 'load', 'parse', 'startup', 'rules',
+                          'lock_wait', 'apply', 'exec', 'total'})
+        self.assertEqual(record['counts'], {'rules': 2, 'forks': 2})
+        self.assertLessEqual(record['phases']['exec'],
+                             record['phases']['apply'])
+
+    def test_invalid_entry(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bench = Bench(tmp_dir)
+            config = json.loads(TEST_CONFIG)
+            config['machines']['test']['private_ip'] = '192.168.122.300'
+            bench.write_config(config)
+            # The hook succeeds without running the firewall.
+            wall, forks, rss, load = bench.run_hook('qemu', 'test', 'start')
+        self.assertEqual(forks, 0)
+
+    @mock.patch('hooks.execute', return_value=(0, ''))
+    @mock.patch('hooks.iptables_capabilities',
+                return_value={'noflush': True})
+    @mock.patch('hooks.syslog.syslog')
+    def test_transaction_log(self, log, capabilities, execute_function):
+        # Stores written without --debug have no debug value.
+        for backend in ['iptables-restore', 'nft']:
+            config = json.loads(TEST_CONFIG)
+            del config['debug']
+            config['backend'] = backend
+            ctrl_machine('start', 'test', config)
+            ctrl_machine('stopped', 'test', config)
+        self.assertEqual(execute_function.call_count, 4)
+
+        # One record per event, also at debug level.
+        log.reset_mock()
+        config['debug'] = True
+        ctrl_machine('start', 'test', config)
+        self.assertEqual(log.call_count, 1)
+
+    @mock.patch('hooks.logged_call', return_value=True)
+    @mock.patch('hooks.syslog.syslog')
+    def test_log_summary(self, log, logged_call_function):
+        config = json.loads(TEST_CONFIG)
+        config['machines']['test']['port_map'] = [
+            [str(port), '22'] for port in range(2000, 2500)]
+        ctrl_machine('start', 'test', config)
+        # One record for the event, without the rules.
+        self.assertEqual(log.call_count, 1)
+        priority, message = log.call_args[0]
+        self.assertEqual(priority, syslog.LOG_INFO)
+        self.assertEqual(message, 'Start test: 500 rules for 500 port '
+                                  'mappings')
+
+        # Everything at debug level, still in one record.
+        log.reset_mock()
+        config['debug'] = True
+        ctrl_machine('stopped', 'test', config)
+        self.assertEqual(log.call_count, 1)
+        priority, message = log.call_args[0]
+        self.assertEqual(priority, syslog.LOG_INFO)
+        lines = message.split('\n')
+        self.assertEqual(len(lines), 1 + 500 + 500)
+        self.assertEqual(lines[1], '192.168.0.166:2000 -> 192.168.122.2:22')
+        self.assertTrue(lines[-1].startswith('iptables -t nat -D'))
+
+        # Nothing below the log level.
+        log.reset_mock()
+        config['debug'] = False
+        config['log_level'] = 'warning'
+        ctrl_network('plugged', 'default', config)
+        log.assert_not_called()
+
+        # Failures are errors.
+        logged_call_function.return_value = False
+        ctrl_network('unplugged', 'default', config)
+        self.assertEqual(log.call_args[0], (
+            syslog.LOG_ERR, 'Unplugged network default (192.168.122.0/24): '
+                            '1 rules, failed'))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+"""
+Libvirt port-forwarding hook scale benchmark unit tests.
+
+0.0.1:
+======
+
+ * Synthetic configurations, comparison and a small run.
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from hookbench import synthetic_config, compare
+
+
+class HookBenchTestCase(unittest.TestCase):
+
+    def test_synthetic_config(self):
+        config = synthetic_config(3, 2, 2)
+        self.assertEqual(config['machines']['vm2'], {
+            'private_ip': '10.0.0.3', 'port_map': [[1028, 22], [1029, 23]]})
+        self.assertEqual(config['networks'], {'net0': '172.16.0.0/24',
+                                              'net1': '172.16.1.0/24'})
+
+    def test_compare(self):
+        def results(wall):
+            return {'results': [{'case': 'hook_machine', 'machines': 10,
+                                 'ports': 1, 'networks': 0,
+                                 'backend': 'iptables', 'wall_ms': wall}]}
+
+        self.assertFalse(compare(results(100), results(110), 0.2)[0][3])
+        self.assertTrue(compare(results(100), results(130), 0.2)[0][3])
+        # Too small to tell.
+        self.assertFalse(compare(results(0.5), results(1.0), 0.2)[0][3])
+        self.assertEqual(compare(results(100), {'results': []}, 0.2), [])
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'bench.json')
+            subprocess.run([sys.executable,
+                            os.path.join(os.path.dirname(
+                                os.path.abspath(__file__)), 'hookbench.py'),
+                            '--machines', '2', '--ports', '1,3',
+                            '--networks', '2', '--repeat', '1', '--output',
+                            output], check=True, stdout=subprocess.DEVNULL)
+            with open(output, 'r') as results_file:
+                results = json.load(results_file)
+
+        self.assertEqual([result['case'] for result in results['results']],
+                         ['hook_cold', 'hook_machine', 'hook_network',
+                          'ctrl_machine', 'hookctrl'] * 2)
+        forks = {(result['case'], result['ports']): result['forks'] for
+                 result in results['results']}
+        # One iptables call per rule. The first run also probes iptables for
+        # the -w option.
+        self.assertEqual(forks[('hook_cold', 3)], 5)
+        # Starts follow stops, with no rules to remove first.
+        self.assertEqual(forks[('hook_machine', 3)], 3)
+        self.assertEqual(forks[('ctrl_machine', 3)], 3)
+        self.assertEqual(forks[('hook_network', 3)], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
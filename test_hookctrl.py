@@ -8,12 +8,24 @@ Libvirt port-forwarding hook control utility unit tests.
 """
 
 import argparse
+import io
 import json
 import imp
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest import mock
 from hookctrl import str2bool, create_argparser, check_args, add_machine, \
     remove_machine, add_network, remove_network, add_port, remove_port, \
-    process_config, ConfigError
+    process_config, process_store, reconcile, ConfigError, ConfigIndex, \
+    read_batch, process_batch, process_store_batch, BatchError, hot_apply, \
+    machines_snapshot, plan, write_plan, compile_fragments, edited_entries, \
+    virsh_probe
+from hookmodel import build_models
+from hooksqlconf import HookSQLConfig
+import hooks
 
 
 class HookCTRLTestCase(unittest.TestCase):
@@ -450,6 +462,460 @@ class HookCTRLTestCase(unittest.TestCase):
                                 )
         self.assertListEqual([], config['machines']['test']['port_map'])
 
+    def test_process_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = HookSQLConfig(os.path.join(tmp_dir, 'config.db'))
+            store.import_config(self.base_config())
+            arg_parser = create_argparser()
+
+            def parse_args(argv):
+                args = arg_parser.parse_args(argv)
+                check_args(args)
+                return args
+
+            process_store(store, parse_args(
+                ['--cmd', 'add_machine', '--name', 'test', '--private_ip',
+                 '1.1.1.1']))
+            process_store(store, parse_args(
+                ['--cmd', 'add_port', '--name', 'test', '--public_port',
+                 '8080', '--vm-port', '80']))
+            self.assertEqual(store.export_config()['machines'],
+                             {'test': {'private_ip': '1.1.1.1',
+                                       'port_map': [[8080, 80]]}})
+
+            with self.assertRaises(ConfigError):
+                process_store(store, parse_args(
+                    ['--cmd', 'add_machine', '--name', 'test',
+                     '--private_ip', '1.1.1.2']))
+            with self.assertRaises(ConfigError):
+                process_store(store, parse_args(
+                    ['--cmd', 'add_port', '--name', 'test',
+                     '--public_port', '8080', '--vm-port', '81']))
+            with self.assertRaises(ConfigError):
+                process_store(store, parse_args(
+                    ['--cmd', 'remove_port', '--name', 'test',
+                     '--public_port', '8081', '--vm-port', '80']))
+            with self.assertRaises(ConfigError):
+                process_store(store, parse_args(
+                    ['--cmd', 'add_machine', '--name', 'other',
+                     '--private_ip', '1.1.1.1']))
+            process_store(store, parse_args(
+                ['--cmd', 'add_network', '--name', 'lan', '--network',
+                 '10.0.0.0/16']))
+            with self.assertRaises(ConfigError):
+                process_store(store, parse_args(
+                    ['--cmd', 'add_network', '--name', 'other',
+                     '--network', '10.0.1.0/24']))
+            self.assertIsNone(store.network('other'))
+
+            process_store(store, parse_args(
+                ['--cmd', 'remove_port', '--name', 'test', '--public_port',
+                 '8080', '--vm-port', '80']))
+            self.assertEqual(store.machine('test')['port_map'], [])
+            store.close()
+
+
+    @mock.patch('hookctrl.subprocess.run')
+    def test_virsh_probe(self, run):
+        def virsh(args, **kwargs):
+            if 'lxc:///' in args:
+                return mock.Mock(stdout=b'container\n\n')
+            return mock.Mock(stdout=b'vm\n\n')
+
+        run.side_effect = virsh
+        self.assertEqual(virsh_probe('machine'), {'vm', 'container'})
+        self.assertEqual(virsh_probe('network'), {'vm'})
+        self.assertEqual(run.call_count, 3)
+
+        # Without the LXC driver only the QEMU domains are running.
+        def no_lxc(args, **kwargs):
+            if 'lxc:///' in args:
+                raise subprocess.CalledProcessError(1, args)
+            return mock.Mock(stdout=b'vm\n')
+
+        run.side_effect = no_lxc
+        self.assertEqual(virsh_probe('machine'), {'vm'})
+
+    @mock.patch('hooks.apply_rules', return_value=True)
+    @mock.patch('hookctrl.subprocess.run')
+    def test_reconcile_models(self, run, apply_rules):
+        config = self.base_config()
+        config['public_ip'] = '192.168.0.166'
+        config = add_machine(config, 'running', '192.168.122.2')
+        config['machines']['running']['port_map'] = [['022', '22']]
+        config['networks']['default'] = '192.168.122.1/24'
+
+        def probe(kind):
+            return {'running'} if kind == 'machine' else {'default'}
+
+        # The rules as the hook installs them, from the models.
+        models = build_models(config)
+        installed = hooks.machine_rules(
+            'start', 'running', models['machines']['running'], models) + \
+            hooks.network_rules('plugged', models['networks']['default'],
+                                models, check=False)
+        run.return_value.stdout = hooks.restore_payload(installed).replace(
+            '-I ', '-A ').encode('utf-8')
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch('hooks.LEDGER_PATH', tmp_dir):
+            # Nothing to do, and the ledger is the one of the hook.
+            self.assertEqual(reconcile(config, probe), [])
+            self.assertEqual(hooks.read_ledger('running'), hooks.machine_rules(
+                'start', 'running', models['machines']['running'], models))
+
+        config['machines']['running']['private_ip'] = '192.168.122.300'
+        with self.assertRaises(ConfigError):
+            reconcile(config, probe)
+
+    @mock.patch('hooks.apply_rules', return_value=True)
+    @mock.patch('hookctrl.subprocess.run')
+    def test_reconcile(self, run, apply_rules):
+        config = self.base_config()
+        config['public_ip'] = '192.168.0.166'
+        config = add_machine(config, 'running', '192.168.122.2')
+        config = add_port(config, 'running', 2222, 22)
+        config = add_machine(config, 'stopped', '192.168.122.3')
+        config = add_port(config, 'stopped', 2223, 22)
+        # The firewall was flushed.
+        run.return_value.stdout = b'*nat\n:PREROUTING ACCEPT [0:0]\nCOMMIT\n'
+
+        def probe(kind):
+            return {'running'} if kind == 'machine' else set()
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch('hooks.LEDGER_PATH', tmp_dir):
+            hooks.write_ledger('running', [['iptables', '-I', 'FORWARD']])
+            hooks.write_ledger('stopped', [['iptables', '-I', 'FORWARD']])
+            cmds = reconcile(config, probe)
+            # The ledgers follow the reconciled rules.
+            self.assertEqual(hooks.read_ledger('running'), cmds)
+            self.assertIsNone(hooks.read_ledger('stopped'))
+        self.assertEqual(len(cmds), 1)
+        self.assertIn('2222', cmds[0])
+        # Applied in one transaction.
+        apply_rules.assert_called_once()
+        self.assertEqual(apply_rules.call_args[0][1]['backend'],
+                         'iptables-restore')
+
+    @mock.patch('hooks.apply_rules', return_value=True)
+    def test_hot_apply(self, apply_rules):
+        config = self.base_config()
+        config['public_ip'] = '192.168.0.166'
+        config = add_machine(config, 'running', '192.168.122.2')
+        config = add_port(config, 'running', 2222, 22)
+        config = add_machine(config, 'stopped', '192.168.122.3')
+
+        def probe(kind):
+            return {'running'} if kind == 'machine' else set()
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch('hooks.LEDGER_PATH', tmp_dir):
+            # Without a ledger, the old configuration is taken as installed.
+            old_config = machines_snapshot(config, ['running', 'stopped'])
+            config = add_port(config, 'running', 8080, 80)
+            config = add_port(config, 'stopped', 8081, 80)
+            cmds = hot_apply(['running', 'stopped'], old_config, config,
+                             probe)
+            self.assertEqual([' '.join(cmd[1:]) for cmd in cmds], [
+                '-t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 8080 '
+                '-j DNAT --to-destination 192.168.122.2:80'])
+            apply_rules.assert_called_once()
+
+            # Only the removed mapping is deleted, as recorded in the ledger.
+            old_config = machines_snapshot(config, ['running'])
+            config = remove_port(config, 'running', 2222, 22)
+            cmds = hot_apply(['running'], old_config, config, probe)
+            self.assertEqual([' '.join(cmd[1:]) for cmd in cmds], [
+                '-t nat -D PREROUTING -p tcp -d 192.168.0.166 --dport 2222 '
+                '-j DNAT --to-destination 192.168.122.2:22'])
+
+            # Nothing to do if nothing changed.
+            self.assertEqual(hot_apply(['running'], config, config, probe),
+                             [])
+
+            old_config = machines_snapshot(config, ['running'])
+            config = remove_machine(config, 'running')
+            cmds = hot_apply(['running'], old_config, config, probe)
+            self.assertEqual([' '.join(cmd[1:]) for cmd in cmds], [
+                '-t nat -D PREROUTING -p tcp -d 192.168.0.166 --dport 8080 '
+                '-j DNAT --to-destination 192.168.122.2:80'])
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+            # A failure is reported.
+            apply_rules.return_value = False
+            config = add_machine(config, 'running', '192.168.122.2')
+            config = add_port(config, 'running', 2222, 22)
+            with self.assertRaises(ConfigError):
+                hot_apply(['running'], self.base_config(), config, probe)
+    @mock.patch('hooks.subprocess')
+    def test_plan(self, subprocess):
+        config = self.base_config()
+        config['public_ip'] = '192.168.0.166'
+        config['network_ipset'] = True
+        config = add_machine(config, 'web', '192.168.122.2')
+        config = add_port(config, 'web', 8080, 80)
+        config = add_port(config, 'web', 8443, 443)
+        config = add_network(config, 'default', '192.168.122.0/24')
+        config = add_network(config, 'other', '192.168.123.0/24')
+
+        output = io.StringIO()
+        self.assertEqual(write_plan(plan(config, '', 'restore'), output,
+                                    'restore'), 6)
+        lines = output.getvalue().split('\n')
+        self.assertEqual(lines[0], '*nat')
+        self.assertEqual(lines[1], '-I PREROUTING -p tcp -d 192.168.0.166 '
+                                   '--dport 8080 -j DNAT --to-destination '
+                                   '192.168.122.2:80')
+        # The set and its rule are created once, for all the networks.
+        self.assertEqual(lines[3:6], ['COMMIT',
+                                      '# ipset -exist create '
+                                      'libvirt-hook-nets hash:net',
+                                      '# ipset -exist add libvirt-hook-nets '
+                                      '192.168.122.0/24'])
+        self.assertEqual(lines[6:], ['*filter', '-I FORWARD -m set '
+                                     '--match-set libvirt-hook-nets dst -m '
+                                     'conntrack --ctstate '
+                                     'NEW,RELATED,ESTABLISHED -j ACCEPT',
+                                     'COMMIT', '# ipset -exist add '
+                                     'libvirt-hook-nets 192.168.123.0/24',
+                                     ''])
+
+        output = io.StringIO()
+        write_plan(plan(config, 'web', 'nft'), output, 'nft')
+        lines = output.getvalue().split('\n')
+        self.assertEqual(lines[0], 'add table ip libvirt_hook')
+        self.assertEqual(lines[-2], 'add element ip libvirt_hook dnat { '
+                                    '192.168.0.166 . tcp . 8443 : '
+                                    '192.168.122.2 . 443 }')
+
+        output = io.StringIO()
+        self.assertEqual(write_plan(plan(config, 'default', 'jsonl'), output,
+                                    'jsonl'), 3)
+        records = [json.loads(line) for line in
+                   output.getvalue().splitlines()]
+        self.assertEqual(records[0]['kind'], 'network')
+        self.assertEqual(records[0]['name'], 'default')
+        self.assertEqual(records[0]['cmd'][1:], [
+            '-exist', 'create', 'libvirt-hook-nets', 'hash:net'])
+
+        with self.assertRaises(ConfigError):
+            plan(config, 'missing', 'restore')
+        # Nothing is run.
+        self.assertEqual(subprocess.mock_calls, [])
+
+    def test_port_ranges(self):
+        arg_parser = create_argparser()
+        args = arg_parser.parse_args(
+            ['--cmd', 'add_port', '--name', 'test', '--public_port',
+             '27000-27100', '--vm-port', '27000-27100'])
+        self.assertEqual(check_args(args), True)
+        self.assertEqual(args.public_port, '27000-27100')
+
+        for public_port, vm_port in [('27000-27100', '27000-27099'),
+                                     ('27100-27000', '27100-27000'),
+                                     ('27000-70000', '27000-70000'),
+                                     ('27000-', '27000-'),
+                                     ('80', '80-81')]:
+            args = arg_parser.parse_args(
+                ['--cmd', 'add_port', '--name', 'test', '--public_port',
+                 public_port, '--vm-port', vm_port])
+            with self.assertRaises(argparse.ArgumentTypeError):
+                check_args(args)
+
+        def add(config, name, public_port, vm_port):
+            return process_config(config, args=type(
+                'config', (object,), {'cmd': 'add_port', 'name': name,
+                                      'public_port': public_port,
+                                      'vm_port': vm_port}))
+
+        config = add_machine(self.base_config(), 'test', '1.1.1.1')
+        config = add_machine(config, 'other', '1.1.1.2')
+        config = add(config, 'test', '27000-27100', '27000-27100')
+        config = add(config, 'test', 8080, 80)
+        config = add(config, 'other', '27101-27200', '27101-27200')
+        # Overlaps with mappings of the same or another machine.
+        for port in [27000, 27100, '26000-27000', '27050-27150', 8080,
+                     '8000-9000']:
+            with self.assertRaises(ConfigError):
+                add(config, 'other', port, port)
+        config = add(config, 'other', 26999, 26999)
+
+    def test_config_index(self):
+        def process(config, index, **kwargs):
+            return process_config(config, args=type('config', (object,),
+                                                    kwargs), index=index)
+
+        config = add_machine(self.base_config(), 'test', '1.1.1.1')
+        config = add_port(config, 'test', 8080, 80)
+        config = add_port(config, 'test', '27000-27100', '27000-27100')
+        config = add_network(config, 'net', '1.1.1.0/24')
+        index = ConfigIndex(config)
+        self.assertEqual(index.port_owner(27050)[2], 'test')
+        self.assertIsNone(index.port_owner(8081))
+        self.assertEqual(index.private_ips['1.1.1.1'], 'test')
+        self.assertEqual(index.network_owner('1.1.1.128/25')[2], 'net')
+        self.assertIsNone(index.network_owner('fd00::/64'))
+
+        # Collisions with other entries.
+        with self.assertRaises(ConfigError):
+            process(config, index, cmd='add_machine', name='other',
+                    private_ip='1.1.1.1')
+        with self.assertRaises(ConfigError):
+            process(config, index, cmd='add_network', name='other',
+                    network='1.1.0.0/16')
+
+        # The index follows the changes.
+        config = process(config, index, cmd='add_machine', name='other',
+                         private_ip='1.1.1.2')
+        config = process(config, index, cmd='add_port', name='other',
+                         public_port=8081, vm_port=80)
+        self.assertEqual(index.port_owner(8081)[2], 'other')
+        # Ports given as strings find mappings stored as integers.
+        config = process(config, index, cmd='remove_port', name='test',
+                         public_port='8080', vm_port='80')
+        self.assertEqual(config['machines']['test']['port_map'],
+                         [['27000-27100', '27000-27100']])
+        self.assertIsNone(index.port_owner(8080))
+        config = process(config, index, cmd='remove_machine', name='test')
+        self.assertIsNone(index.port_owner(27050))
+        self.assertNotIn('1.1.1.1', index.private_ips)
+        config = process(config, index, cmd='add_port', name='other',
+                         public_port=27050, vm_port=27050)
+        config = process(config, index, cmd='remove_network', name='net')
+        config = process(config, index, cmd='add_network', name='other',
+                         network='1.1.0.0/16')
+        self.assertEqual(index.network_owner('1.1.1.1/32')[2], 'other')
+
+    def test_batch(self):
+        batch = [
+            '{"cmd": "add_machine", "name": "web", "private_ip": "10.0.0.2"}',
+            '{"cmd": "add_port", "name": "web", "public_port": 8080, '
+            '"vm_port": 80}',
+            '',
+            '# Comment',
+            '{"cmd": "add_port", "name": "web", "public_port": "27000-27010", '
+            '"vm_port": "27000-27010"}',
+        ]
+        config = self.base_config()
+        self.assertEqual(process_batch(config, read_batch(batch)), 3)
+        self.assertEqual(config['machines']['web']['port_map'],
+                         [[8080, 80], ['27000-27010', '27000-27010']])
+
+        # CSV with a header line.
+        batch = ['cmd,name,private_ip,public_port,vm_port',
+                 'add_machine,db,10.0.0.3,,',
+                 'add_port,db,,5432,5432',
+                 'remove_port,web,,8080,80']
+        self.assertEqual(process_batch(config, read_batch(batch)), 3)
+        self.assertEqual(config['machines']['db']['port_map'],
+                         [[5432, 5432]])
+        self.assertEqual(config['machines']['web']['port_map'],
+                         [['27000-27010', '27000-27010']])
+
+        # Every bad line is reported.
+        batch = ['{"cmd": "add_machine", "name": "mail", '
+                 '"private_ip": "10.0.0.3"}',
+                 '{"cmd": "add_port", "name": "web", "public_port": 5432, '
+                 '"vm_port": 5432}',
+                 '{"cmd": "reconcile"}',
+                 '{"cmd": "add_port", "name": "web", "public_port": 1}',
+                 '{"cmd": "add_machine", "name": "mail", "color": "red"}',
+                 '{"cmd": ',
+                 '{"cmd": "add_machine", "name": "ok", '
+                 '"private_ip": "10.0.0.4"}']
+        with self.assertRaises(BatchError) as context:
+            process_batch(self.base_config(), read_batch(batch))
+        self.assertEqual([error.split(':')[0] for error in
+                          context.exception.errors],
+                         ['Line 2', 'Line 3', 'Line 4', 'Line 5', 'Line 6'])
+
+        # Nothing is stored if a line fails.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = HookSQLConfig(os.path.join(tmpdir, 'config.db'))
+            batch = ['cmd,name,private_ip,public_port,vm_port',
+                     'add_machine,web,10.0.0.2,,',
+                     'add_port,web,,8080,80',
+                     'add_port,web,,8080,81']
+            with self.assertRaises(BatchError):
+                process_store_batch(store, read_batch(batch))
+            self.assertIsNone(store.machine('web'))
+            self.assertEqual(process_store_batch(store,
+                                                 read_batch(batch[:3])), 2)
+            self.assertEqual(store.machine('web')['port_map'], [[8080,
+                                                                 80]])
+            store.close()
+
+        # A failed batch exits with an error status.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'config.json')
+            with open(filename, 'w') as config_file:
+                json.dump(self.base_config(), config_file)
+            process = subprocess.run(
+                [sys.executable, os.path.join(os.path.dirname(
+                    os.path.abspath(__file__)), 'hookctrl.py'), '--batch',
+                 '-'], input=b'{"cmd": "remove_machine", "name": "none"}\n',
+                stdout=subprocess.PIPE,
+                env=dict(os.environ, CONFIG_FILENAME=filename))
+            self.assertEqual(process.returncode, 1)
+            self.assertIn(b'Line 1', process.stdout)
+
+
+    def test_compile(self):
+        config = self.base_config()
+        config['public_ip'] = '192.168.0.166'
+        config['backend'] = 'iptables-restore'
+        config = add_machine(config, 'web', '192.168.122.2')
+        config = add_port(config, 'web', 8080, 80)
+        config = add_machine(config, 'idle', '192.168.122.3')
+        config = add_network(config, 'default', '192.168.122.0/24')
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'config.json')
+            # Machines without port mappings have no rules to compile.
+            self.assertEqual(compile_fragments(config, filename), 2)
+            self.assertEqual(sorted(os.listdir(filename + '.fragments')), [
+                'machine-web.ledger', 'machine-web.start',
+                'machine-web.stopped', 'network-default.plugged',
+                'network-default.unplugged'])
+            with open(os.path.join(filename + '.fragments',
+                                   'machine-web.start'), 'r') as start_file:
+                self.assertEqual(start_file.read().split('\n'), [
+                    '# ' + hooks.fragment_key('machine', 'web', config),
+                    '*nat', '-I PREROUTING -p tcp -d 192.168.0.166 --dport '
+                    '8080 -j DNAT --to-destination 192.168.122.2:80',
+                    'COMMIT', ''])
+
+            # Only the edited entries are compiled again.
+            args = create_argparser().parse_args(['--cmd', 'remove_machine',
+                                                  '--name', 'web'])
+            self.assertEqual(edited_entries(args), ({'web'}, set()))
+            config = process_config(config, args)
+            self.assertEqual(compile_fragments(config, filename,
+                                               *edited_entries(args)), 0)
+            self.assertEqual(len(os.listdir(filename + '.fragments')), 2)
+
+            # An invalid entry is not compiled, and does not stop the others.
+            config['machines']['broken'] = {'private_ip': '192.168.122.300',
+                                            'port_map': [[8081, 81]]}
+            config = add_machine(config, 'web', '192.168.122.2')
+            config = add_port(config, 'web', 8080, 80)
+            self.assertEqual(compile_fragments(config, filename, {'web'},
+                                               set()), 1)
+            self.assertEqual(compile_fragments(config, filename, {'broken'},
+                                               set()), 0)
+            config = process_config(config, args)
+            del config['machines']['broken']
+            compile_fragments(config, filename, {'web'}, set())
+            self.assertEqual(len(os.listdir(filename + '.fragments')), 2)
+
+            # Networks in an ipset are left to the hook.
+            config['network_ipset'] = True
+            self.assertEqual(compile_fragments(config, filename), 0)
+            self.assertEqual(os.listdir(filename + '.fragments'), [])
+            self.assertEqual(compile_fragments(dict(config, backend='nft'),
+                                               filename), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+"""
+Libvirt port-forwarding hook daemon unit tests.
+
+0.0.1:
+======
+
+ * Event handling, configuration reload and the UNIX socket client.
+ * Changes applied by the configuration watcher.
+
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+with patch.dict('os.environ', values={'IPTABLES_BINARY': 'iptables'}, clear=True):
+    import hooks
+    from hookdaemon import HookDaemon, merge_config
+
+
+TEST_CONFIG = {
+    'debug': False,
+    'machines': {
+        'test': {
+            'private_ip': '192.168.122.2',
+            'port_map': [['2222', '22']]
+        }
+    },
+    'networks': {
+        'default': '192.168.122.0/24'
+    },
+    'public_ip': '192.168.0.166'
+}
+
+
+@mock.patch('hooks.apply_rules')
+class HookDaemonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config_filename = os.path.join(self.tmp_dir.name, 'config.json')
+        self.write_config(TEST_CONFIG)
+        self.daemon = HookDaemon(self.config_filename)
+        self.ledger_path = patch('hooks.LEDGER_PATH', self.tmp_dir.name)
+        self.ledger_path.start()
+        self.apply_lock = patch('hooks.APPLY_LOCK_FILENAME',
+                                os.path.join(self.tmp_dir.name, 'apply.lock'))
+        self.apply_lock.start()
+
+    def tearDown(self):
+        self.apply_lock.stop()
+        self.ledger_path.stop()
+        self.tmp_dir.cleanup()
+
+    def write_config(self, config, mtime=0):
+        with open(self.config_filename, 'w') as json_file:
+            json.dump(config, json_file)
+        os.utime(self.config_filename, ns=(mtime, mtime))
+
+    def test_handle_event(self, apply_rules):
+        reply = self.daemon.handle_event('qemu', 'test', 'start')
+        self.assertEqual(reply['status'], 'ok')
+        self.assertEqual(reply['cmds'], [
+            'iptables -t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 2222 -j DNAT --to-destination 192.168.122.2:22'])
+        apply_rules.assert_called_once()
+
+        reply = self.daemon.handle_event('network', 'default', 'plugged')
+        self.assertEqual(reply['status'], 'ok')
+
+        # Unknown objects and actions are ignored, not fatal.
+        self.assertEqual(
+            self.daemon.handle_event('qemu', 'other', 'start')['status'],
+            'ignored')
+        self.assertEqual(
+            self.daemon.handle_event('qemu', 'test', 'prepare')['status'],
+            'ignored')
+
+    def test_apply_batch(self, apply_rules):
+        config = json.loads(json.dumps(TEST_CONFIG))
+        config['backend'] = 'nft'
+        config['machines']['other'] = {'private_ip': '192.168.122.3',
+                                       'port_map': [['2223', '22']]}
+        self.write_config(config)
+        self.daemon.reload()
+        events = [('qemu', 'test', 'start'), ('qemu', 'missing', 'start'),
+                  ('qemu', 'other', 'start')]
+
+        # One transaction for the whole batch.
+        apply_rules.return_value = True
+        replies = self.daemon.apply_batch(events)
+        apply_rules.assert_called_once()
+        self.assertEqual(len(apply_rules.call_args[0][0]), 2)
+        self.assertEqual([reply['status'] for reply in replies],
+                         ['ok', 'ignored', 'ok'])
+        self.assertEqual(replies[0]['batch_size'], 3)
+
+        # A failed batch is split, so each event gets its own result.
+        apply_rules.reset_mock()
+        apply_rules.side_effect = [False, True, False]
+        replies = self.daemon.apply_batch(events)
+        self.assertEqual(apply_rules.call_count, 3)
+        self.assertEqual([reply['status'] for reply in replies],
+                         ['ok', 'ignored', 'error'])
+
+    def test_apply_batch_tables(self, apply_rules):
+        config = dict(TEST_CONFIG, backend='iptables-restore')
+        config['machines'] = dict(config['machines'], other={
+            'private_ip': '192.168.122.3', 'port_map': [['2223', '22']]})
+        self.write_config(config)
+        self.daemon.reload()
+        apply_rules.return_value = True
+        replies = self.daemon.apply_batch([
+            ('qemu', 'test', 'start'), ('network', 'default', 'plugged'),
+            ('qemu', 'other', 'start')])
+        self.assertEqual([reply['status'] for reply in replies], ['ok'] * 3)
+        # A nat transaction for the machines, the filter table on its own,
+        # so that a failure does not leave part of the batch applied.
+        self.assertEqual([[hooks.restore_line(cmd)[0] for cmd in
+                           call[0][0]] for call in
+                          apply_rules.call_args_list],
+                         [['nat', 'nat'], ['filter']])
+
+    def test_aggregate(self, apply_rules):
+        apply_rules.return_value = True
+
+        async def storm():
+            self.daemon.queue = asyncio.Queue()
+            self.daemon.lock = asyncio.Lock()
+            aggregator = asyncio.get_running_loop().create_task(
+                self.daemon.aggregate())
+            futures = []
+            for action in ['start', 'stopped', 'start']:
+                future = asyncio.get_running_loop().create_future()
+                await self.daemon.queue.put((('qemu', 'test', action),
+                                             future))
+                futures.append(future)
+            replies = await asyncio.gather(*futures)
+            aggregator.cancel()
+            return replies
+
+        replies = asyncio.run(storm())
+        self.assertEqual([reply['batch_size'] for reply in replies],
+                         [3, 3, 3])
+        # Each event builds on the rules of the one before.
+        rule = ('-t nat {} PREROUTING -p tcp -d 192.168.0.166 --dport 2222 '
+                '-j DNAT --to-destination 192.168.122.2:22')
+        self.assertEqual([reply['cmds'] for reply in replies], [
+            ['iptables ' + rule.format('-I')],
+            ['iptables ' + rule.format('-D')],
+            ['iptables ' + rule.format('-I')]])
+        self.assertEqual(len(hooks.read_ledger('test')), 1)
+        self.assertEqual(self.daemon.batches, 1)
+
+    def test_reload(self, apply_rules):
+        self.daemon.handle_event('qemu', 'test', 'start')
+        changed = json.loads(json.dumps(TEST_CONFIG))
+        changed['machines']['test']['port_map'].append(['8002', '80'])
+        self.write_config(changed, mtime=1000000000)
+        # Only the new mapping is installed.
+        reply = self.daemon.handle_event('qemu', 'test', 'reconnect')
+        self.assertEqual(reply['cmds'], [
+            'iptables -t nat -I PREROUTING -p tcp -d 192.168.0.166 --dport 8002 -j DNAT --to-destination 192.168.122.2:80'])
+
+        # A broken configuration keeps the previous one.
+        with open(self.config_filename, 'w') as json_file:
+            json_file.write('{')
+        reply = self.daemon.handle_event('qemu', 'test', 'stopped')
+        self.assertEqual(reply['status'], 'ok')
+        self.assertEqual(len(self.daemon.config['machines']['test']
+                             ['port_map']), 2)
+
+    def changed_config(self):
+        config = json.loads(json.dumps(TEST_CONFIG))
+        config['machines']['test']['port_map'].append(['8002', '80'])
+        config['machines']['idle'] = {'private_ip': '192.168.122.3',
+                                      'port_map': [['2223', '22']]}
+        config['networks']['default'] = '192.168.123.0/24'
+        return config
+
+    def test_merge_config(self, apply_rules):
+        self.daemon.reload()
+        old_config = self.daemon.config
+        unchanged = old_config['machines']['test']
+        self.write_config(self.changed_config(), mtime=1000000000)
+        self.daemon.reload()
+        self.assertEqual(merge_config(old_config, self.daemon.config),
+                         ({'test', 'idle'}, {'default'}))
+
+        # Unchanged machines keep their models.
+        self.write_config(TEST_CONFIG, mtime=2000000000)
+        self.daemon.reload()
+        self.daemon.config['machines']['test'] = unchanged
+        old_config = self.daemon.config
+        config = json.loads(json.dumps(TEST_CONFIG))
+        config['networks']['other'] = '10.0.0.0/24'
+        self.write_config(config, mtime=3000000000)
+        self.daemon.reload()
+        self.assertEqual(merge_config(old_config, self.daemon.config),
+                         (set(), {'other'}))
+        self.assertIs(self.daemon.config['machines']['test'], unchanged)
+
+        # Global values change the rules of everything.
+        config['public_ip'] = '192.168.0.167'
+        self.write_config(config, mtime=4000000000)
+        old_config = self.daemon.reload()
+        self.assertEqual(merge_config(old_config, self.daemon.config),
+                         ({'test'}, {'default', 'other'}))
+
+    def test_apply_changes(self, apply_rules):
+        apply_rules.return_value = True
+        self.daemon.watching = True
+        self.daemon.handle_event('qemu', 'test', 'start')
+        apply_rules.reset_mock()
+        self.write_config(self.changed_config(), mtime=1000000000)
+        with mock.patch('hookdaemon.active_networks',
+                        return_value=set()) as active_networks:
+            self.daemon.refresh()
+        active_networks.assert_called_once()
+
+        # Only the new mapping of the running machine, the network is not
+        # active.
+        self.assertEqual([call[0][0] for call in apply_rules.call_args_list], [
+            [['iptables', '-t', 'nat', '-I', 'PREROUTING', '-p', 'tcp', '-d',
+              '192.168.0.166', '--dport', '8002', '-j', 'DNAT',
+              '--to-destination', '192.168.122.2:80']]])
+        self.assertEqual(len(hooks.read_ledger('test')), 2)
+        self.assertIsNone(hooks.read_ledger('idle'))
+
+        # Nothing changed, nothing applied.
+        apply_rules.reset_mock()
+        self.daemon.refresh()
+        apply_rules.assert_not_called()
+
+        # An event noticing the new file first applies the changes too. The
+        # rules of an active network move to its new IP range.
+        self.write_config(TEST_CONFIG, mtime=2000000000)
+        apply_rules.reset_mock()
+        with mock.patch('hookdaemon.active_networks',
+                        return_value={'default'}):
+            self.daemon.handle_event('qemu', 'test', 'reconnect')
+        self.assertEqual(len(hooks.read_ledger('test')), 1)
+        self.assertEqual(apply_rules.call_args_list[1][0][0], [
+            ['iptables', '-D', 'FORWARD', '-m', 'state', '-d',
+             '192.168.123.0/24', '--state', 'NEW,RELATED,ESTABLISHED', '-j',
+             'ACCEPT'],
+            ['iptables', '-I', 'FORWARD', '-m', 'state', '-d',
+             '192.168.122.0/24', '--state', 'NEW,RELATED,ESTABLISHED', '-j',
+             'ACCEPT']])
+
+    def test_watch(self, apply_rules):
+        apply_rules.return_value = True
+        self.daemon.handle_event('qemu', 'test', 'start')
+
+        async def edit():
+            self.daemon.lock = asyncio.Lock()
+            watcher = asyncio.get_running_loop().create_task(
+                self.daemon.watch())
+            await asyncio.sleep(0.05)
+            self.write_config(self.changed_config(), mtime=1000000000)
+            for retry in range(100):
+                if len(hooks.read_ledger('test')) == 2:
+                    break
+                await asyncio.sleep(0.01)
+            watcher.cancel()
+
+        with patch('hookdaemon.WATCH_INTERVAL', 0.01):
+            asyncio.run(edit())
+        self.assertEqual(len(hooks.read_ledger('test')), 2)
+
+    def test_socket(self, apply_rules):
+        socket_filename = os.path.join(self.tmp_dir.name, 'hookd.sock')
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(self.daemon.serve(socket_filename))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            with patch('hooks.SOCKET_FILENAME', socket_filename):
+                for retry in range(100):
+                    reply = hooks.forward_to_daemon('qemu', 'test', 'start')
+                    if reply is not None:
+                        break
+                    threading.Event().wait(0.01)
+            self.assertEqual(reply['status'], 'ok')
+            self.assertEqual(len(reply['cmds']), 1)
+        finally:
+            loop.call_soon_threadsafe(task.cancel)
+            # Let the server close and remove the socket before stopping.
+            for retry in range(100):
+                if task.done():
+                    break
+                threading.Event().wait(0.01)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+        # Without a daemon the hook runs the event itself.
+        with patch('hooks.SOCKET_FILENAME', socket_filename):
+            self.assertIsNone(hooks.forward_to_daemon('qemu', 'test',
+                                                      'start'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+"""
+Libvirt port-forwarding hook config file parser library unit tests.
+
+0.0.1:
+======
+
+ * Compiled configuration cache tests.
+ * Atomic and locked write tests.
+
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import unittest
+from hookjsonconf import HookConfig, ConfigChangedError, locked
+
+
+TEST_CONFIG = {
+    'debug': False,
+    'machines': {
+        'test': {
+            'private_ip': '192.168.122.2',
+            'port_map': [['2222', '22'], ['8002', '80']]
+        },
+        'other': {
+            'private_ip': '192.168.122.3',
+            'port_map': [['2223', '22']]
+        }
+    },
+    'networks': {
+        'default': '192.168.122.0/24'
+    },
+    'public_ip': '192.168.0.166'
+}
+
+
+class HookConfigTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'config.json')
+        self.write_config(TEST_CONFIG)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_config(self, config):
+        with open(self.filename, 'w') as json_file:
+            json.dump(config, json_file)
+
+    def test_parse_build(self):
+        json_config = HookConfig(json.dumps(TEST_CONFIG))
+        self.assertEqual(json_config.config, TEST_CONFIG)
+        self.assertEqual(json.loads(json_config.build(TEST_CONFIG, True)),
+                         TEST_CONFIG)
+
+    def test_load_single_entry(self):
+        config = HookConfig().load(self.filename, machine='test')
+        self.assertTrue(os.path.exists(self.filename + '.cache'))
+        self.assertEqual(config['public_ip'], '192.168.0.166')
+        self.assertEqual(config['machines'],
+                         {'test': TEST_CONFIG['machines']['test']})
+        self.assertEqual(config['networks'], {})
+
+        # Loaded from the cache this time.
+        config = HookConfig().load(self.filename, network='default')
+        self.assertEqual(config['machines'], {})
+        self.assertEqual(config['networks'], TEST_CONFIG['networks'])
+
+        config = HookConfig().load(self.filename, machine='missing')
+        self.assertEqual(config['machines'], {})
+
+    def test_load_rebuilds_on_change(self):
+        HookConfig().load(self.filename, machine='test')
+        changed = json.loads(json.dumps(TEST_CONFIG))
+        changed['machines']['test']['port_map'].append(['8443', '443'])
+        self.write_config(changed)
+        # Make sure the stamp differs even on coarse file systems.
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns,
+                                    stat.st_mtime_ns + 1000000000))
+
+        config = HookConfig().load(self.filename, machine='test')
+        self.assertIn(['8443', '443'],
+                      config['machines']['test']['port_map'])
+
+    def test_load_touched(self):
+        HookConfig().load(self.filename, machine='test')
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns,
+                                    stat.st_mtime_ns + 1000000000))
+        config = HookConfig().load(self.filename, machine='test')
+        self.assertEqual(config['machines']['test'],
+                         TEST_CONFIG['machines']['test'])
+
+    def test_load_corrupt_cache(self):
+        HookConfig().load(self.filename, machine='test')
+        with open(self.filename + '.cache', 'r+b') as cache_file:
+            cache_file.seek(-4, os.SEEK_END)
+            cache_file.write(b'\xff\xff\xff\xff')
+        config = HookConfig().load(self.filename, machine='other')
+        self.assertEqual(config['machines'],
+                         {'other': TEST_CONFIG['machines']['other']})
+
+        with open(self.filename + '.cache', 'wb') as cache_file:
+            cache_file.write(b'garbage')
+        config = HookConfig().load(self.filename, machine='other')
+        self.assertEqual(config['machines'],
+                         {'other': TEST_CONFIG['machines']['other']})
+
+    def test_load_invalid_json(self):
+        with open(self.filename, 'w') as json_file:
+            json_file.write('{')
+        with self.assertRaises(json.JSONDecodeError):
+            HookConfig().load(self.filename, machine='test')
+
+    def test_write(self):
+        os.chmod(self.filename, 0o640)
+        json_config = HookConfig()
+        config = json_config.read(self.filename)
+        config['debug'] = True
+        json_config.write(self.filename, config)
+        self.assertEqual(HookConfig().read(self.filename)['debug'], True)
+        self.assertEqual(os.stat(self.filename).st_mode & 0o777, 0o640)
+        # No temporary files are left behind.
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)),
+                         ['config.json', 'config.json.lock'])
+        # The cache follows the new file.
+        self.assertEqual(HookConfig().load(self.filename)['debug'], True)
+
+        # Writing again after our own write is fine.
+        config['public_ip'] = '192.168.0.1'
+        json_config.write(self.filename, config)
+
+    def test_write_changed(self):
+        json_config = HookConfig()
+        config = json_config.read(self.filename)
+        # Touching the file is not a change.
+        os.utime(self.filename, ns=(1000000000, 1000000000))
+        json_config.write(self.filename, config)
+
+        other = HookConfig()
+        other.read(self.filename)
+        other.config['debug'] = True
+        other.write(self.filename)
+        config['public_ip'] = '192.168.0.1'
+        with self.assertRaises(ConfigChangedError):
+            json_config.write(self.filename, config)
+        self.assertEqual(HookConfig().read(self.filename)['public_ip'],
+                         TEST_CONFIG['public_ip'])
+
+    def test_locked(self):
+        def try_lock(operation):
+            with open(self.filename + '.lock', 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+                    return True
+                except BlockingIOError:
+                    return False
+
+        with locked(self.filename):
+            self.assertTrue(try_lock(fcntl.LOCK_SH))
+            self.assertFalse(try_lock(fcntl.LOCK_EX))
+        with locked(self.filename, exclusive=True):
+            self.assertFalse(try_lock(fcntl.LOCK_SH))
+        self.assertTrue(try_lock(fcntl.LOCK_EX))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+"""
+Libvirt port-forwarding hook configuration model unit tests.
+
+0.0.1:
+======
+
+ * Model checks and rules built from models.
+
+"""
+
+import ipaddress
+import unittest
+from unittest.mock import patch
+
+with patch.dict('os.environ', values={'IPTABLES_BINARY': 'iptables'}, clear=True):
+    import hooks
+    from hookmodel import Machine, Network, PortMapping, build_models
+
+
+TEST_CONFIG = {
+    'debug': False,
+    'machines': {
+        'test': {
+            'private_ip': '192.168.122.2',
+            'port_map': [['2222', '22'], [8002, 80],
+                         ['27000-27010', '27000-27010']]
+        }
+    },
+    'networks': {
+        'default': '192.168.122.0/24'
+    },
+    'public_ip': '192.168.0.166'
+}
+
+
+class HookModelTestCase(unittest.TestCase):
+
+    def test_port_mapping(self):
+        mapping = PortMapping('2222', '22')
+        self.assertEqual((mapping.public_first, mapping.private_last),
+                         (2222, 22))
+        self.assertEqual(list(mapping), [2222, 22])
+        self.assertEqual(list(PortMapping('27000-27010', '28000-28010')),
+                         ['27000-27010', '28000-28010'])
+        self.assertEqual(PortMapping(8080, 80), PortMapping('8080', '80'))
+        self.assertFalse(hasattr(mapping, '__dict__'))
+
+        for public_port, private_port in [('80', '80-81'), (70000, 80),
+                                          ('2000-1000', '2000-1000'),
+                                          ('http', 80), (None, 80)]:
+            with self.assertRaises(ValueError):
+                PortMapping(public_port, private_port)
+
+    def test_machine(self):
+        machine = Machine.from_config('test', TEST_CONFIG['machines']['test'])
+        self.assertEqual(machine.private_ip,
+                         ipaddress.ip_address('192.168.122.2'))
+        self.assertEqual(machine['private_ip'], '192.168.122.2')
+        self.assertEqual(machine.to_config(), {
+            'private_ip': '192.168.122.2',
+            'port_map': [[2222, 22], [8002, 80],
+                         ['27000-27010', '27000-27010']]})
+        with self.assertRaises(KeyError):
+            machine['name']
+
+        for value in [{'private_ip': '192.168.122.300', 'port_map': []},
+                      {'private_ip': '192.168.122.2'},
+                      {'private_ip': '192.168.122.2', 'port_map': [[80]]}]:
+            with self.assertRaises(ValueError):
+                Machine.from_config('test', value)
+
+    def test_network(self):
+        self.assertEqual(str(Network('default', '192.168.122.0/24')),
+                         '192.168.122.0/24')
+        self.assertEqual(str(Network('default', '192.168.122.1/24')),
+                         '192.168.122.0/24')
+        with self.assertRaises(ValueError):
+            Network('default', '192.168.122.0/33')
+
+    def test_rules(self):
+        models = build_models(TEST_CONFIG)
+        for action in ['start', 'stopped', 'reconnect']:
+            self.assertEqual(
+                hooks.machine_rules(action, 'test', models['machines']['test'],
+                                    models),
+                hooks.machine_rules(action, 'test',
+                                    TEST_CONFIG['machines']['test'],
+                                    TEST_CONFIG))
+        for action in ['plugged', 'unplugged']:
+            self.assertEqual(
+                hooks.network_rules(action, models['networks']['default'],
+                                    models),
+                hooks.network_rules(action,
+                                    TEST_CONFIG['networks']['default'],
+                                    TEST_CONFIG))
+
+        # The DNAT rules are built once per machine.
+        machine = models['machines']['test']
+        self.assertIs(hooks.dnat_rules(models, machine),
+                      hooks.dnat_rules(models, machine))
+        self.assertEqual(len(machine.templates), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+"""
+Libvirt port-forwarding hook SQLite configuration store unit tests.
+
+0.0.1:
+======
+
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from hookjsonconf import HookConfig
+from hooksqlconf import HookSQLConfig
+
+
+TEST_CONFIG = {
+    'debug': True,
+    'machines': {
+        'test': {
+            'private_ip': '192.168.122.2',
+            'port_map': [['2222', '22'], [8002, 80]]
+        },
+        'empty': {
+            'private_ip': '192.168.122.3',
+            'port_map': []
+        }
+    },
+    'networks': {
+        'default': '192.168.122.0/24'
+    },
+    'public_ip': '192.168.0.166'
+}
+
+
+class HookSQLConfigTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'config.db')
+        self.store = HookSQLConfig(self.filename)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        self.store.import_config(TEST_CONFIG)
+        self.assertEqual(self.store.export_config(), TEST_CONFIG)
+
+    def test_load(self):
+        self.store.import_config(TEST_CONFIG)
+        config = HookConfig().load(self.filename, machine='test')
+        self.assertEqual(config['public_ip'], '192.168.0.166')
+        self.assertEqual(config['machines'],
+                         {'test': TEST_CONFIG['machines']['test']})
+        self.assertEqual(config['networks'], {})
+
+        config = HookConfig().load(self.filename, network='default')
+        self.assertEqual(config['networks'], TEST_CONFIG['networks'])
+
+    def test_unique_public_port(self):
+        self.store.import_config(TEST_CONFIG)
+        self.assertEqual(self.store.port_owner('2222'), 'test')
+        self.assertEqual(self.store.port_owner('2000-2300'), 'test')
+        self.assertIsNone(self.store.port_owner('2223-2300'))
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.store.add_port('empty', '2222', '22')
+        # Whatever the type of the port.
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.store.add_port('empty', 2222, 22)
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.store.add_port('empty', '8002-8003', '80-81')
+
+    def test_remove_port(self):
+        self.store.import_config(TEST_CONFIG)
+        # Ports match whatever type they were stored with.
+        self.assertFalse(self.store.remove_port('test', 2222, 23))
+        self.assertFalse(self.store.remove_port('empty', 2222, 22))
+        self.assertTrue(self.store.remove_port('test', 2222, 22))
+        self.assertTrue(self.store.remove_port('test', '8002', '80'))
+        self.assertEqual(self.store.machine('test')['port_map'], [])
+
+    def test_owners(self):
+        self.store.import_config(TEST_CONFIG)
+        self.assertEqual(self.store.ip_owner('192.168.122.3'), 'empty')
+        self.assertIsNone(self.store.ip_owner('192.168.122.4'))
+        self.assertEqual(self.store.network_owner('192.168.122.128/25'),
+                         'default')
+        self.assertEqual(self.store.network_owner('192.168.0.0/16'),
+                         'default')
+        self.assertIsNone(self.store.network_owner('192.168.123.0/24'))
+        self.assertIsNone(self.store.network_owner('fd00::/8'))
+
+    def test_migrate(self):
+        self.store.close()
+        os.remove(self.filename)
+        db = sqlite3.connect(self.filename)
+        db.executescript("CREATE TABLE networks (name TEXT PRIMARY KEY, "
+                         "network TEXT NOT NULL); INSERT INTO networks "
+                         "VALUES ('default', '192.168.122.0/24'); "
+                         "CREATE TABLE port_maps (machine TEXT NOT NULL, "
+                         "public_port NOT NULL UNIQUE, vm_port NOT NULL, "
+                         "public_first INTEGER NOT NULL, public_last INTEGER "
+                         "NOT NULL); CREATE INDEX port_maps_public ON "
+                         "port_maps (public_first);")
+        db.commit()
+        db.close()
+
+        self.store = HookSQLConfig(self.filename)
+        self.assertEqual(self.store.network_owner('192.168.122.0/25'),
+                         'default')
+        self.store.import_config(TEST_CONFIG)
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.store.add_port('empty', 2222, 22)
+        self.assertEqual(self.store.export_config()['networks'],
+                         TEST_CONFIG['networks'])
+
+    def test_transaction_rollback(self):
+        self.store.import_config(TEST_CONFIG)
+        with self.assertRaises(ValueError):
+            with self.store.transaction():
+                self.store.remove_machine('test')
+                raise ValueError()
+        self.assertEqual(self.store.export_config(), TEST_CONFIG)
+
+        with self.store.transaction():
+            self.store.remove_machine('test')
+        self.assertIsNone(self.store.machine('test'))
+        # Port mappings go away with the machine.
+        self.assertIsNone(self.store.port_owner('2222'))
+
+
+if __name__ == '__main__':
+    unittest.main()